@@ -0,0 +1,67 @@
+"""
+Compares the cache codecs on survey listing pages: bytes stored in Redis and decode time per page.
+
+    python benchmarks/bench_codecs.py [--repeat 200] [--content-size 400]
+
+zstd and lz4 are skipped when their library is not installed.
+"""
+from mango.core.store.codec import CacheCodec
+from mango.core.models.survey import SurveySchema
+from mango.core.models.reader import compile_reader
+from bench_readers import survey_page
+import argparse
+import timeit
+import random
+
+CODECS = [
+    ('json', CacheCodec()),
+    ('msgpack', CacheCodec('msgpack')),
+    ('msgpack+zlib', CacheCodec('msgpack', 'zlib')),
+    ('msgpack+zstd', lambda: CacheCodec('msgpack', 'zstd')),
+    ('msgpack+lz4', lambda: CacheCodec('msgpack', 'lz4')),
+]
+
+WORDS = ('clean', 'room', 'staff', 'friendly', 'check-in', 'late', 'view', 'noisy', 'breakfast', 'wifi', 'bed',
+         'comfortable', 'location', 'great', 'small', 'bathroom', 'would', 'stay', 'again', 'not', 'the', 'was', 'very')
+
+
+def cached_page(size, content_size, seed=1):
+    # a page as it is cached: loaded documents, with free-text content of realistic length
+    read = compile_reader(SurveySchema(exclude_none_id=True))
+    rng = random.Random(seed)
+    page = [read(survey) for survey in survey_page(size)]
+    for survey in page:
+        words = []
+        while sum(len(word) + 1 for word in words) < content_size:
+            words.append(rng.choice(WORDS))
+        survey['content'] = ' '.join(words)
+    return page
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--content-size', type=int, default=400, help='approximate length of survey content')
+    args = parser.parse_args()
+
+    codecs = []
+    for name, codec in CODECS:
+        try:
+            codecs.append((name, codec() if callable(codec) else codec))
+        except ImportError as e:
+            print('skipping {}: {}'.format(name, e))
+
+    print('{:>6} {:>14} {:>12} {:>16} {:>16}'.format('page', 'codec', 'bytes', 'encode (ms)', 'decode (ms)'))
+    for size in (10, 50, 100, 200):
+        page = cached_page(size, args.content_size)
+        for name, codec in codecs:
+            data = codec.encode(page)
+            assert codec.decode(data) == page
+            encode_time = timeit.timeit(lambda: codec.encode(page), number=args.repeat) / args.repeat
+            decode_time = timeit.timeit(lambda: codec.decode(data), number=args.repeat) / args.repeat
+            print('{:>6} {:>14} {:>12} {:>16.3f} {:>16.3f}'.format(
+                size, name, len(data), encode_time * 1000, decode_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
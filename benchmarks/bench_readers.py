@@ -0,0 +1,48 @@
+"""
+Compares marshmallow `schema.load(many=True)` against the compiled trusted reader on survey pages.
+
+    python benchmarks/bench_readers.py [--repeat 200]
+"""
+from mango.core.models.survey import SurveySchema
+from mango.core.models.reader import compile_reader
+from bson import ObjectId
+import argparse
+import timeit
+
+
+def survey_page(size):
+    return [{
+        '_id': ObjectId(),
+        'user_id': str(i),
+        'staff_id': '',
+        'reservation_id': str(i),
+        'total_rating': i % 5,
+        'status': 'published',
+        'content': 'survey content {}'.format(i),
+        'platform': 'android',
+        'city': 'tehran',
+        'complex': '12',
+        'checkout_date': '2019-08-10',
+        'questions': [{'question_id': str(ObjectId()), 'rating': (i + q) % 5} for q in range(5)],
+    } for i in range(size)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    schema = SurveySchema(exclude_none_id=True)
+    read = compile_reader(schema)
+
+    print('{:>6} {:>14} {:>14} {:>8}'.format('page', 'schema (ms)', 'reader (ms)', 'speedup'))
+    for size in (10, 50, 100, 200):
+        page = survey_page(size)
+        schema_time = timeit.timeit(lambda: schema.load(page, many=True), number=args.repeat) / args.repeat
+        reader_time = timeit.timeit(lambda: [read(doc) for doc in page], number=args.repeat) / args.repeat
+        speedup = schema_time / reader_time
+        print('{:>6} {:>14.3f} {:>14.3f} {:>7.1f}x'.format(size, schema_time * 1000, reader_time * 1000, speedup))
+
+
+if __name__ == '__main__':
+    main()
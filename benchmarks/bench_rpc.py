@@ -0,0 +1,224 @@
+"""
+Benchmarks every MangoService RPC on an in-process gRPC server backed by the mongod and redis-server of a mango
+configuration file, and writes throughput and latency percentiles to a JSON file so runs of two commits can be diffed.
+
+Surveys and questions are seeded into a dedicated database (`--database`, dropped first), redis keys are shared with
+anything else using the same redis db, so point `--config` at a local, disposable setup:
+
+    python benchmarks/bench_rpc.py --config /etc/mango/mango.yml --surveys 20000 --output bench-rpc.json
+"""
+from olive.store.mongo_connection import MongoConnection
+from olive.proto import zoodroom_pb2_grpc, zoodroom_pb2
+from mango.core.store.question import QuestionStore
+from mango.core.toolbox import summarize_latencies
+from mango.core.store.survey import SurveyStore
+from mango.core.store.stats import SurveyStatsStore
+from mango.core.survey import MangoService
+from mango.main import MangoAppTest
+from concurrent import futures
+import subprocess
+import itertools
+import threading
+import argparse
+import datetime
+import random
+import time
+import json
+import grpc
+
+PLATFORMS = ('android', 'ios', 'web')
+STATUSES = ('published', 'pending', 'rejected')
+CITIES = ('tehran', 'shiraz', 'isfahan', 'tabriz', 'mashhad')
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        return commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed(question_store, survey_store, question_count, survey_count, batch_size=1000):
+    """Creates `question_count` rating questions and `survey_count` surveys rating a random subset of them."""
+    question_ids = [question_store.save({'title': {'on_rate': 'question {}'.format(i),
+                                                   'on_display': 'question {}'.format(i)},
+                                         'include_in': ['user_rate', 'rate_display'],
+                                         'weight': random.randint(1, 3),
+                                         'order': i})
+                    for i in range(question_count)]
+
+    rng = random.Random(42)
+    for start in range(0, survey_count, batch_size):
+        surveys = []
+        for i in range(start, min(start + batch_size, survey_count)):
+            ratings = [{'question_id': question_id, 'rating': rng.randint(1, 5)}
+                       for question_id in rng.sample(question_ids, min(5, len(question_ids)))]
+            surveys.append({
+                'user_id': str(rng.randint(1, survey_count)),
+                'staff_id': '',
+                'reservation_id': 'bench-{}'.format(i),
+                'status': rng.choice(STATUSES),
+                'content': 'benchmark survey {}'.format(i),
+                'questions': ratings,
+                'total_rating': round(sum(r['rating'] for r in ratings) / len(ratings)),
+                'platform': rng.choice(PLATFORMS),
+                'city': rng.choice(CITIES),
+                'complex': str(rng.randint(1, 50)),
+                'checkout_date': (datetime.date(2019, 1, 1) + datetime.timedelta(days=rng.randint(0, 364))).isoformat(),
+            })
+        survey_store.save_many(surveys)
+
+    return question_ids
+
+
+def run_scenario(call, requests, concurrency, prepare=None):
+    """
+    Runs `call(i)` for i in range(requests) from `concurrency` threads. Only `call` is timed, `prepare(i)` (e.g. a cache
+    invalidation) runs right before it. Returns throughput, latency percentiles and error codes.
+    """
+    counter = itertools.count()
+    latencies = []
+    error_codes = {}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            i = next(counter)
+            if i >= requests:
+                return
+            if prepare:
+                prepare(i)
+
+            start = time.perf_counter()
+            try:
+                code = call(i)
+            except grpc.RpcError as e:
+                code = 'grpc_{}'.format(e.code().name.lower())
+            latencies.append(time.perf_counter() - start)
+            if code:
+                with lock:
+                    error_codes[code] = error_codes.get(code, 0) + 1
+
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for task in [executor.submit(worker) for _ in range(concurrency)]:
+            task.result()
+    elapsed = time.perf_counter() - start
+
+    result = summarize_latencies(latencies)
+    result['throughput_rps'] = len(latencies) / elapsed if elapsed else None
+    result['errors'] = error_codes
+    return result
+
+
+def scenarios(stub, question_ids, survey_store, survey_count, run_id):
+    def add_survey(i):
+        rated = random.sample(question_ids, min(5, len(question_ids)))
+        return stub.AddSurvey(zoodroom_pb2.AddSurveyRequest(
+            user_id=str(i),
+            reservation_id='bench-add-{}-{}'.format(run_id, i),
+            status='published',
+            content='benchmark survey',
+            platform=random.choice(PLATFORMS),
+            questions=[zoodroom_pb2.SurveyQuestion(question_id=q, rating=random.randint(1, 5)) for q in rated],
+        )).error.code
+
+    def get_surveys(i):
+        return stub.GetSurveys(zoodroom_pb2.GetSurveysRequest(page_size=50)).error.code
+
+    def get_questions(i):
+        return stub.GetQuestions(zoodroom_pb2.GetQuestionsRequest()).error.code
+
+    def get_survey_by_reservation_id(i):
+        reservation_id = 'bench-{}'.format(random.randrange(survey_count))
+        return stub.GetSurveyByReservationId(
+            zoodroom_pb2.GetSurveyByReservationIdRequest(reservation_id=reservation_id)).error.code
+
+    def stream_get_surveys(i):
+        code = ''
+        for response in stub.StreamGetSurveys(zoodroom_pb2.StreamGetSurveysRequest(batch_size=500)):
+            code = code or response.error.code
+        return code
+
+    return [
+        # (name, call, prepare, requests multiplier)
+        ('AddSurvey', add_survey, None, 1),
+        ('GetSurveys (uncached)', get_surveys, lambda i: survey_store.surveys_generation.bump(), 1),
+        ('GetSurveys (cached)', get_surveys, None, 1),
+        ('GetQuestions', get_questions, None, 1),
+        ('GetSurveyByReservationId', get_survey_by_reservation_id, None, 1),
+        # every call reads the whole collection
+        ('StreamGetSurveys', stream_get_surveys, None, 0.01),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='/etc/mango/mango.yml')
+    parser.add_argument('--database', default='mango_benchmark')
+    parser.add_argument('--questions', type=int, default=20)
+    parser.add_argument('--surveys', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=2000, help='calls per RPC')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=10, help='gRPC server threads')
+    parser.add_argument('--output', default='bench-rpc.json')
+    args = parser.parse_args()
+
+    with MangoAppTest(config_files=[args.config]) as app:
+        # request logging would dominate the measurements
+        app.log.set_level('WARNING')
+
+        client = MongoConnection(app.config['mango']['mongodb'], app).service_db.client
+        client.drop_database(args.database)
+        target_database = client[args.database]
+        question_store = QuestionStore(target_database.question, app)
+        stats_store = SurveyStatsStore(target_database.survey_stats, app)
+        survey_store = SurveyStore(target_database.survey, app, stats_store=stats_store)
+        question_store.ensure_indexes()
+        survey_store.ensure_indexes()
+
+        seed_start = time.perf_counter()
+        question_ids = seed(question_store, survey_store, args.questions, args.surveys)
+        seed_time = time.perf_counter() - seed_start
+        app.log.warning('seeded {} questions and {} surveys in {:.1f}s'.format(args.questions, args.surveys, seed_time))
+
+        service = MangoService(question_store, survey_store, app,
+                               ranges=app.config['mango']['survey_setting']['ranges'],
+                               legacy_url=app.config['mango']['legacy']['base_url'],
+                               legacy_key=app.config['mango']['legacy']['key'],
+                               stats_store=stats_store)
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.workers))
+        zoodroom_pb2_grpc.add_MangoServiceServicer_to_server(service, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        server.start()
+
+        results = {}
+        try:
+            with grpc.insecure_channel('127.0.0.1:{}'.format(port)) as channel:
+                stub = zoodroom_pb2_grpc.MangoServiceStub(channel)
+                for name, call, prepare, multiplier in scenarios(stub, question_ids, survey_store, args.surveys,
+                                                                 run_id=int(time.time())):
+                    requests = max(1, int(args.requests * multiplier))
+                    # warm up connections and, for the cached scenarios, the cache
+                    call(0)
+                    results[name] = run_scenario(call, requests, args.concurrency, prepare)
+                    print('{:<28} {:>9.1f} rps  p50 {:>8.2f}ms  p95 {:>8.2f}ms  p99 {:>8.2f}ms  errors {}'.format(
+                        name, results[name]['throughput_rps'], results[name]['p50_ms'], results[name]['p95_ms'],
+                        results[name]['p99_ms'], results[name]['errors'] or '-'))
+        finally:
+            server.stop(None)
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.utcnow().isoformat(),
+        'parameters': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print('results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Times GetSurveyAnalytics queries on a survey snapshot of synthetic surveys spread over two years.
+
+    python benchmarks/bench_snapshot.py [--surveys 5000000] [--repeat 20]
+"""
+from mango.core.snapshot import SurveySnapshot
+import numpy as np
+import argparse
+import datetime
+import tempfile
+import logging
+import timeit
+
+QUERIES = [
+    ('total_rating per day', {'interval': 'day'}),
+    ('total_rating per week, android', {'interval': 'week', 'platform': 'android'}),
+    ('total_rating per day, one month', {'interval': 'day', 'start': '2019-03-01', 'end': '2019-04-01'}),
+    ('question ratings per week', {'interval': 'week', 'question_id': 'q3', 'percentiles': (25, 50, 75, 99)}),
+]
+
+
+class BenchApp:
+    log = logging.getLogger('mango-bench')
+
+
+def write_columns(snapshot, count, questions_per_survey=5, seed=1):
+    # the columns refresh() would write for `count` surveys, generated without mongo
+    rng = np.random.default_rng(seed)
+    start = (datetime.date(2018, 1, 1) - datetime.date(1970, 1, 1)).days
+    columns = {
+        'created_day': np.sort(rng.integers(start, start + 2 * 365, count)),
+        'total_rating': rng.integers(1, 6, count),
+        'platform': rng.integers(0, 2, count),
+        'status': rng.integers(0, 2, count),
+        'rating_survey': np.repeat(np.arange(count), questions_per_survey),
+        'rating_question': np.tile(np.arange(questions_per_survey), count),
+        'rating': rng.integers(1, 6, count * questions_per_survey),
+    }
+    for name, dtype in snapshot.survey_columns + snapshot.rating_columns:
+        columns[name].astype(dtype).tofile(snapshot._column_path(name, 0))
+
+    snapshot._write_meta({'generation': 0, 'count': count, 'ratings_count': count * questions_per_survey,
+                          'last_id': None, 'last_day': int(columns['created_day'][-1]), 'sorted': True,
+                          'platforms': ['android', 'ios'], 'statuses': ['published', 'pending'],
+                          'questions': ['q{}'.format(i) for i in range(questions_per_survey)]})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--surveys', type=int, default=5000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        snapshot = SurveySnapshot(BenchApp(), path)
+        write_columns(snapshot, args.surveys)
+        print('{} surveys'.format(args.surveys))
+        for name, query in QUERIES:
+            result = snapshot.analytics(**query)
+            elapsed = timeit.timeit(lambda: snapshot.analytics(**query), number=args.repeat) / args.repeat
+            print('{:>36} {:>10} ratings {:>5} buckets {:>10.2f} ms'.format(
+                name, result['count'], len(result['buckets']), elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,16 @@
 from cement import Controller, ex
+import datetime
+import json
 from cement.utils.version import get_version_banner
+from mango.core.store.stats import SurveyStatsStore
+from mango.core.store.indexes import explain_query_shapes
+from mango.core.store.question import QuestionStore
+from mango.core.store.survey import SurveyStore
+from mango.core.legacy import ReservationResolver
+from mango.core.loadtest import LoadTest, parse_mix
+from mango.core.recompute import RatingRecompute
+from mango.core.export import SurveyExport
+from mango.core.snapshot import SurveySnapshot
 from mango.core.version import get_version
 
 VERSION_BANNER = """
@@ -16,7 +27,7 @@ class Base(Controller):
         description = 'Authorization Server based on OAuth 2.0'
 
         # text displayed at the bottom of --help output
-        epilog = 'Usage: mango command1 --foo bar'
+        epilog = 'Usage: mango loadtest --target 127.0.0.1:9000 --rate 200 --duration 60'
 
         # controller level arguments. ex: 'mango --version'
         arguments = [
@@ -30,33 +41,386 @@ class Base(Controller):
     def _default(self):
         """Default action if no sub-command is passed."""
 
-        self.app.args.print_help()
+        self.app.run_server()
+
+    @ex(help='recompute survey rating aggregates (GetSurveyStats) from the survey collection')
+    def rebuild_stats(self):
+        target_database = self.app.get_database()
+        stats_store = SurveyStatsStore(target_database.survey_stats, self.app)
+        survey_count = stats_store.rebuild(target_database.survey)
+        self.app.log.info('survey stats rebuilt from {} surveys'.format(survey_count))
+
+    @ex(
+        help='copy city, complex and checkout_date of the legacy reservations onto surveys missing them',
+        arguments=[
+            (
+                    ['--batch-size'],
+                    {
+                        'help': 'surveys updated per bulk write',
+                        'action': 'store',
+                        'type': int,
+                        'default': 500,
+                        'dest': 'batch_size'
+                    }
+            ),
+            (
+                    ['--workers'],
+                    {
+                        'help': 'concurrent legacy API lookups',
+                        'action': 'store',
+                        'type': int,
+                        'default': 8,
+                        'dest': 'workers'
+                    }
+            ),
+        ],
+    )
+    def backfill_reservations(self):
+        survey_store = SurveyStore(self.app.get_database().survey, self.app)
+        survey_store.ensure_indexes()
+        reservation_resolver = ReservationResolver.from_config(self.app)
+        updated_count = survey_store.backfill_reservation_attributes(reservation_resolver.get_reservation_attributes,
+                                                                     batch_size=self.app.pargs.batch_size,
+                                                                     workers=self.app.pargs.workers)
+        self.app.log.info('reservation attributes backfilled on {} surveys'.format(updated_count))
+
+    @ex(
+        help='rebuild the bloom filter of reservations having a survey (mango.reservation_filter) from the collection',
+        arguments=[
+            (
+                    ['--batch-size'],
+                    {
+                        'help': 'reservations read and added per round-trip',
+                        'action': 'store',
+                        'type': int,
+                        'default': 10000,
+                        'dest': 'batch_size'
+                    }
+            ),
+        ],
+    )
+    def rebuild_reservation_filter(self):
+        survey_store = SurveyStore(self.app.get_database().survey, self.app)
+        if not survey_store.reservation_filter:
+            self.app.log.error('mango.reservation_filter is not enabled')
+            self.app.exit_code = 1
+            return
+
+        reservation_count = survey_store.rebuild_reservation_filter(batch_size=self.app.pargs.batch_size)
+        self.app.log.info('reservation filter rebuilt from {} surveys'.format(reservation_count))
+
+    @ex(
+        help='recompute the total_rating of stored surveys with the current question weights, resuming an unfinished '
+             'recompute when no question is given',
+        arguments=[
+            (
+                    ['-q', '--question-id'],
+                    {
+                        'help': 'question whose weight changed, can be repeated',
+                        'action': 'append',
+                        'dest': 'question_ids'
+                    }
+            ),
+            (
+                    ['--all'],
+                    {
+                        'help': 'recompute every survey',
+                        'action': 'store_true',
+                        'dest': 'all'
+                    }
+            ),
+            (
+                    ['--batch-size'],
+                    {
+                        'help': 'surveys read, computed and written per batch',
+                        'action': 'store',
+                        'type': int,
+                        'default': 1000,
+                        'dest': 'batch_size'
+                    }
+            ),
+        ],
+    )
+    def recompute_ratings(self):
+        pargs = self.app.pargs
+        target_database = self.app.get_database()
+        rating_recompute = RatingRecompute(app=self.app,
+                                           question_store=QuestionStore(target_database.question, self.app),
+                                           survey_store=SurveyStore(target_database.survey, self.app),
+                                           stats_store=SurveyStatsStore(target_database.survey_stats, self.app),
+                                           batch_size=pargs.batch_size)
+        if pargs.all:
+            rating_recompute.request()
+        elif pargs.question_ids:
+            rating_recompute.request(pargs.question_ids)
+        elif not rating_recompute.status():
+            self.app.log.info('no total_rating recompute to resume')
+            return
+
+        if not rating_recompute.run():
+            self.app.exit_code = 1
+            return
+
+        job = rating_recompute.status()
+        self.app.log.info('total_rating recompute done: {} surveys read, {} updated'
+                          .format(job['processed'], job['updated']))
+
+    @ex(
+        help='export surveys to parquet (requires pyarrow), csv or jsonl files, reading _id ranges concurrently',
+        arguments=[
+            (
+                    ['-o', '--output'],
+                    {
+                        'help': 'directory the files and the export manifest are written to',
+                        'action': 'store',
+                        'required': True,
+                        'dest': 'output'
+                    }
+            ),
+            (
+                    ['--format'],
+                    {
+                        'help': 'file format',
+                        'action': 'store',
+                        'choices': ['parquet', 'csv', 'jsonl'],
+                        'default': 'parquet',
+                        'dest': 'format'
+                    }
+            ),
+            (
+                    ['--partitions'],
+                    {
+                        'help': '_id ranges the surveys are split into, one file each',
+                        'action': 'store',
+                        'type': int,
+                        'default': 8,
+                        'dest': 'partitions'
+                    }
+            ),
+            (
+                    ['--workers'],
+                    {
+                        'help': 'ranges read concurrently',
+                        'action': 'store',
+                        'type': int,
+                        'default': 4,
+                        'dest': 'workers'
+                    }
+            ),
+            (
+                    ['--batch-size'],
+                    {
+                        'help': 'surveys read and written at a time',
+                        'action': 'store',
+                        'type': int,
+                        'default': 5000,
+                        'dest': 'batch_size'
+                    }
+            ),
+            (
+                    ['--since'],
+                    {
+                        'help': 'only surveys inserted since this UTC timestamp, e.g. 2019-08-01T00:00:00',
+                        'action': 'store',
+                        'dest': 'since'
+                    }
+            ),
+            (
+                    ['--after-id'],
+                    {
+                        'help': 'only surveys inserted after this _id, the last_id of a previous export',
+                        'action': 'store',
+                        'dest': 'after_id'
+                    }
+            ),
+            (
+                    ['--incremental'],
+                    {
+                        'help': 'only surveys inserted after the last export found in the output directory',
+                        'action': 'store_true',
+                        'dest': 'incremental'
+                    }
+            ),
+        ],
+    )
+    def export(self):
+        pargs = self.app.pargs
+        try:
+            since = datetime.datetime.fromisoformat(pargs.since) if pargs.since else None
+            survey_export = SurveyExport(app=self.app,
+                                         db=self.app.get_database().survey,
+                                         output_dir=pargs.output,
+                                         export_format=pargs.format,
+                                         partitions=pargs.partitions,
+                                         workers=pargs.workers,
+                                         batch_size=pargs.batch_size)
+        except (ValueError, ImportError) as e:
+            self.app.log.error(str(e))
+            self.app.exit_code = 1
+            return
+
+        after_id = pargs.after_id
+        if pargs.incremental:
+            after_id = SurveyExport.latest_watermark(pargs.output) or after_id
+
+        manifest = survey_export.run(after_id=after_id, since=since)
+        self.app.log.info('export done: {} surveys, last_id {}'.format(manifest['count'], manifest['last_id']))
 
     @ex(
-        help='example sub command1',
+        help='add the surveys inserted since the last refresh to the columnar survey snapshot (mango.snapshot)',
+        arguments=[
+            (
+                    ['--rebuild'],
+                    {
+                        'help': 'copy every survey again, picking up rating changes of surveys already copied',
+                        'action': 'store_true',
+                        'dest': 'rebuild'
+                    }
+            ),
+            (
+                    ['--batch-size'],
+                    {
+                        'help': 'surveys read and appended at a time',
+                        'action': 'store',
+                        'type': int,
+                        'default': 10000,
+                        'dest': 'batch_size'
+                    }
+            ),
+        ],
+    )
+    def refresh_snapshot(self):
+        survey_snapshot = SurveySnapshot.from_config(self.app)
+        if not survey_snapshot:
+            self.app.log.error('mango.snapshot is not enabled')
+            self.app.exit_code = 1
+            return
 
-        # sub-command level arguments. ex: 'mango command1 --foo bar'
+        added = survey_snapshot.refresh(self.app.get_database().survey, batch_size=self.app.pargs.batch_size,
+                                        rebuild=self.app.pargs.rebuild)
+        if added is None:
+            self.app.log.error('the snapshot is being refreshed by another process')
+            self.app.exit_code = 1
+
+    @ex(help='ensure declared indexes, then explain() every store query shape and fail on collection scans')
+    def check_queries(self):
+        target_database = self.app.get_database()
+        collection_scans = []
+        for store_cls, collection in ((QuestionStore, target_database.question),
+                                      (SurveyStore, target_database.survey)):
+            store = store_cls(collection, self.app)
+            store.ensure_indexes()
+            for name, stages in explain_query_shapes(collection, store.query_shapes):
+                if 'COLLSCAN' in stages:
+                    collection_scans.append(name)
+                    self.app.log.error('{}.{}: collection scan ({})'.format(collection.name, name, ' < '.join(stages)))
+                elif 'SORT' in stages:
+                    self.app.log.warning('{}.{}: in-memory sort ({})'.format(collection.name, name, ' < '.join(stages)))
+                else:
+                    self.app.log.info('{}.{}: {}'.format(collection.name, name, ' < '.join(stages)))
+
+        if collection_scans:
+            self.app.exit_code = 1
+
+    @ex(
+        help='call a running mango server with a fixed arrival rate of mixed RPCs and report latencies per RPC '
+             '(AddSurvey creates surveys on the target)',
         arguments=[
-            # add a sample foo option under subcommand namespace
             (
-                    ['-f', '--foo'],
+                    ['-t', '--target'],
+                    {
+                        'help': 'gRPC address of the server, e.g. 127.0.0.1:9000',
+                        'action': 'store',
+                        'required': True,
+                        'dest': 'target'
+                    }
+            ),
+            (
+                    ['--mix'],
                     {
-                        'help': 'notorious foo option',
+                        'help': 'RPC=ratio pairs',
                         'action': 'store',
-                        'dest': 'foo'
+                        'default': 'GetSurveys=50,GetQuestions=20,GetSurveyByReservationId=20,AddSurvey=10',
+                        'dest': 'mix'
+                    }
+            ),
+            (
+                    ['--rate'],
+                    {
+                        'help': 'calls started per second',
+                        'action': 'store',
+                        'type': float,
+                        'default': 100,
+                        'dest': 'rate'
+                    }
+            ),
+            (
+                    ['--concurrency'],
+                    {
+                        'help': 'maximum calls in flight',
+                        'action': 'store',
+                        'type': int,
+                        'default': 32,
+                        'dest': 'concurrency'
+                    }
+            ),
+            (
+                    ['--duration'],
+                    {
+                        'help': 'seconds to send calls for',
+                        'action': 'store',
+                        'type': float,
+                        'default': 60,
+                        'dest': 'duration'
+                    }
+            ),
+            (
+                    ['--timeout'],
+                    {
+                        'help': 'per call deadline in seconds',
+                        'action': 'store',
+                        'type': float,
+                        'default': 5,
+                        'dest': 'timeout'
+                    }
+            ),
+            (
+                    ['-o', '--output'],
+                    {
+                        'help': 'also write the report as JSON to this file',
+                        'action': 'store',
+                        'dest': 'output'
                     }
             ),
         ],
     )
-    def command1(self):
-        """Example sub-command."""
+    def loadtest(self):
+        pargs = self.app.pargs
+        try:
+            mix = parse_mix(pargs.mix)
+        except ValueError as ve:
+            self.app.log.error(str(ve))
+            self.app.exit_code = 1
+            return
+
+        report = LoadTest(app=self.app,
+                          target=pargs.target,
+                          mix=mix,
+                          rate=pargs.rate,
+                          concurrency=pargs.concurrency,
+                          duration=pargs.duration,
+                          timeout=pargs.timeout).run()
 
-        data = {
-            'foo': 'bar',
-        }
+        for name, result in sorted(report['results'].items()):
+            if not result['count']:
+                self.app.log.info('{}: no calls'.format(name))
+                continue
 
-        # do something with arguments
-        if self.app.pargs.foo is not None:
-            data['foo'] = self.app.pargs.foo
+            codes = ', '.join('{}={}'.format(code, count) for code, count in sorted(result['codes'].items()))
+            self.app.log.info('{}: {} calls {:.1f}/s p50 {:.2f}ms p95 {:.2f}ms p99 {:.2f}ms max {:.2f}ms codes {}'
+                              .format(name, result['count'], result['throughput_rps'], result['p50_ms'],
+                                      result['p95_ms'], result['p99_ms'], result['max_ms'], codes))
 
-        self.app.render(data, 'command1.jinja2')
+        if pargs.output:
+            with open(pargs.output, 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
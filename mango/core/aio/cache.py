@@ -0,0 +1,78 @@
+from mango.core.store.cache import PipelinedCacheWrapper
+from mango.core.store.codec import CacheCodec
+from olive.exc import CacheNotFound
+
+
+class AsyncCacheWrapper:
+    """
+    Coroutine counterpart of `PipelinedCacheWrapper` over a `redis.asyncio` client, for the asyncio server mode.
+
+    Uses the same layout (values encoded by the configured CacheCodec under `cache_key.format(key)`, expiring after
+    `cache.iredis.expire_time`) so both server modes can share one Redis.
+    """
+
+    def __init__(self, app, redis, cache_key, codec=None):
+        self.app = app
+        self.redis = redis
+        self.cache_key = cache_key
+        self.codec = codec or CacheCodec.from_config(app)
+        self.expire_time = int(self.app.config.get('cache.iredis', 'expire_time') or 3600)
+
+    async def get_cache(self, key):
+        value = await self.redis.get(self.cache_key.format(key))
+        if value is None:
+            raise CacheNotFound('{} not found in cache'.format(self.cache_key.format(key)))
+
+        return self.codec.decode(value)
+
+    async def write_cache(self, key, value, expire_time=None):
+        await self.redis.set(self.cache_key.format(key), self.codec.encode(value), ex=expire_time or self.expire_time)
+
+    async def delete(self, key):
+        await self.redis.delete(self.cache_key.format(key))
+
+    async def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        values = await self.redis.mget([self.cache_key.format(key) for key in keys])
+        return {key: self.codec.decode(value) for key, value in zip(keys, values) if value is not None}
+
+    async def get_many_in_generation(self, generation, keys_in_generation, keys=()):
+        """Coroutine counterpart of `PipelinedCacheWrapper.get_many_in_generation`, always one EVAL."""
+        keys_in_generation, keys = list(keys_in_generation), list(keys)
+        arguments = []
+        for template in keys_in_generation:
+            arguments += self.cache_key.format(template).split('{}', 1)
+        number, *values = await self.redis.eval(PipelinedCacheWrapper.generation_read_script, 1 + len(keys),
+                                                generation.key, *[self.cache_key.format(key) for key in keys],
+                                                *arguments)
+        number = int(number)
+        return number, {key: self.codec.decode(value)
+                        for key, value in zip([template.format(number) for template in keys_in_generation] + keys,
+                                              values) if value is not None}
+
+    async def write_many(self, items, expire_time=None):
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(self.cache_key.format(key), self.codec.encode(value), ex=expire_time or self.expire_time)
+
+        await pipeline.execute()
+
+
+class AsyncCacheGeneration:
+    """Coroutine counterpart of `CacheGeneration`, reading and bumping the same Redis counter."""
+
+    def __init__(self, app, redis, key):
+        self.app = app
+        self.redis = redis
+        self.key = key
+
+    async def current(self):
+        return int(await self.redis.get(self.key) or 0)
+
+    async def bump(self):
+        generation = await self.redis.incr(self.key)
+        self.app.log.debug('cache generation {} bumped to {}'.format(self.key, generation))
+        return generation
@@ -0,0 +1,98 @@
+from mango.core.aio.store import AsyncQuestionStore, AsyncSurveyStore
+from mango.core.metrics import instrument_servicer, instrument_store
+from olive.proto import zoodroom_pb2_grpc, health_pb2_grpc
+from mango.core.aio.service import AsyncMangoService
+from mango.core.store.stats import SurveyStatsStore
+from mango.core.recompute import RatingRecompute
+from mango.core.snapshot import SurveySnapshot
+from motor.motor_asyncio import AsyncIOMotorClient
+from olive.proto.health import HealthService
+from concurrent import futures
+import redis.asyncio
+import asyncio
+import grpc
+
+
+class AsyncMangoServer:
+    """
+    Serves MangoService from a grpc.aio server on one event loop (`mango.server.mode: asyncio`).
+
+    The asynchronous Mongo and Redis clients are created inside the loop. The synchronous stores given here back the
+    RPCs AsyncMangoService inherits, which grpc.aio runs on its migration thread pool.
+    """
+
+    def __init__(self, service_name, question_store, survey_store, app, stats_store=None):
+        self.service_name = service_name
+        self.question_store = question_store
+        self.survey_store = survey_store
+        self.stats_store = stats_store
+        self.app = app
+        self.server_cfg = self.app.config['mango'].get('server') or {}
+
+    def start(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        app = self.app
+        mongo_client = AsyncIOMotorClient(**dict(app.config['mango']['mongodb']))
+        target_database = mongo_client[self.survey_store.db.database.name]
+        redis_cfg = app.config.get_section_dict('cache.iredis')
+        redis_client = redis.asyncio.Redis(host=redis_cfg.get('host', '127.0.0.1'),
+                                           port=redis_cfg.get('port', 6379),
+                                           db=redis_cfg.get('db', 0),
+                                           password=redis_cfg.get('password'))
+
+        aio_stats_store = None
+        if self.stats_store:
+            aio_stats_store = SurveyStatsStore(target_database[self.stats_store.db.name], app)
+        aio_question_store = AsyncQuestionStore(target_database[self.question_store.db.name], app, redis_client)
+        aio_survey_store = AsyncSurveyStore(target_database[self.survey_store.db.name], app, redis_client,
+                                            stats_store=aio_stats_store)
+
+        legacy_cfg = app.config['mango']['legacy']
+        rating_recompute = RatingRecompute.from_config(app, self.question_store, self.survey_store, self.stats_store)
+        survey_snapshot = SurveySnapshot.from_config(app)
+        service = AsyncMangoService(question_store=self.question_store,
+                                    survey_store=self.survey_store,
+                                    app=app,
+                                    ranges=app.config['mango']['survey_setting']['ranges'],
+                                    legacy_url=legacy_cfg['base_url'],
+                                    legacy_key=legacy_cfg['key'],
+                                    aio_question_store=aio_question_store,
+                                    aio_survey_store=aio_survey_store,
+                                    legacy_workers=legacy_cfg.get('pool_size', 10),
+                                    bulk_batch_size=(app.config['mango'].get('bulk') or {}).get('batch_size', 500),
+                                    stats_store=self.stats_store,
+                                    local_reservation_filters=legacy_cfg.get('local_filters', False),
+                                    enrich_surveys=legacy_cfg.get('enrich_surveys', False),
+                                    rating_recompute=rating_recompute,
+                                    max_reservation_ids=(app.config['mango'].get('bulk') or {}).get(
+                                        'max_reservation_ids', 500),
+                                    survey_snapshot=survey_snapshot)
+        if rating_recompute:
+            rating_recompute.start()
+        if survey_snapshot:
+            survey_snapshot.start(self.survey_store.db)
+
+        if (app.config['mango'].get('metrics') or {}).get('enabled'):
+            instrument_store(aio_question_store, 'question')
+            instrument_store(aio_survey_store, 'survey')
+            instrument_servicer(service)
+
+        server = grpc.aio.server(migration_thread_pool=futures.ThreadPoolExecutor(
+            max_workers=self.server_cfg.get('migration_workers', 10)))
+        zoodroom_pb2_grpc.add_MangoServiceServicer_to_server(service, server)
+        health_pb2_grpc.add_HealthServicer_to_server(HealthService(app=app), server)
+        # the address `GRPCServerBase` serves the threaded mode on, switching modes must not move the port
+        address = '[::]:9000'
+        server.add_insecure_port(address)
+
+        await server.start()
+        app.log.info('{} serving on {} (asyncio mode)'.format(self.service_name, address))
+        try:
+            await server.wait_for_termination()
+        finally:
+            await server.stop(self.server_cfg.get('grace', 5))
+            service.legacy_executor.shutdown(wait=False)
+            await redis_client.close()
+            mongo_client.close()
@@ -0,0 +1,409 @@
+from olive.proto.zoodroom_pb2 import AddSurveyResponse, AddSurveyRequest, GetQuestionByIdRequest, \
+    GetQuestionByIdResponse, GetQuestionsRequest, GetQuestionsResponse, GetSurveyByReservationIdRequest, \
+    GetSurveyByReservationIdResponse, GetSurveysRequest, GetSurveysResponse, StreamGetSurveysResponse, \
+    StreamGetSurveysRequest, GetSurveysByReservationIdsRequest, GetSurveysByReservationIdsResponse
+from olive.exc import InvalidObjectId, DocumentNotFound, SaveError, FetchError, InvalidFilter
+from marshmallow import ValidationError
+from mango.core.survey import MangoService
+from olive.proto.rpc import Response
+from concurrent import futures
+import traceback
+import asyncio
+
+
+class AsyncMangoService(MangoService):
+    """
+    MangoService for the asyncio server mode.
+
+    The request path RPCs below are coroutines running on the event loop over the async stores, so thousands of
+    in-flight calls share one thread. Blocking legacy API calls run on a dedicated thread pool the size of the legacy
+    connection pool. The administrative RPCs (question management, AddSurveys, GetSurveyStats, GetSurveyAnalytics)
+    are inherited as is and executed by grpc.aio on its migration thread pool with the synchronous stores.
+    """
+
+    def __init__(self, question_store, survey_store, app, ranges, legacy_url, legacy_key, aio_question_store,
+                 aio_survey_store, legacy_workers=10, **kwargs):
+        super(AsyncMangoService, self).__init__(question_store, survey_store, app, ranges, legacy_url, legacy_key,
+                                                **kwargs)
+        self.aio_question_store = aio_question_store
+        self.aio_survey_store = aio_survey_store
+        self.legacy_executor = futures.ThreadPoolExecutor(max_workers=legacy_workers, thread_name_prefix='legacy')
+
+    async def _run_legacy(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.legacy_executor, fn, *args)
+
+    async def AddSurvey(self, request: AddSurveyRequest, context) -> AddSurveyResponse:
+        try:
+            self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
+            given_question_ids = list({question.question_id for question in request.questions})
+            self.app.log.debug('Validating and retrieving below questions: \n{}'.format(given_question_ids))
+            questions = await self.aio_question_store.get_rating_questions(question_ids=given_question_ids,
+                                                                           include_in="user_rate")
+            questions = {str(q['_id']): q for q in questions}
+            self.app.log.info('Validation completed, validated questions: {}'.format(','.join(questions.keys())))
+
+            survey_payload = self._build_survey_payload(request, questions)
+            if self.enrich_surveys:
+                await self._run_legacy(self._enrich_survey_payload, survey_payload)
+
+            survey_id = await self.aio_survey_store.save(survey_payload)
+            self.app.log.info('survey has been saved successfully: {}'.format(survey_id))
+
+            return Response.message(
+                survey_id=survey_id
+            )
+
+        except SaveError as se:
+            self.app.log.error('survey cannot be saved:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'save_error',
+                    'message': str(se),
+                    'details': []
+                }
+            )
+
+        except InvalidObjectId as ioi:
+            self.app.log.error('Invalid ObjectId (question_id) given:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'invalid_id',
+                    'message': str(ioi),
+                    'details': []
+                }
+            )
+
+        except DocumentNotFound as dnf:
+            self.app.log.error('question not found:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'resource_not_found',
+                    'message': str(dnf),
+                    'details': []
+                }
+            )
+
+        except ValueError as ve:
+            self.app.log.error('Schema value error:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'value_error',
+                    'message': str(ve),
+                    'details': []
+                }
+            )
+        except ValidationError as ve:
+            self.app.log.error('Schema validation error:\r\n{}'.format(ve.messages))
+            return Response.message(
+                error={
+                    'code': 'invalid_schema',
+                    'message': 'Given data is not valid!',
+                    'details': []
+                }
+            )
+        except Exception:
+            self.app.log.error('An error occurred: {}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'server_error',
+                    'message': 'Server is in maintenance mode',
+                    'details': []
+                }
+            )
+
+    async def GetQuestionById(self, request: GetQuestionByIdRequest, context) -> GetQuestionByIdResponse:
+        try:
+            self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
+            question = await self.aio_question_store.get_question_by_id(request.question_id)
+            return Response.message(
+                _id=str(question['_id']),
+                ranges=self.ranges,
+                title=question['title'],
+                order=question['order'],
+                include_in=question['include_in'],
+                weight=question['weight']
+            )
+        except DocumentNotFound as dnf:
+            self.app.log.error('question not found:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'resource_not_found',
+                    'message': str(dnf),
+                    'details': []
+                }
+            )
+        except ValueError as ve:
+            self.app.log.error('Schema value error:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'value_error',
+                    'message': str(ve),
+                    'details': []
+                }
+            )
+        except InvalidObjectId as ioi:
+            self.app.log.error('Invalid ObjectId (question_id) given:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'invalid_id',
+                    'message': str(ioi),
+                    'details': []
+                }
+            )
+        except ValidationError as ve:
+            self.app.log.error('Schema validation error:\r\n{}'.format(ve.messages))
+            return Response.message(
+                error={
+                    'code': 'invalid_schema',
+                    'message': 'Given data is not valid!',
+                    'details': []
+                }
+            )
+        except Exception:
+            self.app.log.error('An error occurred: {}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'server_error',
+                    'message': 'Server is in maintenance mode',
+                    'details': []
+                }
+            )
+
+    async def GetQuestions(self, request: GetQuestionsRequest, context) -> GetQuestionsResponse:
+        try:
+            self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
+            questions = await self.aio_question_store.get_questions()
+            return Response.message(questions=questions)
+        except ValueError as ve:
+            self.app.log.error('Schema value error:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'value_error',
+                    'message': str(ve),
+                    'details': []
+                }
+            )
+        except ValidationError as ve:
+            self.app.log.error('Schema validation error:\r\n{}'.format(ve.messages))
+            return Response.message(
+                error={
+                    'code': 'invalid_schema',
+                    'message': 'Given data is not valid!',
+                    'details': []
+                }
+            )
+        except Exception:
+            self.app.log.error('An error occurred: {}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'server_error',
+                    'message': 'Server is in maintenance mode',
+                    'details': []
+                }
+            )
+
+    async def GetSurveyByReservationId(self, request: GetSurveyByReservationIdRequest,
+                                       context) -> GetSurveyByReservationIdResponse:
+        try:
+            self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
+            survey = await self.aio_survey_store.get_by_reservation_id(request.reservation_id)
+            return Response.message(_id=survey['_id'],
+                                    questions=survey['questions'],
+                                    user_id=survey['user_id'],
+                                    staff_id=survey['staff_id'],
+                                    reservation_id=survey['reservation_id'],
+                                    status=survey['status'],
+                                    content=survey['content'],
+                                    platform=survey['platform'],
+                                    total_rating=survey['total_rating'])
+        except ValueError as ve:
+            self.app.log.error('Schema value error:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'value_error',
+                    'message': str(ve),
+                    'details': []
+                }
+            )
+        except DocumentNotFound as dnf:
+            self.app.log.error('survey not found:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'resource_not_found',
+                    'message': str(dnf),
+                    'details': []
+                }
+            )
+        except ValidationError as ve:
+            self.app.log.error('Schema validation error:\r\n{}'.format(ve.messages))
+            return Response.message(
+                error={
+                    'code': 'invalid_schema',
+                    'message': 'Given data is not valid!',
+                    'details': []
+                }
+            )
+        except Exception:
+            self.app.log.error('An error occurred: {}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'server_error',
+                    'message': 'Server is in maintenance mode',
+                    'details': []
+                }
+            )
+
+    async def GetSurveysByReservationIds(self, request: GetSurveysByReservationIdsRequest,
+                                         context) -> GetSurveysByReservationIdsResponse:
+        try:
+            self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
+            reservation_ids = self._batch_reservation_ids(request)
+            surveys, not_found = await self.aio_survey_store.get_by_reservation_ids(reservation_ids)
+            return Response.message(surveys=surveys, not_found_reservation_ids=not_found)
+        except ValueError as ve:
+            self.app.log.error('Schema value error:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'value_error',
+                    'message': str(ve),
+                    'details': []
+                }
+            )
+        except ValidationError as ve:
+            self.app.log.error('Schema validation error:\r\n{}'.format(ve.messages))
+            return Response.message(
+                error={
+                    'code': 'invalid_schema',
+                    'message': 'Given data is not valid!',
+                    'details': []
+                }
+            )
+        except Exception:
+            self.app.log.error('An error occurred: {}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'server_error',
+                    'message': 'Server is in maintenance mode',
+                    'details': []
+                }
+            )
+
+    async def StreamGetSurveys(self, request: StreamGetSurveysRequest, context) -> StreamGetSurveysResponse:
+        try:
+            self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
+            if not request.batch_size:
+                # one survey per message, kept for backward compatibility
+                async for survey in self.aio_survey_store.stream_surveys():
+                    yield Response.message(survey=survey)
+                return
+
+            query = {}
+            for field in ('platform', 'city', 'complex'):
+                if getattr(request, field):
+                    query[field] = getattr(request, field)
+            if request.status:
+                query['status'] = request.status.lower()
+
+            # a yield only resumes once grpc.aio accepted the message, a slow consumer holds back the database reads
+            async for surveys, last_id in self.aio_survey_store.stream_survey_batches(
+                    query=query, resume_after=request.resume_after, batch_size=request.batch_size):
+                yield Response.message(surveys=surveys, last_id=last_id)
+        except InvalidObjectId as ioi:
+            self.app.log.error('Invalid ObjectId (resume_after) given:\r\n{}'.format(traceback.format_exc()))
+            yield Response.message(
+                error={
+                    'code': 'invalid_id',
+                    'message': str(ioi),
+                    'details': []
+                }
+            )
+        except ValidationError as ve:
+            self.app.log.error('Schema validation error:\r\n{}'.format(ve.messages))
+            yield Response.message(
+                error={
+                    'code': 'invalid_schema',
+                    'message': 'Given data is not valid!',
+                    'details': []
+                }
+            )
+        except asyncio.CancelledError:
+            self.app.log.info('survey stream cancelled by the client')
+            raise
+        except Exception:
+            self.app.log.error('An error occurred: {}'.format(traceback.format_exc()))
+            yield Response.message(
+                error={
+                    'code': 'server_error',
+                    'message': 'Server is in maintenance mode',
+                    'details': []
+                }
+            )
+
+    async def GetSurveys(self, request: GetSurveysRequest, context) -> GetSurveysResponse:
+        try:
+            self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
+            query = {}
+            if not all(v in [None, 0, ''] for v in [request.checkout_start,
+                                                    request.checkout_end,
+                                                    request.city,
+                                                    request.complex]):
+                if self.local_reservation_filters:
+                    query = self._reservation_query(request)
+                else:
+                    query = await self._run_legacy(self._legacy_reservation_query, request)
+
+                status = request.status
+                if status:
+                    query['status'] = status.lower()
+
+            next_cursor = ''
+            if request.skip and not request.cursor:
+                # deprecated offset pagination, kept for backward compatibility
+                total_count, surveys = await self.aio_survey_store.get_surveys(skip=request.skip,
+                                                                               limit=request.page_size,
+                                                                               query=query)
+            else:
+                total_count, surveys, next_cursor = await self.aio_survey_store.get_surveys_page(
+                    limit=request.page_size, query=query, cursor=request.cursor)
+            self.app.log.info('total surveys count: {}'.format(total_count))
+            return Response.message(
+                surveys=surveys,
+                total_count=total_count,
+                next_cursor=next_cursor
+            )
+        except ValidationError as ve:
+            self.app.log.error('Schema validation error:\r\n{}'.format(ve.messages))
+            return Response.message(
+                error={
+                    'code': 'invalid_schema',
+                    'message': 'Given data is not valid!',
+                    'details': []
+                }
+            )
+        except InvalidFilter as inf:
+            self.app.log.error('Invalid filter given:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'invalid_filter',
+                    'message': str(inf),
+                    'details': []
+                }
+            )
+        except FetchError:
+            self.app.log.error('Legacy API error:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'legacy_fetch_error',
+                    'message': 'Could not get data from Legacy API!',
+                    'details': []
+                }
+            )
+        except Exception:
+            self.app.log.error('An error occurred: {}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'server_error',
+                    'message': 'Server is in maintenance mode',
+                    'details': []
+                }
+            )
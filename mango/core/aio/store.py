@@ -0,0 +1,428 @@
+from mango.core.aio.cache import AsyncCacheWrapper, AsyncCacheGeneration
+from olive.exc import SaveError, CacheNotFound, DocumentNotFound
+from mango.core.store.pagination import encode_cursor, decode_cursor, keyset_filter
+from mango.core.models.question import QuestionSchema
+from mango.core.models.survey import SurveySchema
+from mango.core.models.reader import compile_reader
+from mango.core.store.survey import SurveyStore
+from mango.core.store.bloom import BloomFilter
+from olive.store.toolbox import to_object_id
+from olive.toolbox import generate_sha256
+from pymongo.errors import DuplicateKeyError
+import traceback
+import asyncio
+import time
+import pymongo
+
+
+class AsyncQuestionStore:
+    """
+    Coroutine counterpart of the `QuestionStore` read paths over motor and `redis.asyncio`, sharing its cache keys.
+
+    The in-process tier and the question catalog of the threaded mode are not used here.
+    """
+
+    def __init__(self, db, app, redis):
+        self.app = app
+        self.db = db
+        self.question_schema = QuestionSchema(exclude_none_id=True)
+        self.question_reader = None
+        if self.app.config['mango'].get('trusted_reads'):
+            self.question_reader = compile_reader(self.question_schema)
+
+        self.cache_key = 'MANGO:QUESTION:{}'
+        self.cache_questions_key = 'ALL'
+        self.cache_wrapper = AsyncCacheWrapper(self.app, redis, self.cache_key)
+        self.questions_generation = AsyncCacheGeneration(
+            self.app, redis, self.cache_key.format('GENERATION:{}'.format(self.cache_questions_key)))
+
+    def _load(self, question_docs, many=False, partial=None):
+        if not self.question_reader:
+            return self.question_schema.load(question_docs, many=many, partial=partial)
+
+        if many:
+            return [self.question_reader(question_doc) for question_doc in question_docs]
+
+        return self.question_reader(question_docs)
+
+    async def get_question_by_id(self, question_id):
+        question_id = to_object_id(question_id)
+
+        try:
+            question_doc = await self.cache_wrapper.get_cache(question_id)
+        except CacheNotFound:
+            self.app.log.debug('reading directly from database')
+            question_doc = await self.db.find_one({'_id': question_id}, {'created_at': 0})
+            if not question_doc:
+                raise DocumentNotFound("Document {} not found!".format(question_id))
+
+            question_doc['_id'] = str(question_doc['_id'])
+            if not question_doc['is_deleted']:
+                await self.cache_wrapper.write_cache(question_id, question_doc)
+
+        return self._load(question_doc)
+
+    async def get_rating_questions(self, question_ids, include_in=None):
+        """Returns `_id` and `weight` of the given questions, deleted ones are left out like the catalog does."""
+        filter_args = {'_id': {'$in': [to_object_id(i) for i in question_ids]}, 'is_deleted': False}
+        if include_in:
+            filter_args['include_in'] = include_in
+
+        questions = await self.db.find(filter=filter_args, projection=['weight']).to_list(length=None)
+        return [{'_id': str(question['_id']), 'weight': question['weight']} for question in questions]
+
+    async def get_questions(self):
+        # the generation and the list in one round-trip
+        generation, cached = await self.cache_wrapper.get_many_in_generation(
+            self.questions_generation, [self.cache_questions_key + ':{}'])
+        questions_cache_key = '{}:{}'.format(self.cache_questions_key, generation)
+        try:
+            questions_docs = cached[questions_cache_key]
+        except KeyError:
+            self.app.log.debug('reading questions directly from database')
+            questions_cursor = self.db.find({'is_deleted': False}, {'created_at': 0, 'is_deleted': 0})
+            questions_docs = self._load(await questions_cursor.to_list(length=None), many=True)
+            if not questions_docs:
+                return questions_docs
+            await self.cache_wrapper.write_cache(questions_cache_key, questions_docs)
+
+        return questions_docs
+
+
+class AsyncSurveyStore:
+    """
+    Coroutine counterpart of the `SurveyStore` request paths over motor and `redis.asyncio`, sharing its cache keys,
+    listing generation and reservation bloom filter. `stats_store` is a `SurveyStatsStore` whose `db` is a motor
+    collection.
+    """
+    stream_batch_limit = SurveyStore.stream_batch_limit
+
+    def __init__(self, db, app, redis, stats_store=None):
+        self.app = app
+        self.db = db
+        self.redis = redis
+        self.stats_store = stats_store
+        self._next_outbox_check = 0
+        self.survey_schema = SurveySchema(exclude_none_id=True)
+        self.survey_reader = None
+        if self.app.config['mango'].get('trusted_reads'):
+            self.survey_reader = compile_reader(self.survey_schema)
+
+        self.cache_key = 'MANGO:SURVEY:{}'
+        self.get_surveys_cache_key = 'GET_SURVEYS:{}'
+        self.cache_wrapper = AsyncCacheWrapper(self.app, redis, self.cache_key)
+        self.surveys_generation = AsyncCacheGeneration(self.app, redis,
+                                                       self.cache_key.format('GENERATION:GET_SURVEYS'))
+
+        # the bitmap is read and written through `redis`, see `SurveyStore`
+        reservation_filter_cfg = self.app.config['mango'].get('reservation_filter') or {}
+        self.reservation_filter = None
+        self.negative_ttl = 0
+        if reservation_filter_cfg.get('enabled'):
+            self.reservation_filter = BloomFilter(self.app, self.cache_key.format('RESERVATION_FILTER'),
+                                                  capacity=reservation_filter_cfg.get('capacity', 5000000),
+                                                  error_rate=reservation_filter_cfg.get('error_rate', 0.001))
+            self.negative_ttl = reservation_filter_cfg.get('negative_ttl', 60)
+
+    def _load(self, survey_docs, many=False):
+        if not self.survey_reader:
+            return self.survey_schema.load(survey_docs, many=many)
+
+        if many:
+            return [self.survey_reader(survey_doc) for survey_doc in survey_docs]
+
+        return self.survey_reader(survey_docs)
+
+    async def save(self, data):
+        # raise validation error on invalid data
+        self.survey_schema.load(data)
+        clean_data = self.survey_schema.dump(data)
+        if not clean_data:
+            self.app.log.error('empty survey payload cannot be saved.')
+            raise SaveError
+
+        self.app.log.debug('saving clean survey:\n{}'.format(clean_data))
+        try:
+            result = await self.db.insert_one(clean_data)
+        except DuplicateKeyError:
+            raise SaveError('survey of reservation {} already exists'.format(clean_data.get('reservation_id')))
+
+        # invalidate all survey caches with filters
+        await self.surveys_generation.bump()
+        await self._index_reservations([clean_data])
+        await self._record_stats([clean_data])
+
+        return str(result.inserted_id)
+
+    async def get_by_reservation_id(self, reservation_id):
+        if self.reservation_filter and not (await self._might_contain_many([reservation_id]))[0]:
+            raise DocumentNotFound("Document with reservation_id {} not found!".format(reservation_id))
+
+        survey_key = 'BY_RESERVATION:{}'.format(reservation_id)
+        no_survey_key = 'NO_SURVEY:{}'.format(reservation_id)
+        cached = await self.cache_wrapper.get_many([survey_key, no_survey_key] if self.negative_ttl else [survey_key])
+        if survey_key in cached:
+            survey_doc = cached[survey_key]
+        elif no_survey_key in cached:
+            raise DocumentNotFound("Document with reservation_id {} not found!".format(reservation_id))
+        else:
+            self.app.log.debug('reading directly from database')
+            survey_doc = await self.db.find_one({'reservation_id': reservation_id}, {'created_at': 0, 'updated_at': 0})
+            if not survey_doc:
+                if self.negative_ttl:
+                    await self.cache_wrapper.write_cache(no_survey_key, True, expire_time=self.negative_ttl)
+                raise DocumentNotFound("Document with reservation_id {} not found!".format(reservation_id))
+
+            survey_doc['_id'] = str(survey_doc['_id'])
+            await self.cache_wrapper.write_cache(survey_key, survey_doc)
+
+        return self._load(survey_doc)
+
+    async def get_by_reservation_ids(self, reservation_ids):
+        """Coroutine counterpart of `SurveyStore.get_by_reservation_ids`."""
+        reservation_ids = list(dict.fromkeys(reservation_ids))
+        candidates = reservation_ids
+        if self.reservation_filter and candidates:
+            candidates = [reservation_id for reservation_id, might_exist
+                          in zip(candidates, await self._might_contain_many(candidates)) if might_exist]
+
+        keys = ['BY_RESERVATION:{}'.format(reservation_id) for reservation_id in candidates]
+        if self.negative_ttl:
+            keys += ['NO_SURVEY:{}'.format(reservation_id) for reservation_id in candidates]
+        cached = await self.cache_wrapper.get_many(keys)
+
+        survey_docs = {}
+        misses = []
+        for reservation_id in candidates:
+            if 'BY_RESERVATION:{}'.format(reservation_id) in cached:
+                survey_docs[reservation_id] = cached['BY_RESERVATION:{}'.format(reservation_id)]
+            elif 'NO_SURVEY:{}'.format(reservation_id) not in cached:
+                misses.append(reservation_id)
+
+        if misses:
+            self.app.log.debug('reading {} surveys directly from database'.format(len(misses)))
+            found = {}
+            async for survey_doc in self.db.find({'reservation_id': {'$in': misses}},
+                                                 {'created_at': 0, 'updated_at': 0}):
+                survey_doc['_id'] = str(survey_doc['_id'])
+                found[survey_doc['reservation_id']] = survey_doc
+
+            if found:
+                await self.cache_wrapper.write_many({'BY_RESERVATION:{}'.format(reservation_id): survey_doc
+                                                     for reservation_id, survey_doc in found.items()})
+            if self.negative_ttl and len(found) < len(misses):
+                await self.cache_wrapper.write_many({'NO_SURVEY:{}'.format(reservation_id): True
+                                                     for reservation_id in misses if reservation_id not in found},
+                                                    expire_time=self.negative_ttl)
+            survey_docs.update(found)
+
+        surveys = self._load([survey_docs[reservation_id]
+                              for reservation_id in reservation_ids if reservation_id in survey_docs], many=True)
+        not_found = [reservation_id for reservation_id in reservation_ids if reservation_id not in survey_docs]
+        return surveys, not_found
+
+    async def stream_surveys(self):
+        surveys = self.db.find({}, projection={'created_at': 0, 'updated_at': 0}, batch_size=self.stream_batch_limit)
+        async for survey in surveys:
+            yield self._load(survey)
+
+    async def stream_survey_batches(self, query=None, resume_after=None, batch_size=100):
+        """Async generator counterpart of `SurveyStore.stream_survey_batches`."""
+        query = dict(query or {})
+        batch_size = max(1, min(batch_size or 100, self.stream_batch_limit))
+        if resume_after:
+            query['_id'] = {'$gt': to_object_id(resume_after)}
+
+        cursor = self.db.find(filter=query,
+                              projection={'created_at': 0, 'updated_at': 0},
+                              sort=[('_id', pymongo.ASCENDING)],
+                              batch_size=batch_size)
+        try:
+            batch = []
+            async for survey in cursor:
+                batch.append(survey)
+                if len(batch) == batch_size:
+                    yield self._load(batch, many=True), str(batch[-1]['_id'])
+                    batch = []
+
+            if batch:
+                yield self._load(batch, many=True), str(batch[-1]['_id'])
+        finally:
+            # release the server side cursor when the consumer goes away mid-stream
+            await cursor.close()
+
+    async def get_surveys(self, skip, limit, query=None, sort_key='+total_rating', ignore_cache=False):
+        query = query or {}
+        skip, limit = skip or 0, min(limit or 50, 200)
+
+        plain_cache_key = 'skip:{}limit:{}{}'.format(skip, limit, sort_key)
+        if query:
+            plain_cache_key += str(query)
+
+        cache_key = generate_sha256(plain_cache_key)
+
+        try:
+            if ignore_cache:
+                self.app.log.debug('ignoring cache requested')
+                raise CacheNotFound
+
+            cache_key, cached_page = await self._get_cached_page(cache_key)
+            if cached_page is None:
+                raise CacheNotFound('{} not found in cache'.format(self.get_surveys_cache_key.format(cache_key)))
+            survey_docs, page_info = cached_page
+            total_count = page_info['total_count']
+        except CacheNotFound:
+            self.app.log.debug('reading surveys directly from database by below filters...')
+            self.app.log.info('skip={} limit={} sort_key={}'.format(skip, limit, sort_key))
+
+            raw_docs, total_count = await asyncio.gather(
+                self.db.find(filter=query,
+                             projection={'created_at': 0, 'updated_at': 0},
+                             skip=skip,
+                             limit=limit,
+                             sort=SurveyStore._sort_spec(sort_key)).to_list(length=None),
+                self.db.count_documents(query))
+
+            survey_docs = self._load(raw_docs, many=True)
+            if not survey_docs:
+                return total_count, survey_docs
+
+            if not ignore_cache:
+                await self._write_cached_page(cache_key, survey_docs, {'total_count': total_count})
+
+        return total_count, survey_docs
+
+    async def get_surveys_page(self, limit, query=None, sort_key='+total_rating', cursor=None, ignore_cache=False):
+        """Coroutine counterpart of `SurveyStore.get_surveys_page`: returns `(total_count, surveys, next_cursor)`."""
+        query = query or {}
+        limit = min(limit or 50, 200)
+        sort = SurveyStore._sort_spec(sort_key)
+
+        plain_cache_key = 'cursor:{}limit:{}{}'.format(cursor or '', limit, sort_key)
+        if query:
+            plain_cache_key += str(query)
+
+        cache_key = generate_sha256(plain_cache_key)
+
+        try:
+            if ignore_cache:
+                self.app.log.debug('ignoring cache requested')
+                raise CacheNotFound
+
+            cache_key, cached_page = await self._get_cached_page(cache_key)
+            if cached_page is None:
+                raise CacheNotFound('{} not found in cache'.format(self.get_surveys_cache_key.format(cache_key)))
+            survey_docs, page_info = cached_page
+            total_count, next_cursor = page_info['total_count'], page_info['next_cursor']
+        except CacheNotFound:
+            self.app.log.debug('reading surveys directly from database by below filters...')
+            self.app.log.info('cursor={} limit={} sort_key={}'.format(cursor, limit, sort_key))
+
+            page_query = query
+            if cursor:
+                page_query = {'$and': [query, keyset_filter(sort_key, *decode_cursor(cursor, sort_key))]}
+
+            # the sort field is needed to build the next cursor even when it is not part of the response
+            projection = {field: 0 for field in ('created_at', 'updated_at') if field != sort_key[1:]}
+            raw_docs, total_count = await asyncio.gather(
+                self.db.find(filter=page_query,
+                             projection=projection,
+                             limit=limit,
+                             sort=sort if sort_key[1:] == '_id' else sort + [('_id', sort[0][1])]).to_list(length=None),
+                self._total_count(query, ignore_cache))
+
+            next_cursor = encode_cursor(sort_key, raw_docs[-1]) if len(raw_docs) == limit else ''
+
+            survey_docs = self._load(raw_docs, many=True)
+            if not survey_docs:
+                return total_count, survey_docs, next_cursor
+
+            if not ignore_cache:
+                await self._write_cached_page(cache_key, survey_docs, {'total_count': total_count,
+                                                                       'next_cursor': next_cursor})
+
+        return total_count, survey_docs, next_cursor
+
+    async def _total_count(self, query, ignore_cache=False):
+        """Coroutine counterpart of `SurveyStore._total_count`."""
+        count_key = self.get_surveys_cache_key.format('TOTAL:{}:{}'.format(await self.surveys_generation.current(),
+                                                                           generate_sha256(str(query))))
+        if not ignore_cache:
+            try:
+                return await self.cache_wrapper.get_cache(count_key)
+            except CacheNotFound:
+                pass
+
+        total_count = await self.db.count_documents(query)
+        await self.cache_wrapper.write_cache(count_key, total_count)
+        return total_count
+
+    async def _get_cached_page(self, cache_key):
+        """
+        Returns `(generation:cache_key, (survey_docs, page_info))` of a cached listing page, or `(generation:cache_key,
+        None)`. The survey generation, the page and its `:COUNT` entry are read in one round-trip.
+        """
+        generation, cached = await self.cache_wrapper.get_many_in_generation(
+            self.surveys_generation, [self.get_surveys_cache_key.format('{}:' + cache_key),
+                                      self.get_surveys_cache_key.format('{}:' + cache_key + ':COUNT')])
+        cache_key = '{}:{}'.format(generation, cache_key)
+        page_key = self.get_surveys_cache_key.format(cache_key)
+        info_key = self.get_surveys_cache_key.format('{}:COUNT'.format(cache_key))
+        if page_key not in cached or info_key not in cached:
+            return cache_key, None
+
+        return cache_key, (cached[page_key], cached[info_key])
+
+    async def _write_cached_page(self, cache_key, survey_docs, page_info):
+        info_key = self.get_surveys_cache_key.format('{}:COUNT'.format(cache_key))
+        await self.cache_wrapper.write_many({self.get_surveys_cache_key.format(cache_key): survey_docs,
+                                             info_key: page_info})
+
+    async def _might_contain_many(self, reservation_ids):
+        pipeline = self.redis.pipeline(transaction=False)
+        self.reservation_filter.queue_lookup(reservation_ids, pipeline)
+        return self.reservation_filter.lookup_results(reservation_ids, await pipeline.execute())
+
+    async def _index_reservations(self, surveys):
+        """Coroutine counterpart of `SurveyStore._index_reservations`."""
+        reservation_ids = [survey['reservation_id'] for survey in surveys if survey.get('reservation_id')]
+        if not reservation_ids or not self.reservation_filter:
+            return
+
+        pipeline = self.redis.pipeline(transaction=False)
+        self.reservation_filter.add_many(reservation_ids, pipeline)
+        pipeline.delete(*[self.cache_key.format('NO_SURVEY:{}'.format(reservation_id))
+                          for reservation_id in reservation_ids])
+        await pipeline.execute()
+
+    async def _record_stats(self, surveys):
+        if not self.stats_store:
+            return
+
+        try:
+            await self._write_stats(self.stats_store.updates(surveys))
+            if time.monotonic() >= self._next_outbox_check:
+                self._next_outbox_check = time.monotonic() + self.stats_store.outbox_interval
+                while True:
+                    pipeline = self.redis.pipeline(transaction=True)
+                    self.stats_store.queue_outbox_pop(pipeline)
+                    updates = self.stats_store.outbox_updates(await pipeline.execute())
+                    if not updates:
+                        break
+                    await self._write_stats(updates)
+        except Exception:
+            # the updates not written are in the stats outbox, never fail a saved survey because of them
+            self.app.log.error('could not record survey stats: {}'.format(traceback.format_exc()))
+
+    async def _write_stats(self, updates):
+        """Coroutine counterpart of `SurveyStatsStore._write`."""
+        if not updates:
+            return
+
+        try:
+            await self.stats_store.db.bulk_write(self.stats_store.upserts(updates), ordered=False)
+        except Exception as e:
+            failed = self.stats_store.failed_updates(updates, e)
+            await self.redis.rpush(self.stats_store.outbox_key, *self.stats_store.outbox_entries(failed))
+            self.app.log.error('{} survey stats updates moved to the outbox: {}'.format(len(failed), e))
+            raise
@@ -0,0 +1,226 @@
+from concurrent import futures
+from bson import ObjectId
+import datetime
+import pymongo
+import ujson
+import glob
+import csv
+import os
+
+# exported fields, in file column order
+COLUMNS = ('_id', 'reservation_id', 'user_id', 'staff_id', 'status', 'platform', 'total_rating', 'content', 'city',
+           'complex', 'checkout_date', 'created_at', 'updated_at', 'questions')
+
+
+def _pyarrow():
+    # optional dependency, only needed by the parquet format
+    import pyarrow
+    import pyarrow.parquet
+    return pyarrow, pyarrow.parquet
+
+
+def _row(survey_doc):
+    row = {column: survey_doc.get(column) for column in COLUMNS}
+    row['_id'] = str(survey_doc['_id'])
+    row['questions'] = [{'question_id': question.get('question_id'), 'rating': question.get('rating')}
+                        for question in survey_doc.get('questions') or []]
+    return row
+
+
+def _text_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+class JsonLinesWriter:
+    extension = 'jsonl'
+
+    def __init__(self, path):
+        self.file = open(path, 'w')
+
+    def write(self, rows):
+        self.file.writelines(ujson.dumps({column: _text_value(value) for column, value in row.items()}) + '\n'
+                             for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+class CsvWriter:
+    """Questions are written as a JSON list, missing values as empty cells."""
+    extension = 'csv'
+
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows([ujson.dumps(row[column]) if column == 'questions' else
+                               '' if row[column] is None else _text_value(row[column])
+                               for column in COLUMNS] for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """Every written batch becomes one row group, questions a list of `{question_id, rating}` structs."""
+    extension = 'parquet'
+
+    def __init__(self, path):
+        pa, pq = _pyarrow()
+        self.pa = pa
+        string_columns = ('_id', 'reservation_id', 'user_id', 'staff_id', 'status', 'platform', 'content', 'city',
+                          'complex', 'checkout_date')
+        self.schema = pa.schema(
+            [(column, pa.string()) for column in string_columns] +
+            [('total_rating', pa.int64()),
+             ('created_at', pa.timestamp('ms')),
+             ('updated_at', pa.timestamp('ms')),
+             ('questions', pa.list_(pa.struct([('question_id', pa.string()), ('rating', pa.int64())])))])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        self.writer.write_table(self.pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class SurveyExport:
+    """
+    Dumps the survey collection to `output_dir`, bypassing marshmallow and protobuf.
+
+    The surveys to export are split into `partitions` `_id` ranges of about the same size, picked from a `$sample`
+    of their ids. `workers` threads read the ranges concurrently with projected cursors in `_id` order, and write
+    one file per range, `batch_size` surveys at a time, so memory stays bounded whatever the collection size.
+
+    Every run exports the surveys inserted up to the newest `_id` found when it starts, and records it as `last_id`
+    in a manifest next to the files. `run(after_id=...)` exports only the surveys inserted after such a watermark,
+    `run(since=...)` those inserted since a UTC datetime (surveys updated since are not exported again). Files are
+    named after the exported `_id` range, exporting the same range again replaces them.
+    """
+    writers = {writer.extension: writer for writer in (ParquetWriter, CsvWriter, JsonLinesWriter)}
+
+    def __init__(self, app, db, output_dir, export_format='parquet', partitions=8, workers=4, batch_size=5000):
+        if export_format not in self.writers:
+            raise ValueError('invalid export format given: {}, it should be one of {}'
+                             .format(export_format, ', '.join(self.writers)))
+        if export_format == 'parquet':
+            # fail before reading anything when pyarrow is missing
+            _pyarrow()
+
+        self.app = app
+        self.db = db
+        self.output_dir = output_dir
+        self.writer = self.writers[export_format]
+        self.export_format = export_format
+        self.partitions = max(1, partitions)
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+
+    @staticmethod
+    def latest_watermark(output_dir):
+        """The `last_id` of the newest export manifest in `output_dir`, None when there is none."""
+        last_ids = []
+        for manifest_path in glob.glob(os.path.join(output_dir, 'surveys-*.json')):
+            with open(manifest_path) as manifest_file:
+                last_ids.append(ujson.load(manifest_file).get('last_id'))
+
+        last_ids = [last_id for last_id in last_ids if last_id]
+        return max(last_ids, key=ObjectId) if last_ids else None
+
+    def run(self, after_id=None, since=None):
+        """Exports the surveys, returns the manifest of the export."""
+        id_filter = {}
+        if after_id:
+            id_filter['$gt'] = ObjectId(after_id)
+        if since:
+            id_filter['$gte'] = ObjectId.from_datetime(since)
+
+        # an empty `{'_id': {}}` would only match an `_id` equal to an empty document
+        newest = self.db.find_one({'_id': id_filter} if id_filter else {}, {'_id': 1},
+                                  sort=[('_id', pymongo.DESCENDING)])
+        if not newest:
+            self.app.log.info('no survey to export')
+            return {'format': self.export_format, 'last_id': str(after_id) if after_id else None, 'count': 0,
+                    'files': []}
+
+        id_filter['$lte'] = newest['_id']
+        query = {'_id': id_filter}
+        last_id = str(newest['_id'])
+        lower_bounds = [bound for operator, bound in query['_id'].items() if operator in ('$gt', '$gte')]
+        prefix = 'surveys-{}-{}'.format(max(lower_bounds) if lower_bounds else '0' * 24, last_id)
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        id_ranges = self._id_ranges(query)
+        self.app.log.info('exporting surveys up to {} in {} partitions'.format(last_id, len(id_ranges)))
+        with futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='export') as executor:
+            partitions = list(executor.map(lambda partition: self._export_range(prefix, *partition),
+                                           enumerate(id_ranges)))
+
+        manifest = {
+            'format': self.export_format,
+            'after_id': str(after_id) if after_id else None,
+            'since': since.isoformat() if since else None,
+            'last_id': last_id,
+            'count': sum(partition['count'] for partition in partitions),
+            'files': partitions,
+            'exported_at': datetime.datetime.utcnow().isoformat(),
+        }
+        manifest_path = os.path.join(self.output_dir, '{}.json'.format(prefix))
+        with open('{}.tmp'.format(manifest_path), 'w') as manifest_file:
+            ujson.dump(manifest, manifest_file, indent=2)
+        os.replace('{}.tmp'.format(manifest_path), manifest_path)
+
+        self.app.log.info('{} surveys exported to {}'.format(manifest['count'], self.output_dir))
+        return manifest
+
+    def _id_ranges(self, query):
+        """Splits `query` into `_id` range queries holding about the same number of surveys."""
+        sample = self.db.aggregate([{'$match': query},
+                                    {'$sample': {'size': self.partitions * 32}},
+                                    {'$project': {'_id': 1}}])
+        sampled_ids = sorted(survey_doc['_id'] for survey_doc in sample)
+        step = len(sampled_ids) / self.partitions
+        boundaries = sorted({sampled_ids[int(i * step)] for i in range(1, self.partitions) if int(i * step)})
+
+        id_ranges = []
+        for lower, upper in zip([None] + boundaries, boundaries + [None]):
+            id_filter = dict(query['_id'])
+            if lower is not None:
+                id_filter.pop('$gt', None)
+                id_filter['$gte'] = lower
+            if upper is not None:
+                id_filter['$lt'] = upper
+            id_ranges.append(dict(query, _id=id_filter))
+
+        return id_ranges
+
+    def _export_range(self, prefix, partition, query):
+        path = os.path.join(self.output_dir, '{}-{:03d}.{}'.format(prefix, partition, self.writer.extension))
+        writer = self.writer('{}.tmp'.format(path))
+        count = 0
+        cursor = self.db.find(query, projection={column: 1 for column in COLUMNS}, sort=[('_id', pymongo.ASCENDING)],
+                              batch_size=self.batch_size)
+        try:
+            rows = []
+            for survey_doc in cursor:
+                rows.append(_row(survey_doc))
+                if len(rows) == self.batch_size:
+                    writer.write(rows)
+                    count += len(rows)
+                    rows = []
+
+            if rows:
+                writer.write(rows)
+                count += len(rows)
+        finally:
+            cursor.close()
+            writer.close()
+
+        os.replace('{}.tmp'.format(path), path)
+        self.app.log.info('{} surveys exported to {}'.format(count, path))
+        return {'file': os.path.basename(path), 'count': count}
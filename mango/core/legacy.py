@@ -0,0 +1,93 @@
+from requests.adapters import HTTPAdapter
+from mango.core.metrics import LEGACY_LATENCY, LEGACY_FAILURES
+from mango.core.store.cache import LocalCache
+from mango.core.toolbox import SingleFlight
+from olive.exc import CacheNotFound, FetchError
+import requests
+
+
+class ReservationResolver:
+    """
+    Resolves GetSurveys reservation filters (checkout window, city, complex) to reservation ids via the legacy API.
+
+    Results are kept in-process for `ttl` seconds per normalized filter, identical lookups in flight are coalesced into
+    a single HTTP call and every call reuses keep-alive connections from a pooled session.
+    """
+
+    # survey attributes copied from a legacy reservation, mapped from the legacy field names
+    reservation_attributes = {
+        'city': 'city',
+        'complex': 'complex',
+        'checkout_date': 'checkout',
+    }
+
+    def __init__(self, app, base_url, key, ttl=60, max_size=1024, pool_size=10, timeout=5):
+        self.app = app
+        self.url = '{}v3/internal-reservations'.format(base_url if base_url[-1:] == '/' else '{}/'.format(base_url))
+        self.key = key
+        self.timeout = timeout
+        self.cache = LocalCache(max_size=max_size, ttl=ttl)
+        self.single_flight = SingleFlight()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_config(cls, app):
+        legacy_cfg = app.config['mango']['legacy']
+        return cls(app=app,
+                   base_url=legacy_cfg['base_url'],
+                   key=legacy_cfg['key'],
+                   ttl=legacy_cfg.get('reservations_ttl', 60),
+                   pool_size=legacy_cfg.get('pool_size', 10),
+                   timeout=legacy_cfg.get('timeout', 5))
+
+    @staticmethod
+    def normalize(**filters):
+        """Hashable, order independent form of the given filters, empty values are dropped."""
+        return tuple(sorted((name, str(value).strip())
+                            for name, value in filters.items() if value not in (None, 0, '')))
+
+    def resolve(self, checkout_start=None, checkout_end=None, city=None, complex=None):
+        filters = self.normalize(checkout_start=checkout_start, checkout_end=checkout_end, city=city, complex=complex)
+        try:
+            return self.cache.get(filters)
+        except CacheNotFound:
+            return self.single_flight.do(filters, self._fetch, filters)
+
+    def get_reservation_attributes(self, reservation_id):
+        """Returns the survey attributes (city, complex, checkout_date) of a single reservation."""
+        url = '{}/{}'.format(self.url, reservation_id)
+        try:
+            with LEGACY_LATENCY.time('get_reservation'):
+                response = self.session.get(url, headers={'X-INTERNAL-API-KEY': self.key}, timeout=self.timeout)
+            response.raise_for_status()
+            reservation = response.json() or {}
+        except (requests.RequestException, ValueError) as e:
+            LEGACY_FAILURES.inc('get_reservation')
+            raise FetchError('could not get reservation {}: {}'.format(reservation_id, e))
+
+        return {attribute: str(reservation[legacy_field])
+                for attribute, legacy_field in self.reservation_attributes.items()
+                if reservation.get(legacy_field) not in (None, '')}
+
+    def _fetch(self, filters):
+        self.app.log.debug('resolving reservations from legacy API by {}'.format(filters))
+        try:
+            with LEGACY_LATENCY.time('resolve_reservations'):
+                response = self.session.get(self.url,
+                                            params=list(filters),
+                                            headers={'X-INTERNAL-API-KEY': self.key},
+                                            timeout=self.timeout)
+            response.raise_for_status()
+            reservations = response.json()
+        except (requests.RequestException, ValueError) as e:
+            LEGACY_FAILURES.inc('resolve_reservations')
+            raise FetchError('could not resolve reservations by {}: {}'.format(filters, e))
+
+        # a stable order keeps the survey listing cache key stable for identical filters
+        reservations = sorted(set(reservations or []))
+        self.cache.set(filters, reservations)
+        self.app.log.info('{} reservations resolved by {}'.format(len(reservations), filters))
+        return reservations
@@ -0,0 +1,159 @@
+from olive.proto import zoodroom_pb2_grpc, zoodroom_pb2
+from mango.core.toolbox import summarize_latencies
+from concurrent import futures
+import threading
+import random
+import time
+import uuid
+import grpc
+
+
+def parse_mix(mix):
+    """Parses `GetSurveys=60,AddSurvey=10` into `{'GetSurveys': 60.0, 'AddSurvey': 10.0}`."""
+    ratios = {}
+    for part in mix.split(','):
+        name, _, ratio = part.strip().partition('=')
+        if name not in LoadTest.rpcs:
+            raise ValueError('unknown RPC {} in mix, it should be one of {}'.format(name, ', '.join(LoadTest.rpcs)))
+        try:
+            ratios[name] = float(ratio or 1)
+        except ValueError:
+            raise ValueError('invalid ratio given for {}: {}'.format(name, ratio))
+
+    if not sum(ratios.values()) > 0:
+        raise ValueError('mix ratios should add up to more than zero: {}'.format(mix))
+
+    return ratios
+
+
+class LoadTest:
+    """
+    Open-model load generator: calls are started at a fixed arrival rate whatever the latency of the server, RPCs
+    are picked at random by the mix ratios and executed by up to `concurrency` threads sharing one channel.
+
+    A call's latency is measured from the time it was scheduled, not from when a thread picked it up, so a saturated
+    client or server shows up in the percentiles instead of silently lowering the rate (coordinated omission).
+    """
+    rpcs = ('AddSurvey', 'GetSurveys', 'GetQuestions', 'GetSurveyByReservationId', 'StreamGetSurveys')
+
+    def __init__(self, app, target, mix, rate, concurrency, duration, timeout=5, seed=None):
+        self.app = app
+        self.target = target
+        self.mix = mix
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duration = duration
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.question_ids = []
+        self.reservation_ids = []
+        self._lock = threading.Lock()
+        self._latencies = {name: [] for name in mix}
+        self._codes = {name: {} for name in mix}
+
+    def discover(self, stub):
+        """Collects question and reservation ids from the target so the generated requests hit existing data."""
+        questions = stub.GetQuestions(zoodroom_pb2.GetQuestionsRequest(), timeout=self.timeout).questions
+        self.question_ids = [question.question_id for question in questions if 'user_rate' in question.include_in]
+        surveys = stub.GetSurveys(zoodroom_pb2.GetSurveysRequest(page_size=200), timeout=self.timeout).surveys
+        self.reservation_ids = [survey.reservation_id for survey in surveys if survey.reservation_id]
+        self.app.log.info('{} rating questions and {} reservations discovered'
+                          .format(len(self.question_ids), len(self.reservation_ids)))
+
+    def build_request(self, name):
+        """
+        The request of one `name` RPC. Its contents are drawn from the seeded `rng`, on the scheduling thread so that
+        a seed replays the same requests in the same order. Reservation ids of new surveys stay unique across runs.
+        """
+        if name == 'AddSurvey':
+            rated = self.rng.sample(self.question_ids, min(5, len(self.question_ids)))
+            return zoodroom_pb2.AddSurveyRequest(
+                user_id=str(self.rng.randint(1, 100000)),
+                reservation_id='loadtest-{}'.format(uuid.uuid4().hex),
+                status='published',
+                content='load test survey',
+                platform=self.rng.choice(('android', 'ios', 'web')),
+                questions=[zoodroom_pb2.SurveyQuestion(question_id=q, rating=self.rng.randint(1, 5)) for q in rated])
+        if name == 'GetSurveys':
+            return zoodroom_pb2.GetSurveysRequest(page_size=self.rng.choice((10, 20, 50)))
+        if name == 'GetQuestions':
+            return zoodroom_pb2.GetQuestionsRequest()
+        if name == 'GetSurveyByReservationId':
+            return zoodroom_pb2.GetSurveyByReservationIdRequest(
+                reservation_id=self.rng.choice(self.reservation_ids) if self.reservation_ids else 'loadtest-missing')
+        if name == 'StreamGetSurveys':
+            return zoodroom_pb2.StreamGetSurveysRequest(batch_size=100)
+
+        raise ValueError('unknown RPC {}'.format(name))
+
+    def call(self, stub, name, request):
+        """Executes one `name` RPC with `request` and returns its error code, '' on success."""
+        if name == 'StreamGetSurveys':
+            code = ''
+            # a single batch, whole collection streams would not keep a fixed rate
+            for response in stub.StreamGetSurveys(request, timeout=self.timeout):
+                code = response.error.code
+                break
+            return code
+
+        return getattr(stub, name)(request, timeout=self.timeout).error.code
+
+    def _execute(self, stub, name, request, scheduled_at):
+        try:
+            code = self.call(stub, name, request)
+        except grpc.RpcError as e:
+            code = 'grpc_{}'.format(e.code().name.lower())
+        except Exception as e:
+            code = 'client_{}'.format(type(e).__name__)
+        latency = time.perf_counter() - scheduled_at
+
+        with self._lock:
+            self._latencies[name].append(latency)
+            codes = self._codes[name]
+            codes[code or 'ok'] = codes.get(code or 'ok', 0) + 1
+
+    def run(self):
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        with grpc.insecure_channel(self.target) as channel:
+            stub = zoodroom_pb2_grpc.MangoServiceStub(channel)
+            self.discover(stub)
+
+            self.app.log.info('sending {} calls/s to {} for {}s with {} threads'
+                              .format(self.rate, self.target, self.duration, self.concurrency))
+            interval = 1.0 / self.rate
+            started_at = time.perf_counter()
+            with futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                scheduled = 0
+                while True:
+                    scheduled_at = started_at + scheduled * interval
+                    if scheduled_at - started_at >= self.duration:
+                        break
+
+                    delay = scheduled_at - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                    name = self.rng.choices(names, weights)[0]
+                    executor.submit(self._execute, stub, name, self.build_request(name), scheduled_at)
+                    scheduled += 1
+            elapsed = time.perf_counter() - started_at
+
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        results = {}
+        for name in self.mix:
+            result = summarize_latencies(self._latencies[name])
+            result['throughput_rps'] = len(self._latencies[name]) / elapsed if elapsed else None
+            result['codes'] = dict(self._codes[name])
+            results[name] = result
+
+        return {
+            'target': self.target,
+            'rate': self.rate,
+            'concurrency': self.concurrency,
+            'duration': self.duration,
+            'elapsed': elapsed,
+            'results': results,
+        }
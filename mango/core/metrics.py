@@ -0,0 +1,441 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from olive.exc import CacheNotFound
+from pymongo import monitoring
+import contextlib
+import functools
+import threading
+import asyncio
+import inspect
+import bisect
+import time
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Shards:
+    """
+    Per-thread value maps. A thread only ever writes to its own shard so updates need no lock, collecting sums the
+    shards of every thread seen so far.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            # taken once per thread, when it records its first value
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def all(self):
+        with self._lock:
+            shards = list(self._shards)
+        # copying a dict is atomic, the owning thread may keep writing to it meanwhile
+        return [dict(shard) for shard in shards]
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labelnames, label_values, extra=()):
+    pairs = list(zip(labelnames, label_values)) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs))
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._shards = _Shards()
+
+    def inc(self, *label_values, amount=1):
+        shard = self._shards.get()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+    def collect(self):
+        totals = {}
+        for shard in self._shards.all():
+            for label_values, value in shard.items():
+                totals[label_values] = totals.get(label_values, 0) + value
+        return totals
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} counter'.format(self.name)]
+        for label_values, value in sorted(self.collect().items()):
+            lines.append('{}{} {}'.format(self.name, _format_labels(self.labelnames, label_values), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._shards = _Shards()
+
+    def observe(self, value, *label_values):
+        shard = self._shards.get()
+        # one count per bucket (the last one is +Inf), then the sum of the observed values
+        series = shard.get(label_values)
+        if series is None:
+            series = shard[label_values] = [0] * (len(self.buckets) + 2)
+
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def collect(self):
+        totals = {}
+        for shard in self._shards.all():
+            for label_values, series in shard.items():
+                total = totals.setdefault(label_values, [0] * (len(self.buckets) + 2))
+                for i, value in enumerate(series):
+                    total[i] += value
+        return totals
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        for label_values, series in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                labels = _format_labels(self.labelnames, label_values, [('le', bound)])
+                lines.append('{}_bucket{} {}'.format(self.name, labels, cumulative))
+
+            labels = _format_labels(self.labelnames, label_values)
+            lines.append('{}_sum{} {}'.format(self.name, labels, series[-1]))
+            lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        counter = Counter(name, documentation, labelnames)
+        self.metrics.append(counter)
+        return counter
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        histogram = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+RPC_LATENCY = REGISTRY.histogram('mango_rpc_duration_seconds', 'gRPC method latency.', ('method',))
+RPC_REQUESTS = REGISTRY.counter('mango_rpc_requests_total', 'gRPC calls by method and response error code.',
+                                ('method', 'code'))
+STORE_LATENCY = REGISTRY.histogram('mango_store_operation_duration_seconds', 'Store operation latency.',
+                                   ('store', 'operation'))
+CACHE_REQUESTS = REGISTRY.counter('mango_cache_requests_total', 'Cache reads by result (hit or miss).',
+                                  ('cache', 'result'))
+MONGO_LATENCY = REGISTRY.histogram('mango_mongo_command_duration_seconds', 'MongoDB command latency.',
+                                   ('collection', 'command'))
+MONGO_FAILURES = REGISTRY.counter('mango_mongo_command_failures_total', 'Failed MongoDB commands.',
+                                  ('collection', 'command'))
+LEGACY_LATENCY = REGISTRY.histogram('mango_legacy_request_duration_seconds', 'Legacy API request latency.',
+                                    ('operation',))
+LEGACY_FAILURES = REGISTRY.counter('mango_legacy_request_failures_total', 'Failed legacy API requests.',
+                                   ('operation',))
+
+
+def _response_code(response):
+    # errors are reported in the `error` field of the response message, not as gRPC status codes
+    return getattr(getattr(response, 'error', None), 'code', '') or 'ok'
+
+
+def _timed_rpc(name, method):
+    if inspect.isasyncgenfunction(method):
+        @functools.wraps(method)
+        async def async_stream(request, context):
+            code = 'ok'
+            start = time.perf_counter()
+            try:
+                async for response in method(request, context):
+                    code = _response_code(response)
+                    yield response
+            except (GeneratorExit, asyncio.CancelledError):
+                code = 'cancelled'
+                raise
+            except BaseException:
+                code = 'exception'
+                raise
+            finally:
+                RPC_LATENCY.observe(time.perf_counter() - start, name)
+                RPC_REQUESTS.inc(name, code)
+        return async_stream
+
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_unary(request, context):
+            code = 'exception'
+            start = time.perf_counter()
+            try:
+                response = await method(request, context)
+                code = _response_code(response)
+                return response
+            finally:
+                RPC_LATENCY.observe(time.perf_counter() - start, name)
+                RPC_REQUESTS.inc(name, code)
+        return async_unary
+
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def stream(request, context):
+            code = 'ok'
+            start = time.perf_counter()
+            try:
+                for response in method(request, context):
+                    code = _response_code(response)
+                    yield response
+            except GeneratorExit:
+                code = 'cancelled'
+                raise
+            except BaseException:
+                code = 'exception'
+                raise
+            finally:
+                RPC_LATENCY.observe(time.perf_counter() - start, name)
+                RPC_REQUESTS.inc(name, code)
+        return stream
+
+    @functools.wraps(method)
+    def unary(request, context):
+        code = 'exception'
+        start = time.perf_counter()
+        try:
+            response = method(request, context)
+            code = _response_code(response)
+            return response
+        finally:
+            RPC_LATENCY.observe(time.perf_counter() - start, name)
+            RPC_REQUESTS.inc(name, code)
+    return unary
+
+
+def _timed_operation(store_name, name, method):
+    if inspect.isasyncgenfunction(method):
+        @functools.wraps(method)
+        async def async_stream(*args, **kwargs):
+            with STORE_LATENCY.time(store_name, name):
+                async for item in method(*args, **kwargs):
+                    yield item
+        return async_stream
+
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_operation(*args, **kwargs):
+            with STORE_LATENCY.time(store_name, name):
+                return await method(*args, **kwargs)
+        return async_operation
+
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def stream(*args, **kwargs):
+            with STORE_LATENCY.time(store_name, name):
+                yield from method(*args, **kwargs)
+        return stream
+
+    @functools.wraps(method)
+    def operation(*args, **kwargs):
+        with STORE_LATENCY.time(store_name, name):
+            return method(*args, **kwargs)
+    return operation
+
+
+def instrument_servicer(servicer):
+    """Times every gRPC method (CamelCase public methods) of the servicer instance."""
+    for name in dir(servicer):
+        method = getattr(servicer, name)
+        if name[:1].isupper() and inspect.ismethod(method):
+            setattr(servicer, name, _timed_rpc(name, method))
+
+    return servicer
+
+
+def instrument_store(store, store_name):
+    """Times every public method of the store instance and counts hits and misses of its cache."""
+    for name, attribute in vars(type(store)).items():
+        if not name.startswith('_') and inspect.isfunction(attribute):
+            setattr(store, name, _timed_operation(store_name, name, getattr(store, name)))
+
+    cache_wrapper = getattr(store, 'cache_wrapper', None)
+    if cache_wrapper is not None:
+        if inspect.iscoroutinefunction(cache_wrapper.get_cache):
+            store.cache_wrapper = AsyncMeteredCacheWrapper(cache_wrapper, store_name)
+        else:
+            store.cache_wrapper = MeteredCacheWrapper(cache_wrapper, store_name)
+
+    return store
+
+
+class MeteredCacheWrapper:
+    """
+    Counts `get_cache` hits and misses (CacheNotFound) of the wrapped cache, everything else is delegated.
+
+    Keys read along with a lookup only to tell why it missed (`probe_prefixes`, e.g. the "no survey" entries) are
+    counted apart, under the `<cache>:<prefix>` cache label.
+    """
+    probe_prefixes = ('NO_SURVEY:', 'PENDING:')
+
+    def __init__(self, cache_wrapper, cache_name):
+        self.cache_wrapper = cache_wrapper
+        self.cache_name = cache_name
+
+    def get_cache(self, key):
+        try:
+            value = self.cache_wrapper.get_cache(key)
+        except CacheNotFound:
+            CACHE_REQUESTS.inc(self.cache_name, 'miss')
+            raise
+
+        CACHE_REQUESTS.inc(self.cache_name, 'hit')
+        return value
+
+    def get_many(self, keys):
+        keys = list(keys)
+        values = self.cache_wrapper.get_many(keys)
+        self._count(keys, values)
+        return values
+
+    def get_many_in_generation(self, generation, keys_in_generation, keys=()):
+        keys_in_generation, keys = list(keys_in_generation), list(keys)
+        number, values = self.cache_wrapper.get_many_in_generation(generation, keys_in_generation, keys)
+        self._count([template.format(number) for template in keys_in_generation] + keys, values)
+        return number, values
+
+    def _count(self, keys, values):
+        counts = {}
+        for key in keys:
+            cache_name = self.cache_name
+            for prefix in self.probe_prefixes:
+                if str(key).startswith(prefix):
+                    cache_name = '{}:{}'.format(self.cache_name, prefix[:-1].lower())
+                    break
+            labels = (cache_name, 'hit' if key in values else 'miss')
+            counts[labels] = counts.get(labels, 0) + 1
+
+        for (cache_name, result), amount in counts.items():
+            CACHE_REQUESTS.inc(cache_name, result, amount=amount)
+
+    def __getattr__(self, name):
+        return getattr(self.cache_wrapper, name)
+
+
+class AsyncMeteredCacheWrapper(MeteredCacheWrapper):
+    """MeteredCacheWrapper of a coroutine cache wrapper (asyncio server mode)."""
+
+    async def get_cache(self, key):
+        try:
+            value = await self.cache_wrapper.get_cache(key)
+        except CacheNotFound:
+            CACHE_REQUESTS.inc(self.cache_name, 'miss')
+            raise
+
+        CACHE_REQUESTS.inc(self.cache_name, 'hit')
+        return value
+
+    async def get_many(self, keys):
+        keys = list(keys)
+        values = await self.cache_wrapper.get_many(keys)
+        self._count(keys, values)
+        return values
+
+    async def get_many_in_generation(self, generation, keys_in_generation, keys=()):
+        keys_in_generation, keys = list(keys_in_generation), list(keys)
+        number, values = await self.cache_wrapper.get_many_in_generation(generation, keys_in_generation, keys)
+        self._count([template.format(number) for template in keys_in_generation] + keys, values)
+        return number, values
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every command sent by the MongoClients created after it is registered with `pymongo.monitoring`."""
+
+    def __init__(self):
+        # started -> succeeded/failed events of a command are matched by connection and request id
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = \
+            collection if isinstance(collection, str) else event.database_name
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), event.database_name)
+        MONGO_LATENCY.observe(event.duration_micros / 1e6, collection, event.command_name)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), event.database_name)
+        MONGO_LATENCY.observe(event.duration_micros / 1e6, collection, event.command_name)
+        MONGO_FAILURES.inc(collection, event.command_name)
+
+
+class MetricsServer:
+    """Serves the registry in the Prometheus text format on `http://host:port/metrics` from a daemon thread."""
+
+    def __init__(self, app, registry=REGISTRY, host='127.0.0.1', port=9464):
+        self.app = app
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        registry = self.registry
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # scrapes would otherwise be written to stderr every few seconds
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, name='mango-metrics', daemon=True).start()
+        self.app.log.info('metrics served on http://{}:{}/metrics'.format(self.host, self.httpd.server_port))
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
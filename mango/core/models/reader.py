@@ -0,0 +1,58 @@
+from olive.store.toolbox import MongoObjectId
+from marshmallow import fields
+
+# fields whose loaded value is the stored value itself
+_IDENTITY_FIELDS = (fields.String, fields.Integer, fields.Boolean, fields.Float)
+
+
+def _converter(field, value, namespace):
+    """Python expression converting the stored `value` the way `field` would load it, without validation."""
+    if isinstance(field, MongoObjectId):
+        return 'str({})'.format(value)
+
+    if isinstance(field, _IDENTITY_FIELDS):
+        return value
+
+    if isinstance(field, fields.Nested):
+        reader_name = '_read_{}'.format(len(namespace))
+        namespace[reader_name] = compile_reader(field.schema)
+        return '{}({})'.format(reader_name, value)
+
+    if isinstance(field, fields.List):
+        inner = getattr(field, 'inner', None) or getattr(field, 'container')
+        return '[{} for item in {}]'.format(_converter(inner, 'item', namespace), value)
+
+    # anything else keeps marshmallow's own deserialization
+    field_name = '_field_{}'.format(len(namespace))
+    namespace[field_name] = field
+    return '{}.deserialize({})'.format(field_name, value)
+
+
+def compile_reader(schema):
+    """
+    Generates a trusted-read converter equivalent to `schema.load(document)` for documents this service wrote and
+    validated itself: same output keys and ObjectId conversion, but no validation, hooks or error collection.
+
+    It is a plain function compiled once per schema, e.g. for SurveySchema:
+
+        def read(document):
+            data = {}
+            if '_id' in document:
+                data['_id'] = str(document['_id'])
+            if 'questions' in document:
+                data['questions'] = [_read_1(item) for item in document['questions']]
+            ...
+            return data
+
+    Marshmallow validation must stay on every write path.
+    """
+    namespace = {}
+    lines = ['def read(document):', '    data = {}']
+    for name, field in schema.load_fields.items():
+        key = field.data_key or name
+        lines.append('    if {!r} in document:'.format(key))
+        lines.append('        data[{!r}] = {}'.format(name, _converter(field, 'document[{!r}]'.format(key), namespace)))
+    lines.append('    return data')
+
+    exec(compile('\n'.join(lines), '<reader {}>'.format(type(schema).__name__), 'exec'), namespace)
+    return namespace['read']
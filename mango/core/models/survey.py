@@ -16,7 +16,7 @@ class SurveySchema(BaseSchema):
     class Meta:
         # Tuple or list of fields to include in the serialized result
         fields = ("_id", "created_at", "updated_at", "user_id", "staff_id", "total_rating",
-                  "reservation_id", "status", "questions", "content", "platform")
+                  "reservation_id", "status", "questions", "content", "platform", "city", "complex", "checkout_date")
         # exclude unknown fields from database on .load() call
         unknown = EXCLUDE
         datetimeformat = UTC_DATE_FORMAT
@@ -42,4 +42,8 @@ class SurveySchema(BaseSchema):
                          error_messages={'required': {'message': 'content is required', 'code': 400}})
     platform = fields.Str(required=True,
                           error_messages={'required': {'message': 'platform is required', 'code': 400}})
+    # reservation attributes denormalized from the legacy API so surveys can be filtered locally
+    city = fields.Str(required=False)
+    complex = fields.Str(required=False)
+    checkout_date = fields.Str(required=False)
     _id = MongoObjectId(allow_none=False)
@@ -0,0 +1,136 @@
+from cement.core.exc import CaughtSignal
+import traceback
+import signal
+import time
+import os
+
+
+class Supervisor:
+    """
+    Pre-fork supervisor: runs `target(worker_index)` in `workers` forked processes and keeps them running.
+
+    Workers are expected to bind the same gRPC port, which gRPC opens with SO_REUSEPORT so the kernel balances
+    connections between them. A worker that exits is forked again after `restart_delay` seconds, doubled for every
+    consecutive exit within `min_uptime` seconds of its start (up to `max_restart_delay`). A worker exiting that way
+    more than `max_restarts` times in a row stops the supervisor. SIGTERM and SIGINT are forwarded to every worker,
+    workers still running `grace` seconds later are killed.
+
+    Nothing holding sockets or threads (Mongo and Redis clients, gRPC servers) may be created before `run()`, each
+    worker creates its own in `target`.
+    """
+    stop_signals = (signal.SIGTERM, signal.SIGINT)
+
+    def __init__(self, app, workers, target, restart_delay=1, grace=10, max_restarts=5, max_restart_delay=30,
+                 min_uptime=60):
+        self.app = app
+        self.workers = workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.grace = grace
+        self.max_restarts = max_restarts
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.processes = {}
+        self.crash_looping = False
+        self._started_at = {}
+        # consecutive early exits and restart time of every worker waiting to be forked again
+        self._exits = {}
+        self._restarts = {}
+        self._stop_deadline = None
+        self._previous_handlers = {}
+
+    def run(self):
+        """Runs the workers until stopped by a signal (returns True) or by a crash looping worker (returns False)."""
+        self._previous_handlers = {sig: signal.signal(sig, self._stop) for sig in self.stop_signals}
+        try:
+            for worker_index in range(self.workers):
+                self._spawn(worker_index)
+
+            self._supervise()
+        finally:
+            for sig, handler in self._previous_handlers.items():
+                signal.signal(sig, handler)
+
+        self.app.log.info('all {} workers stopped'.format(self.workers))
+        return not self.crash_looping
+
+    def _spawn(self, worker_index):
+        pid = os.fork()
+        if pid:
+            self.processes[pid] = worker_index
+            self._started_at[pid] = time.monotonic()
+            self.app.log.info('worker {} started with pid {}'.format(worker_index, pid))
+            return
+
+        # worker process: signals are handled by the application again, never return into the supervisor
+        for sig, handler in self._previous_handlers.items():
+            signal.signal(sig, handler)
+
+        exit_code = 0
+        try:
+            self.target(worker_index)
+        except CaughtSignal:
+            pass
+        except BaseException:
+            self.app.log.error('worker {} failed: {}'.format(worker_index, traceback.format_exc()))
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _supervise(self):
+        while self.processes or (self._restarts and not self._stop_deadline):
+            pid, status = os.waitpid(-1, os.WNOHANG) if self.processes else (0, 0)
+            if not pid:
+                if self._stop_deadline and time.monotonic() > self._stop_deadline:
+                    self._signal_workers(signal.SIGKILL)
+                self._restart_due()
+                time.sleep(0.1)
+                continue
+
+            worker_index = self.processes.pop(pid)
+            uptime = time.monotonic() - self._started_at.pop(pid)
+            if self._stop_deadline:
+                continue
+
+            exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            # a worker which served for a while starts over
+            exits = self._exits.get(worker_index, 0) + 1 if uptime < self.min_uptime else 1
+            self._exits[worker_index] = exits
+            if exits > self.max_restarts:
+                self.app.log.error('worker {} (pid {}) exited with status {}, {} times in a row within {}s of its start'
+                                   .format(worker_index, pid, exit_code, exits, self.min_uptime))
+                self.crash_looping = True
+                self._stop_workers('worker {} is crash looping'.format(worker_index))
+                continue
+
+            delay = min(self.restart_delay * 2 ** (exits - 1), self.max_restart_delay)
+            self.app.log.error('worker {} (pid {}) exited with status {}, restarting it in {}s'.format(
+                worker_index, pid, exit_code, delay))
+            self._restarts[worker_index] = time.monotonic() + delay
+
+    def _restart_due(self):
+        if self._stop_deadline:
+            return
+
+        for worker_index, restart_at in list(self._restarts.items()):
+            if time.monotonic() >= restart_at:
+                del self._restarts[worker_index]
+                self._spawn(worker_index)
+
+    def _stop(self, signum, frame):
+        self._stop_workers('signal {}'.format(signum))
+
+    def _stop_workers(self, reason):
+        if self._stop_deadline:
+            return
+
+        self.app.log.info('stopping {} workers on {}'.format(len(self.processes), reason))
+        self._stop_deadline = time.monotonic() + self.grace
+        self._signal_workers(signal.SIGTERM)
+
+    def _signal_workers(self, signum):
+        for pid in list(self.processes):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,232 @@
+from pymongo import UpdateOne
+import numpy as np
+import threading
+import datetime
+import pymongo
+import time
+import uuid
+
+
+def total_ratings(surveys, weights):
+    """
+    Vectorized total_rating of every survey, as `MangoService._build_survey_payload` computes it: the weighted mean of
+    its question ratings rounded to one decimal, then truncated (None when the weights sum to 0). `weights` maps
+    question ids to their weight, questions missing from it weigh 0.
+    """
+    survey_positions, question_weights, ratings = [], [], []
+    for position, survey in enumerate(surveys):
+        for question in survey.get('questions') or []:
+            survey_positions.append(position)
+            question_weights.append(weights.get(question['question_id'], 0))
+            ratings.append(question['rating'] or 0)
+
+    survey_positions = np.array(survey_positions, dtype=np.intp)
+    question_weights = np.array(question_weights, dtype=np.float64)
+    sums = np.bincount(survey_positions, weights=question_weights * np.array(ratings, dtype=np.float64),
+                       minlength=len(surveys))
+    counters = np.bincount(survey_positions, weights=question_weights, minlength=len(surveys))
+    means = np.divide(sums, counters, out=np.zeros(len(surveys)), where=counters != 0)
+
+    tenths = means * 10
+    results = np.trunc(np.round(means, 1)).astype(np.int64)
+    # numpy and python may round a mean sitting on a half tenth differently, those few are rounded by python
+    ties = np.flatnonzero(np.abs(tenths - np.floor(tenths) - 0.5) < 1e-9)
+    results = results.tolist()
+    for position in ties:
+        results[position] = int(round(float(means[position]), 1))
+
+    return [result if counter else None for result, counter in zip(results, counters.tolist())]
+
+
+class RatingRecompute:
+    """
+    Resumable job recomputing the total_rating of stored surveys with the current question weights.
+
+    `request(question_ids)` records that the weights of these questions changed, `run()` streams the surveys rating
+    any of them in `_id` order, `batch_size` at a time. It computes their total_rating with `total_ratings()`, writes
+    back the ones that changed with one unordered bulk write, and moves their survey stats from the old rating to the
+    new one. After every batch the last `_id` is saved in the job document (collection `rating_recompute`), so a job
+    that was stopped resumes there. A request made while a job runs restarts it from the beginning with the new
+    weights. One process at a time runs the job, holding a lease renewed after every batch.
+    """
+    job_id = 'total_rating'
+    lease_time = 60
+
+    def __init__(self, app, question_store, survey_store, stats_store=None, batch_size=1000):
+        self.app = app
+        self.question_store = question_store
+        self.survey_store = survey_store
+        self.stats_store = stats_store
+        self.batch_size = batch_size
+        self.db = survey_store.db.database['rating_recompute']
+        self.owner = uuid.uuid4().hex
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, app, question_store, survey_store, stats_store=None):
+        recompute_cfg = app.config['mango'].get('rating_recompute') or {}
+        if not recompute_cfg.get('enabled'):
+            return None
+
+        return cls(app=app,
+                   question_store=question_store,
+                   survey_store=survey_store,
+                   stats_store=stats_store,
+                   batch_size=recompute_cfg.get('batch_size', 1000))
+
+    def request(self, question_ids=None):
+        """Schedules a recompute of the surveys rating `question_ids`, or of every survey when None."""
+        update = {
+            '$set': {'status': 'pending', 'last_id': None, 'processed': 0, 'updated': 0,
+                     'requested_at': datetime.datetime.utcnow()},
+            '$inc': {'generation': 1},
+        }
+        if question_ids is None:
+            update['$set']['all'] = True
+        else:
+            update['$addToSet'] = {'question_ids': {'$each': [str(question_id) for question_id in question_ids]}}
+
+        self.db.update_one({'_id': self.job_id}, update, upsert=True)
+        self.app.log.info('total_rating recompute requested for questions {}'.format(question_ids or 'all'))
+
+    def start(self):
+        """Runs the job in a background thread of this process, unless it is already running here."""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+
+            self._thread = threading.Thread(target=self._run_logged, name='rating-recompute', daemon=True)
+            self._thread.start()
+
+    def status(self):
+        return self.db.find_one({'_id': self.job_id})
+
+    def run(self):
+        """Runs the job until it is done. Returns False when another process holds it."""
+        while True:
+            job = self.status()
+            if not job or job['status'] == 'done':
+                return True
+
+            job = self._acquire()
+            if job is None:
+                self.app.log.info('total_rating recompute is running elsewhere')
+                return False
+
+            if self._run_generation(job):
+                done = self.db.update_one({'_id': self.job_id, 'generation': job['generation']},
+                                          {'$set': {'status': 'done', 'question_ids': [], 'all': False,
+                                                    'finished_at': datetime.datetime.utcnow()},
+                                           '$unset': {'owner': '', 'lease_until': ''}})
+                if done.matched_count:
+                    self.survey_store.surveys_generation.bump()
+                    return True
+
+            self.app.log.info('question weights changed meanwhile, restarting total_rating recompute')
+
+    def _run_logged(self):
+        try:
+            self.run()
+        except Exception as e:
+            self.app.log.error('total_rating recompute failed, it resumes on its next run: {}'.format(e))
+
+    def _acquire(self):
+        now = datetime.datetime.utcnow()
+        return self.db.find_one_and_update(
+            {'_id': self.job_id, '$or': [{'owner': {'$exists': False}},
+                                         {'owner': self.owner},
+                                         {'lease_until': {'$lt': now}}]},
+            {'$set': {'owner': self.owner, 'lease_until': now + datetime.timedelta(seconds=self.lease_time)}},
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    def _weights(self):
+        return {str(question['_id']): question['weight']
+                for question in self.question_store.db.find({'is_deleted': False}, {'weight': 1})
+                if question.get('weight') is not None}
+
+    def _run_generation(self, job):
+        """Recomputes from `job['last_id']` on, returns False as soon as the job was requested again."""
+        weights = self._weights()
+        query = {} if job.get('all') else {'questions.question_id': {'$in': job.get('question_ids') or []}}
+        if job.get('last_id'):
+            query['_id'] = {'$gt': job['last_id']}
+
+        processed, updated = job.get('processed', 0), job.get('updated', 0)
+        started_at = time.monotonic()
+        cursor = self.survey_store.db.find(query,
+                                           {'questions': 1, 'total_rating': 1, 'platform': 1, 'status': 1,
+                                            'created_at': 1, 'reservation_id': 1},
+                                           sort=[('_id', pymongo.ASCENDING)],
+                                           batch_size=self.batch_size)
+        try:
+            batch = []
+            for survey in cursor:
+                batch.append(survey)
+                if len(batch) < self.batch_size:
+                    continue
+
+                updated += self._recompute_batch(batch, weights)
+                processed += len(batch)
+                if not self._checkpoint(job, batch[-1]['_id'], processed, updated, started_at):
+                    return False
+                batch = []
+
+            if batch:
+                updated += self._recompute_batch(batch, weights)
+                processed += len(batch)
+                return self._checkpoint(job, batch[-1]['_id'], processed, updated, started_at)
+
+            return True
+        finally:
+            cursor.close()
+
+    def _recompute_batch(self, surveys, weights):
+        changed = [(survey, rating) for survey, rating in zip(surveys, total_ratings(surveys, weights))
+                   if rating is not None and rating != survey.get('total_rating')]
+        if not changed:
+            return 0
+
+        # only surveys still carrying the rating we read are updated
+        result = self.survey_store.db.bulk_write([UpdateOne({'_id': survey['_id'],
+                                                             'total_rating': survey.get('total_rating')},
+                                                            {'$set': {'total_rating': rating}})
+                                                  for survey, rating in changed], ordered=False)
+        if result.matched_count < len(changed):
+            changed = self._applied(changed)
+            if not changed:
+                return 0
+
+        if self.stats_store:
+            operations = [operation for survey, rating in changed
+                          for operation in self.stats_store.rating_change_operations(survey, rating)]
+            if operations:
+                self.stats_store.db.bulk_write(operations, ordered=False)
+
+        reservation_keys = ['BY_RESERVATION:{}'.format(survey['reservation_id'])
+                            for survey, _ in changed if survey.get('reservation_id')]
+        if reservation_keys:
+            self.survey_store.cache_wrapper.delete_many(reservation_keys)
+
+        return len(changed)
+
+    def _applied(self, changed):
+        """
+        The updates of `changed` that matched: a survey whose rating was changed by someone else since it was read was
+        left alone, its stats must not be moved either.
+        """
+        current = {survey['_id']: survey.get('total_rating')
+                   for survey in self.survey_store.db.find({'_id': {'$in': [survey['_id'] for survey, _ in changed]}},
+                                                           {'total_rating': 1})}
+        return [(survey, rating) for survey, rating in changed if current.get(survey['_id']) == rating]
+
+    def _checkpoint(self, job, last_id, processed, updated, started_at):
+        now = datetime.datetime.utcnow()
+        saved = self.db.update_one({'_id': self.job_id, 'generation': job['generation'], 'owner': self.owner},
+                                   {'$set': {'status': 'running', 'last_id': last_id, 'processed': processed,
+                                             'updated': updated, 'checkpoint_at': now,
+                                             'lease_until': now + datetime.timedelta(seconds=self.lease_time)}})
+        elapsed = time.monotonic() - started_at
+        self.app.log.info('total_rating recompute: {} surveys read, {} updated ({:.0f} surveys/s)'.format(
+            processed, updated, (processed - job.get('processed', 0)) / elapsed if elapsed else 0))
+        return bool(saved.matched_count)
@@ -0,0 +1,341 @@
+from olive.exc import DocumentNotFound, InvalidFilter
+from bson import ObjectId
+import numpy as np
+import threading
+import datetime
+import pymongo
+import fcntl
+import ujson
+import time
+import os
+
+EPOCH = datetime.date(1970, 1, 1)
+
+
+class SurveySnapshot:
+    """
+    Columnar copy of the surveys in `path`, one file of fixed-width values per column, memory-mapped read-only by
+    `analytics()` so queries touch no MongoDB and no per-survey python object.
+
+    Survey columns, in `_id` order: `created_day` (UTC day number since 1970-01-01), `total_rating` (`no_rating`
+    when unset), `platform` and `status` codes. Question ratings are kept apart as (`rating_survey` row,
+    `rating_question` code, `rating`) triples. Codes index the platform, status and question id lists of
+    `snapshot.json`, which also holds the number of rows of every column, the last `_id` copied and whether
+    `created_day` is sorted, in which case date ranges are sliced out of it by binary search.
+
+    `refresh()` appends the surveys inserted after that `_id` and then rewrites `snapshot.json`, readers only map
+    the rows it counts. Surveys changed after being copied (e.g. by a rating recompute) are only picked up by
+    `refresh(rebuild=True)`, which writes the columns of a new `generation` (part of the file names) and swaps them
+    in with the meta once complete, so readers never see a partial snapshot.
+    """
+    survey_columns = (('created_day', np.int32), ('total_rating', np.int16), ('platform', np.uint16),
+                      ('status', np.uint16))
+    rating_columns = (('rating_survey', np.int32), ('rating_question', np.uint16), ('rating', np.int16))
+    no_rating = np.iinfo(np.int16).min
+    # bucket size and origin in days, weeks start on monday (1970-01-05)
+    intervals = {'day': (1, 0), 'week': (7, 4)}
+    day_format = '%Y-%m-%d'
+
+    def __init__(self, app, path, refresh_interval=60):
+        self.app = app
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.meta_path = os.path.join(path, 'snapshot.json')
+        self._view = None
+        self._view_version = None
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, app):
+        snapshot_cfg = app.config['mango'].get('snapshot') or {}
+        if not snapshot_cfg.get('enabled'):
+            return None
+
+        return cls(app=app,
+                   path=snapshot_cfg.get('path', '/var/lib/mango/snapshot'),
+                   refresh_interval=snapshot_cfg.get('refresh_interval', 60))
+
+    @staticmethod
+    def _empty_meta(generation=0):
+        return {'generation': generation, 'count': 0, 'ratings_count': 0, 'last_id': None, 'last_day': None,
+                'sorted': True, 'platforms': [], 'statuses': [], 'questions': []}
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path) as meta_file:
+                meta = ujson.load(meta_file)
+        except FileNotFoundError:
+            return self._empty_meta()
+
+        # written before column files were versioned, copied again by the next refresh
+        return meta if 'generation' in meta else self._empty_meta()
+
+    def _write_meta(self, meta):
+        with open('{}.tmp'.format(self.meta_path), 'w') as meta_file:
+            ujson.dump(meta, meta_file)
+        os.replace('{}.tmp'.format(self.meta_path), self.meta_path)
+
+    def _column_path(self, name, generation):
+        return os.path.join(self.path, '{}.{}.bin'.format(name, generation))
+
+    def view(self):
+        """`(meta, columns)` of the last refresh, columns being read-only memory maps."""
+        version = self._meta_version()
+        while self._view is None or version != self._view_version:
+            meta = self._read_meta()
+            try:
+                self._view, self._view_version = (meta, self._map_columns(meta)), version
+            except FileNotFoundError:
+                # a rebuild may have swapped in a new generation and removed these files since the meta was read
+                if self._meta_version() == version:
+                    raise
+                version = self._meta_version()
+
+        return self._view
+
+    def _meta_version(self):
+        try:
+            meta_stat = os.stat(self.meta_path)
+        except FileNotFoundError:
+            return None
+
+        # snapshot.json is replaced on every refresh
+        return meta_stat.st_ino, meta_stat.st_mtime_ns
+
+    def _map_columns(self, meta):
+        columns = {}
+        for names, length in ((self.survey_columns, meta['count']), (self.rating_columns, meta['ratings_count'])):
+            for name, dtype in names:
+                columns[name] = (np.memmap(self._column_path(name, meta['generation']), dtype=dtype, mode='r',
+                                           shape=(length,)) if length else np.zeros(0, dtype=dtype))
+        return columns
+
+    def refresh(self, survey_db, batch_size=10000, rebuild=False):
+        """
+        Appends the surveys inserted since the last refresh, or copies them all again with `rebuild`. Returns the
+        number of surveys added, None when another process is refreshing the snapshot.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with self._refresh_lock, open(os.path.join(self.path, '.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+            meta = self._read_meta()
+            if rebuild:
+                # readers keep the current generation until the new one is complete
+                meta = self._empty_meta(meta['generation'] + 1)
+            for names, length in ((self.survey_columns, meta['count']), (self.rating_columns, meta['ratings_count'])):
+                for name, dtype in names:
+                    # drops rows appended by a refresh interrupted before it saved its meta
+                    with open(self._column_path(name, meta['generation']), 'ab') as column_file:
+                        column_file.truncate(length * np.dtype(dtype).itemsize)
+
+            query = {'_id': {'$gt': ObjectId(meta['last_id'])}} if meta['last_id'] else {}
+            cursor = survey_db.find(query, {'created_at': 1, 'total_rating': 1, 'platform': 1, 'status': 1,
+                                            'questions': 1}, sort=[('_id', pymongo.ASCENDING)], batch_size=batch_size)
+            added = 0
+            try:
+                batch = []
+                for survey in cursor:
+                    batch.append(survey)
+                    if len(batch) == batch_size:
+                        added += self._append(meta, batch, publish=not rebuild)
+                        batch = []
+
+                if batch:
+                    added += self._append(meta, batch, publish=not rebuild)
+            finally:
+                cursor.close()
+
+            if rebuild:
+                self._write_meta(meta)
+                self._remove_generations(keep=meta['generation'])
+            self.app.log.info('{} surveys added to the snapshot, {} in total'.format(added, meta['count']))
+            return added
+
+    def _remove_generations(self, keep):
+        # readers still mapping them keep reading the unlinked files
+        suffix = '.{}.bin'.format(keep)
+        for name in os.listdir(self.path):
+            if name.endswith('.bin') and not name.endswith(suffix):
+                os.remove(os.path.join(self.path, name))
+
+    def _append(self, meta, surveys, publish=True):
+        """Appends the surveys to the column files, and saves `meta` for the readers with `publish`."""
+        codes = {key: {value: code for code, value in enumerate(meta[key])}
+                 for key in ('platforms', 'statuses', 'questions')}
+
+        def code(key, value):
+            if value not in codes[key]:
+                if len(meta[key]) > np.iinfo(np.uint16).max:
+                    raise ValueError('too many distinct {} for the snapshot'.format(key))
+                codes[key][value] = len(meta[key])
+                meta[key].append(value)
+            return codes[key][value]
+
+        survey_values = {name: [] for name, _ in self.survey_columns}
+        rating_values = {name: [] for name, _ in self.rating_columns}
+        for row, survey in enumerate(surveys, start=meta['count']):
+            created_at = survey.get('created_at')
+            if not isinstance(created_at, datetime.datetime):
+                created_at = survey['_id'].generation_time
+            survey_values['created_day'].append((created_at.date() - EPOCH).days)
+            total_rating = survey.get('total_rating')
+            survey_values['total_rating'].append(self.no_rating if total_rating is None else total_rating)
+            survey_values['platform'].append(code('platforms', survey.get('platform') or ''))
+            survey_values['status'].append(code('statuses', survey.get('status') or ''))
+            for question in survey.get('questions') or []:
+                if question.get('rating') is None:
+                    continue
+                rating_values['rating_survey'].append(row)
+                rating_values['rating_question'].append(code('questions', question['question_id']))
+                rating_values['rating'].append(question['rating'])
+
+        for names, values in ((self.survey_columns, survey_values), (self.rating_columns, rating_values)):
+            for name, dtype in names:
+                with open(self._column_path(name, meta['generation']), 'ab') as column_file:
+                    np.array(values[name], dtype=dtype).tofile(column_file)
+
+        days = np.array(survey_values['created_day'], dtype=np.int64)
+        meta['sorted'] = bool(meta['sorted'] and (meta['last_day'] is None or days[0] >= meta['last_day'])
+                              and np.all(days[1:] >= days[:-1]))
+        meta['last_day'] = max(int(days.max()), meta['last_day'] or 0)
+        meta['count'] += len(surveys)
+        meta['ratings_count'] += len(rating_values['rating'])
+        meta['last_id'] = str(surveys[-1]['_id'])
+        if publish:
+            self._write_meta(meta)
+        return len(surveys)
+
+    def start(self, survey_db):
+        """Refreshes the snapshot every `refresh_interval` seconds in a background thread of this process."""
+        def refresh_forever():
+            while True:
+                try:
+                    self.refresh(survey_db)
+                except Exception as e:
+                    self.app.log.error('survey snapshot refresh failed: {}'.format(e))
+                time.sleep(self.refresh_interval)
+
+        self._thread = threading.Thread(target=refresh_forever, name='snapshot-refresh', daemon=True)
+        self._thread.start()
+
+    def _parse_day(self, day):
+        try:
+            return (datetime.datetime.strptime(day, self.day_format).date() - EPOCH).days
+        except ValueError:
+            raise InvalidFilter('invalid date given: {}, it should look like 2019-08-01'.format(day))
+
+    def analytics(self, interval='day', start=None, end=None, platform=None, status=None, question_id=None,
+                  window=7, percentiles=(50, 90)):
+        """
+        Ratings (survey total_rating, or the ratings of `question_id`) of the surveys created from `start` to before
+        `end` (days, e.g. 2019-08-01), per `interval` bucket: count, mean, mean of the last `window` buckets,
+        nearest-rank `percentiles` and histogram. Buckets without ratings are left out.
+        """
+        if interval not in self.intervals:
+            raise InvalidFilter('invalid interval given: {}, it should be one of {}'
+                                .format(interval, ', '.join(self.intervals)))
+        if any(not 0 < percentile <= 100 for percentile in percentiles):
+            raise InvalidFilter('percentiles should be greater than 0 and at most 100')
+        window = max(1, window)
+
+        meta, columns = self.view()
+        start_day = self._parse_day(start) if start else None
+        end_day = self._parse_day(end) if end else None
+        if question_id:
+            if question_id not in meta['questions']:
+                raise DocumentNotFound('no ratings of question {} in the snapshot'.format(question_id))
+            selected = columns['rating_question'] == meta['questions'].index(question_id)
+            rows = columns['rating_survey'][selected]
+            ratings = columns['rating'][selected]
+            conditions = []
+
+            def survey_column(name):
+                return columns[name][rows]
+        else:
+            first_row, last_row = 0, meta['count']
+            if meta['sorted']:
+                # the date range is a slice of the survey columns
+                if start_day is not None:
+                    first_row = int(np.searchsorted(columns['created_day'], start_day))
+                if end_day is not None:
+                    last_row = int(np.searchsorted(columns['created_day'], end_day))
+                start_day = end_day = None
+            ratings = columns['total_rating'][first_row:last_row]
+            conditions = [ratings != self.no_rating]
+
+            def survey_column(name):
+                return columns[name][first_row:last_row]
+
+        days = survey_column('created_day')
+        for name, key, value in (('platform', 'platforms', platform), ('status', 'statuses', status)):
+            if value:
+                if value not in meta[key]:
+                    raise DocumentNotFound('no survey with {} {} in the snapshot'.format(name, value))
+                conditions.append(survey_column(name) == meta[key].index(value))
+        if start_day is not None:
+            conditions.append(days >= start_day)
+        if end_day is not None:
+            conditions.append(days < end_day)
+
+        if conditions:
+            mask = np.logical_and.reduce(conditions) if len(conditions) > 1 else conditions[0]
+            if not mask.all():
+                days, ratings = days[mask], ratings[mask]
+        if not len(ratings):
+            raise DocumentNotFound('no survey ratings match the given filters')
+
+        # one row of rating counts per bucket, from the first bucket to the last one
+        size, origin = self.intervals[interval]
+        buckets = days if size == 1 else (days - origin) // size
+        first_bucket = int(buckets.min())
+        positions = buckets - np.int32(first_bucket)
+        bucket_count = int(positions.max()) + 1
+        lowest = int(ratings.min())
+        values = np.arange(lowest, int(ratings.max()) + 1)
+        indexes = positions * np.int32(len(values))
+        indexes += ratings
+        indexes -= np.int32(lowest)
+        histograms = np.bincount(indexes, minlength=bucket_count * len(values)).reshape(bucket_count, len(values))
+
+        counts = histograms.sum(axis=1)
+        sums = histograms @ values
+        means = np.divide(sums, counts, out=np.zeros(bucket_count), where=counts > 0)
+
+        running_counts, running_sums = np.cumsum(counts), np.cumsum(sums)
+        window_counts, window_sums = running_counts.copy(), running_sums.copy()
+        window_counts[window:] -= running_counts[:-window]
+        window_sums[window:] -= running_sums[:-window]
+        rolling_means = np.divide(window_sums, window_counts, out=np.zeros(bucket_count), where=window_counts > 0)
+
+        cumulative = np.cumsum(histograms, axis=1)
+        percentile_values = {}
+        for percentile in percentiles:
+            ranks = np.maximum(np.ceil(counts * percentile / 100), 1)
+            percentile_values[percentile] = values[np.minimum((cumulative < ranks[:, None]).sum(axis=1),
+                                                              len(values) - 1)]
+
+        result_buckets = []
+        for position in np.flatnonzero(counts).tolist():
+            bucket_start = EPOCH + datetime.timedelta(days=(first_bucket + position) * size + origin)
+            result_buckets.append({
+                'start': bucket_start.strftime(self.day_format),
+                'count': int(counts[position]),
+                'mean': float(means[position]),
+                'rolling_mean': float(rolling_means[position]),
+                'percentiles': [{'percentile': percentile, 'value': int(percentile_values[percentile][position])}
+                                for percentile in percentiles],
+                'histogram': [{'rating': int(value), 'count': int(count)}
+                              for value, count in zip(values.tolist(), histograms[position].tolist()) if count],
+            })
+
+        return {
+            'interval': interval,
+            'count': int(counts.sum()),
+            'mean': float(sums.sum() / counts.sum()),
+            'buckets': result_buckets,
+        }
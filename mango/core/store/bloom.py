@@ -0,0 +1,97 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    Bloom filter kept in a Redis bitmap (plain SETBIT/GETBIT, no Redis module needed).
+
+    Sized for `capacity` items at a false positive rate of `error_rate`. `might_contain()` is False only for items
+    that were never added, and only once the filter has been built from the source of truth with `rebuild()`: until
+    then every item might be contained. Items cannot be removed. The bitmap key carries the sizing, a filter sized
+    differently is a new filter that must be built again (the previous bitmap can then be deleted).
+    """
+
+    def __init__(self, app, key, capacity=5000000, error_rate=0.001):
+        self.app = app
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.key = '{}:{}:{}'.format(key, self.size, self.hash_count)
+        self.ready_key = '{}:READY'.format(self.key)
+
+    def positions(self, item):
+        # double hashing: k positions out of one 128 bit digest, identical in every process
+        digest = hashlib.blake2b(str(item).encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add_many(self, items, pipeline=None):
+        """Sets the bits of `items`, on `pipeline` when given (the caller executes it)."""
+        own_pipeline = pipeline is None
+        if own_pipeline:
+            pipeline = self.app.cache.r.pipeline(transaction=False)
+
+        self._set_bits(self.key, items, pipeline)
+        if own_pipeline:
+            pipeline.execute()
+
+    def might_contain(self, item):
+        return self.might_contain_many([item])[0]
+
+    def might_contain_many(self, items):
+        """`might_contain()` of every item, read with one pipeline."""
+        items = list(items)
+        pipeline = self.app.cache.r.pipeline(transaction=False)
+        self.queue_lookup(items, pipeline)
+        return self.lookup_results(items, pipeline.execute())
+
+    def queue_lookup(self, items, pipeline):
+        """Queues the reads of `might_contain_many()` on `pipeline`, `lookup_results()` reads what it returned."""
+        pipeline.get(self.ready_key)
+        for item in items:
+            for position in self.positions(item):
+                pipeline.getbit(self.key, position)
+
+    def lookup_results(self, items, results):
+        ready, *bits = results
+        if not ready:
+            return [True] * len(items)
+
+        return [all(bits[i:i + self.hash_count]) for i in range(0, len(bits), self.hash_count)]
+
+    def is_ready(self):
+        return bool(self.app.cache.r.get(self.ready_key))
+
+    def rebuild(self, items, batch_size=10000):
+        """
+        Builds the filter from every item of `items` aside, then swaps it in. Items added meanwhile are merged in, so
+        the filter can be rebuilt while it is being written to. Returns the number of items.
+        """
+        redis = self.app.cache.r
+        build_key = '{}:REBUILD'.format(self.key)
+        redis.delete(build_key)
+        # allocate the whole bitmap at once
+        redis.setbit(build_key, self.size - 1, 0)
+
+        count = 0
+        pipeline = redis.pipeline(transaction=False)
+        for item in items:
+            self._set_bits(build_key, [item], pipeline)
+            count += 1
+            if count % batch_size == 0:
+                pipeline.execute()
+                self.app.log.info('{} items added to {}'.format(count, build_key))
+        pipeline.execute()
+
+        swap = redis.pipeline(transaction=True)
+        # bits set by writers while we were building went to the live filter only
+        swap.bitop('OR', build_key, build_key, self.key)
+        swap.rename(build_key, self.key)
+        swap.set(self.ready_key, 1)
+        swap.execute()
+        return count
+
+    def _set_bits(self, key, items, pipeline):
+        for item in items:
+            for position in self.positions(item):
+                pipeline.setbit(key, position, 1)
@@ -0,0 +1,446 @@
+from redis.exceptions import RedisError
+from mango.core.store.codec import CacheCodec
+from mango.core.toolbox import SingleFlight
+from olive.exc import CacheNotFound
+from collections import OrderedDict
+from concurrent import futures
+import threading
+import ujson
+import time
+import uuid
+
+
+class LocalCache:
+    """Bounded, thread-safe in-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires_at, value = self._entries[key]
+            except KeyError:
+                raise CacheNotFound
+
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                raise CacheNotFound
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class InvalidationBus:
+    """
+    Broadcasts cache invalidations to every replica over a Redis pub/sub channel.
+
+    Subscribers are called with the invalidated key, or with `None` when everything they hold must be dropped
+    (e.g. after a pattern delete or when the subscription had to be re-established and messages may have been lost).
+    Messages published by this process are not delivered back to it.
+    """
+
+    def __init__(self, app, channel, retry_interval=1):
+        self.app = app
+        self.channel = channel
+        self.retry_interval = retry_interval
+        self.node_id = uuid.uuid4().hex
+        self._subscribers = []
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen,
+                                                  name='invalidation-bus:{}'.format(self.channel),
+                                                  daemon=True)
+                self._listener.start()
+
+    def publish(self, key=None):
+        message = ujson.dumps({'node': self.node_id, 'key': None if key is None else str(key)})
+        try:
+            self.app.cache.r.publish(self.channel, message)
+        except RedisError:
+            self.app.log.error('could not publish invalidation of {} on {}'.format(key, self.channel))
+
+    def _notify(self, key):
+        for callback in self._subscribers:
+            callback(key)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.app.cache.r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # anything published while we were not subscribed is lost, start from a clean slate
+                self._notify(None)
+                self.app.log.info('listening for cache invalidations on {}'.format(self.channel))
+                for message in pubsub.listen():
+                    payload = ujson.loads(message['data'])
+                    if payload['node'] == self.node_id:
+                        continue
+
+                    self._notify(payload['key'])
+            except RedisError:
+                self.app.log.error('invalidation channel {} lost, retrying in {}s'
+                                   .format(self.channel, self.retry_interval))
+                time.sleep(self.retry_interval)
+
+
+class PipelinedCacheWrapper:
+    """
+    Redis cache of a store: values encoded by `codec` under `cache_key.format(key)`, expiring after
+    `cache.iredis.expire_time`.
+
+    Same interface as olive's `CacheWrapper` (and the same layout with the default JSON codec), plus `get_many`,
+    `write_many` and `delete_many` which cost a single round-trip whatever the number of keys. The latter two can bump
+    CacheGenerations in that same round-trip. `get_many_in_generation` reads a generation and the keys it namespaces in
+    one round-trip too.
+    """
+    # GET of the generation counter (KEYS[1]) then MGET of the keys built on it, ARGV holds the (prefix, suffix) around
+    # the generation number of every namespaced key and the other KEYS are read along as they are
+    generation_read_script = """
+local generation = redis.call('get', KEYS[1]) or '0'
+local keys = {}
+for i = 1, #ARGV, 2 do keys[#keys + 1] = ARGV[i] .. generation .. ARGV[i + 1] end
+for i = 2, #KEYS do keys[#keys + 1] = KEYS[i] end
+local values = redis.call('mget', unpack(keys))
+table.insert(values, 1, generation)
+return values
+"""
+
+    def __init__(self, app, cache_key, codec=None):
+        self.app = app
+        self.cache_key = cache_key
+        self.codec = codec or CacheCodec.from_config(app)
+        self.expire_time = int(self.app.config.get('cache.iredis', 'expire_time') or 3600)
+
+    def get_cache(self, key):
+        value = self.app.cache.r.get(self.cache_key.format(key))
+        if value is None:
+            raise CacheNotFound('{} not found in cache'.format(self.cache_key.format(key)))
+
+        return self.codec.decode(value)
+
+    def write_cache(self, key, value, expire_time=None):
+        self.app.cache.r.set(self.cache_key.format(key), self.codec.encode(value), ex=expire_time or self.expire_time)
+
+    def add_cache(self, key, value, expire_time=None):
+        """Caches `value` unless `key` is already cached (SET NX), returns whether it was."""
+        return bool(self.app.cache.r.set(self.cache_key.format(key), self.codec.encode(value),
+                                         ex=expire_time or self.expire_time, nx=True))
+
+    def delete(self, key):
+        self.app.cache.r.delete(self.cache_key.format(key))
+
+    def delete_by_pattern(self, pattern):
+        keys = list(self.app.cache.r.scan_iter(match=self.cache_key.format(pattern)))
+        if keys:
+            self.app.cache.r.delete(*keys)
+
+    def get_many(self, keys):
+        """Returns `{key: value}` of the given keys which are cached, with one MGET."""
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        values = self.app.cache.r.mget([self.cache_key.format(key) for key in keys])
+        return {key: self.codec.decode(value) for key, value in zip(keys, values) if value is not None}
+
+    def get_many_in_generation(self, generation, keys_in_generation, keys=()):
+        """
+        `get_many()` of `keys` and of `keys_in_generation`, templates like `'PAGE:{}'` formatted with the current number
+        of `generation`. Returns `(generation number, {key: value})`, read with one EVAL unless the number is memoized.
+        """
+        keys_in_generation, keys = list(keys_in_generation), list(keys)
+        number = generation.memoized()
+        if number is not None:
+            return number, self.get_many([template.format(number) for template in keys_in_generation] + keys)
+
+        arguments = []
+        for template in keys_in_generation:
+            arguments += self.cache_key.format(template).split('{}', 1)
+        number, *values = self.app.cache.r.eval(self.generation_read_script, 1 + len(keys), generation.key,
+                                                *[self.cache_key.format(key) for key in keys], *arguments)
+        number = int(number)
+        return number, {key: self.codec.decode(value)
+                        for key, value in zip([template.format(number) for template in keys_in_generation] + keys,
+                                              values) if value is not None}
+
+    def write_many(self, items, generations=(), expire_time=None):
+        """Caches every `{key: value}` of `items` and bumps `generations`, in one pipeline."""
+        pipeline = self.app.cache.r.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(self.cache_key.format(key), self.codec.encode(value), ex=expire_time or self.expire_time)
+
+        self._execute(pipeline, generations)
+
+    def delete_many(self, keys, generations=()):
+        """Deletes `keys` and bumps `generations`, in one pipeline."""
+        keys = [self.cache_key.format(key) for key in keys]
+        pipeline = self.app.cache.r.pipeline(transaction=False)
+        if keys:
+            pipeline.delete(*keys)
+
+        self._execute(pipeline, generations)
+
+    @staticmethod
+    def _execute(pipeline, generations):
+        for generation in generations:
+            pipeline.incr(generation.key)
+
+        results = pipeline.execute()
+        # the INCR replies come last
+        for generation, value in zip(generations, results[len(results) - len(generations):]):
+            generation.bumped(value)
+
+
+class TieredCacheWrapper:
+    """
+    Puts a LocalCache in front of a Redis backed `PipelinedCacheWrapper`.
+
+    Exposes the same interface as `PipelinedCacheWrapper`. Every write or delete goes to both tiers and is announced on
+    the InvalidationBus so the other replicas drop their local copy of the key.
+    """
+
+    def __init__(self, cache_wrapper, local_cache, invalidation_bus=None):
+        self.cache_wrapper = cache_wrapper
+        self.local_cache = local_cache
+        self.invalidation_bus = invalidation_bus
+        if self.invalidation_bus:
+            self.invalidation_bus.subscribe(self._on_invalidation)
+
+    def get_cache(self, key):
+        try:
+            return self.local_cache.get(str(key))
+        except CacheNotFound:
+            value = self.cache_wrapper.get_cache(key)
+            self.local_cache.set(str(key), value)
+            return value
+
+    def write_cache(self, key, value):
+        self.cache_wrapper.write_cache(key, value)
+        self.local_cache.set(str(key), value)
+        self._publish(key)
+
+    def delete(self, key):
+        self.cache_wrapper.delete(key)
+        self.local_cache.delete(str(key))
+        self._publish(key)
+
+    def delete_by_pattern(self, pattern):
+        self.cache_wrapper.delete_by_pattern(pattern)
+        self.local_cache.clear()
+        self._publish(None)
+
+    def get_many(self, keys):
+        values = {}
+        missing = []
+        for key in keys:
+            try:
+                values[key] = self.local_cache.get(str(key))
+            except CacheNotFound:
+                missing.append(key)
+
+        if missing:
+            found = self.cache_wrapper.get_many(missing)
+            for key, value in found.items():
+                self.local_cache.set(str(key), value)
+            values.update(found)
+
+        return values
+
+    def get_many_in_generation(self, generation, keys_in_generation, keys=()):
+        # the generation is memoized along with the local tier, both are kept coherent by the bus
+        number = generation.current()
+        return number, self.get_many([template.format(number) for template in keys_in_generation] + list(keys))
+
+    def write_many(self, items, generations=(), expire_time=None):
+        self.cache_wrapper.write_many(items, generations, expire_time)
+        for key, value in items.items():
+            self.local_cache.set(str(key), value)
+            self._publish(key)
+
+    def delete_many(self, keys, generations=()):
+        keys = list(keys)
+        self.cache_wrapper.delete_many(keys, generations)
+        for key in keys:
+            self.local_cache.delete(str(key))
+            self._publish(key)
+
+    def _publish(self, key):
+        if self.invalidation_bus:
+            self.invalidation_bus.publish(key)
+
+    def _on_invalidation(self, key):
+        if key is None:
+            self.local_cache.clear()
+        else:
+            self.local_cache.delete(key)
+
+
+class CacheGeneration:
+    """
+    Generation number kept in Redis that namespaces a family of cache keys.
+
+    A single INCR through `bump()` makes every key built on the previous generation unreachable; those entries are
+    never deleted explicitly and simply age out by their TTL. With an InvalidationBus the current generation is also
+    memoized in-process until any replica bumps it.
+    """
+
+    def __init__(self, app, key, invalidation_bus=None):
+        self.app = app
+        self.key = key
+        self.invalidation_bus = invalidation_bus
+        self._generation = None
+        self._invalidations = 0
+        if self.invalidation_bus:
+            self.invalidation_bus.subscribe(self._on_invalidation)
+
+    def current(self):
+        generation = self._generation
+        if generation is None:
+            invalidations = self._invalidations
+            generation = int(self.app.cache.r.get(self.key) or 0)
+            # do not memoize a value that may have been bumped while we were reading it
+            if self.invalidation_bus and invalidations == self._invalidations:
+                self._generation = generation
+
+        return generation
+
+    def memoized(self):
+        """The current generation when it is known without reading Redis, else None."""
+        return self._generation
+
+    def bump(self):
+        return self.bumped(self.app.cache.r.incr(self.key))
+
+    def bumped(self, generation):
+        """Announces a bump to `generation` made outside `bump()`, e.g. on a PipelinedCacheWrapper pipeline."""
+        self.app.log.debug('cache generation {} bumped to {}'.format(self.key, generation))
+        if self.invalidation_bus:
+            self._on_invalidation(self.key)
+            self.invalidation_bus.publish(self.key)
+
+        return generation
+
+    def _on_invalidation(self, key):
+        if key in (None, self.key):
+            self._invalidations += 1
+            self._generation = None
+
+
+class StampedeGuard:
+    """
+    Keeps the concurrent misses of a cache entry from all recomputing it.
+
+    Misses in this process are coalesced by a SingleFlight. Across processes the one recomputing holds a short Redis
+    lock (`SET NX PX`), the others poll the cache until the entry shows up or the lock is gone, then compute it
+    themselves. With `stale_ttl`, stores also cache a stale copy of the entry that outlives generation bumps: a miss
+    which finds a copy at most `stale_ttl` seconds old returns it at once while a background thread recomputes the
+    entry.
+    """
+    lock_key = 'MANGO:LOCK:{}'
+    release_script = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, app, lock_ttl=5.0, poll_interval=0.05, stale_ttl=0, refresh_workers=2):
+        self.app = app
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self.stale_ttl = stale_ttl
+        self.single_flight = SingleFlight()
+        self._refresher = None
+        if self.stale_ttl:
+            self._refresher = futures.ThreadPoolExecutor(max_workers=refresh_workers,
+                                                         thread_name_prefix='cache-refresh')
+
+    @classmethod
+    def from_config(cls, app):
+        stampede_cfg = app.config['mango'].get('stampede') or {}
+        if not stampede_cfg.get('enabled'):
+            return None
+
+        return cls(app=app,
+                   lock_ttl=stampede_cfg.get('lock_ttl', 5.0),
+                   stale_ttl=stampede_cfg.get('stale_ttl', 0))
+
+    def fetch(self, name, read, compute):
+        """
+        Returns the cache entry `name`. `read()` returns `(value, fresh)` or raises CacheNotFound, `compute()` computes
+        the value and caches it.
+        """
+        try:
+            value, fresh = read()
+        except CacheNotFound:
+            return self.single_flight.do(name, lambda: self._recompute(name, read, compute))
+
+        if not fresh and not self.single_flight.running(name):
+            self._refresher.submit(self._refresh, name, read, compute)
+
+        return value
+
+    def stale_copy(self, value):
+        return {'written_at': time.time(), 'value': value}
+
+    def from_stale_copy(self, copy):
+        if time.time() - copy['written_at'] > self.stale_ttl:
+            raise CacheNotFound('stale copy is older than {}s'.format(self.stale_ttl))
+
+        return copy['value']
+
+    def _refresh(self, name, read, compute):
+        try:
+            self.single_flight.do(name, lambda: self._recompute(name, read, compute))
+        except Exception as e:
+            self.app.log.error('could not refresh cache entry {}: {}'.format(name, e))
+
+    def _recompute(self, name, read, compute):
+        redis = self.app.cache.r
+        lock_key = self.lock_key.format(name)
+        token = uuid.uuid4().hex
+        if redis.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000)):
+            try:
+                return compute()
+            finally:
+                # only release our own lock, it may have expired and been taken over meanwhile
+                redis.eval(self.release_script, 1, lock_key, token)
+
+        deadline = time.monotonic() + self.lock_ttl
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            locked = redis.exists(lock_key)
+            try:
+                value, fresh = read()
+                if fresh:
+                    return value
+            except CacheNotFound:
+                pass
+
+            if not locked:
+                break
+
+        # the holder of the lock failed, was too slow or had nothing to cache
+        return compute()
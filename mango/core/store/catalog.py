@@ -0,0 +1,76 @@
+from collections import namedtuple
+import threading
+import time
+
+CatalogSnapshot = namedtuple('CatalogSnapshot', ['version', 'built_at', 'by_id', 'by_context'])
+
+
+class QuestionCatalog:
+    """
+    Versioned, in-memory index of the non-deleted questions, keyed by id and by `include_in` context.
+
+    A rebuild prepares a complete new snapshot and swaps it in with a single assignment, so readers never observe a
+    half built index. The snapshot is rebuilt lazily after `invalidate()` or once it is older than `max_age` seconds.
+    """
+    invalidation_key = 'CATALOG'
+
+    def __init__(self, db, app, max_age=300):
+        self.db = db
+        self.app = app
+        self.max_age = max_age
+        self._snapshot = None
+        self._version = 0
+        self._stale = True
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        snapshot = self._snapshot
+        if self._needs_rebuild(snapshot):
+            snapshot = self.rebuild()
+        return snapshot
+
+    @property
+    def version(self):
+        return self._version
+
+    def invalidate(self, key=None):
+        # also used as an InvalidationBus subscriber, only catalog wide invalidations are relevant here
+        if key in (None, self.invalidation_key):
+            self._stale = True
+
+    def rebuild(self):
+        with self._lock:
+            # another thread may have rebuilt it while we were waiting for the lock
+            if not self._needs_rebuild(self._snapshot):
+                return self._snapshot
+
+            # flag before reading, an invalidation arriving during the read must trigger another rebuild
+            self._stale = False
+            by_id = {}
+            by_context = {}
+            for question in self.db.find({'is_deleted': False}, {'weight': 1, 'include_in': 1}):
+                entry = {
+                    '_id': str(question['_id']),
+                    'weight': question['weight'],
+                    'include_in': tuple(question.get('include_in') or ()),
+                }
+                by_id[entry['_id']] = entry
+                for context in entry['include_in']:
+                    by_context.setdefault(context, {})[entry['_id']] = entry
+
+            self._version += 1
+            self._snapshot = CatalogSnapshot(version=self._version,
+                                             built_at=time.monotonic(),
+                                             by_id=by_id,
+                                             by_context=by_context)
+            self.app.log.info('question catalog v{} built with {} questions'.format(self._version, len(by_id)))
+            return self._snapshot
+
+    def get_questions(self, question_ids, include_in=None):
+        snapshot = self.snapshot
+        index = snapshot.by_context.get(include_in, {}) if include_in else snapshot.by_id
+        return [index[question_id] for question_id in question_ids if question_id in index]
+
+    def _needs_rebuild(self, snapshot):
+        return self._stale or snapshot is None or time.monotonic() - snapshot.built_at > self.max_age
@@ -0,0 +1,88 @@
+import msgpack
+import ujson
+import zlib
+
+# first byte of a tagged value. Values without one are plain JSON, as written by olive's CacheWrapper and by mango
+# before codecs: JSON text never starts with a control byte
+MSGPACK = 0x01
+MSGPACK_ZLIB = 0x02
+MSGPACK_ZSTD = 0x03
+MSGPACK_LZ4 = 0x04
+
+
+def _zstd():
+    # optional dependencies, only needed by the compressions that use them
+    import zstandard
+    return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+
+
+def _lz4():
+    import lz4.frame
+    return lz4.frame.compress, lz4.frame.decompress
+
+
+class CacheCodec:
+    """
+    Serializes cache values to bytes.
+
+    `format` is `json` (untagged, readable by every older replica) or `msgpack`, optionally compressed with `zlib`,
+    `zstd` or `lz4` when the encoded value is at least `threshold` bytes long. Every value is decoded according to its
+    own format byte whatever the configured format, so replicas writing different formats can share a Redis during a
+    rollout.
+    """
+    formats = ('json', 'msgpack')
+    compressions = {'zlib': MSGPACK_ZLIB, 'zstd': MSGPACK_ZSTD, 'lz4': MSGPACK_LZ4}
+
+    def __init__(self, format='json', compression=None, threshold=1024):
+        if format not in self.formats:
+            raise ValueError('unknown cache format {!r}, expected one of {}'.format(format, ', '.join(self.formats)))
+        if compression and compression not in self.compressions:
+            raise ValueError('unknown cache compression {!r}, expected one of {}'
+                             .format(compression, ', '.join(self.compressions)))
+        if compression and format != 'msgpack':
+            raise ValueError('cache compression requires the msgpack format')
+
+        self.format = format
+        self.compression = compression
+        self.threshold = threshold
+        # the fastest level: pages are short lived, compressing them costs request latency
+        self._compressors = {MSGPACK_ZLIB: (lambda data: zlib.compress(data, 1), zlib.decompress)}
+        if compression:
+            # fail at startup rather than on the first write when the library is missing
+            self._compressor(self.compressions[compression])
+
+    @classmethod
+    def from_config(cls, app):
+        codec_cfg = app.config['mango'].get('cache_codec') or {}
+        return cls(format=codec_cfg.get('format', 'json'),
+                   compression=codec_cfg.get('compression'),
+                   threshold=codec_cfg.get('threshold', 1024))
+
+    def encode(self, value):
+        if self.format == 'json':
+            return ujson.dumps(value).encode()
+
+        payload = msgpack.packb(value, use_bin_type=True)
+        if self.compression and len(payload) >= self.threshold:
+            tag = self.compressions[self.compression]
+            return bytes((tag,)) + self._compressor(tag)[0](payload)
+
+        return bytes((MSGPACK,)) + payload
+
+    def decode(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+
+        tag = data[0] if data else None
+        if tag == MSGPACK:
+            return msgpack.unpackb(data[1:], raw=False)
+        if tag in (MSGPACK_ZLIB, MSGPACK_ZSTD, MSGPACK_LZ4):
+            return msgpack.unpackb(self._compressor(tag)[1](data[1:]), raw=False)
+
+        return ujson.loads(data)
+
+    def _compressor(self, tag):
+        if tag not in self._compressors:
+            self._compressors[tag] = _zstd() if tag == MSGPACK_ZSTD else _lz4()
+
+        return self._compressors[tag]
@@ -0,0 +1,46 @@
+from pymongo.errors import OperationFailure
+
+
+def ensure_indexes(db, indexes, app):
+    """
+    Creates the declared `IndexModel`s of a collection, one by one so an index that cannot be built (e.g. a unique
+    index over duplicated data) is reported without preventing the others from being created. Returns the names of
+    the indexes that could not be created.
+    """
+    failed = []
+    for index in indexes:
+        name = index.document['name']
+        try:
+            db.create_indexes([index])
+            app.log.debug('index {}.{} ensured'.format(db.name, name))
+        except OperationFailure as of:
+            app.log.error('index {}.{} could not be created: {}'.format(db.name, name, of))
+            failed.append(name)
+
+    return failed
+
+
+def plan_stages(plan):
+    """Yields every stage name of an explain() `winningPlan` tree."""
+    # the slot based engine of newer servers nests the classic plan under `queryPlan`
+    plan = plan.get('queryPlan', plan)
+    yield plan['stage']
+    for child in plan.get('inputStages', []) + ([plan['inputStage']] if 'inputStage' in plan else []):
+        yield from plan_stages(child)
+
+
+def explain_query_shapes(db, query_shapes):
+    """
+    Runs explain() for each `(name, filter, sort)` query shape and returns `(name, stages)` tuples, where stages lists
+    the stage names of the winning plan, e.g. ['FETCH', 'IXSCAN'] or ['COLLSCAN'].
+    """
+    results = []
+    for name, query_filter, sort in query_shapes:
+        cursor = db.find(query_filter)
+        if sort:
+            cursor = cursor.sort(sort)
+
+        explanation = cursor.limit(50).explain()
+        results.append((name, list(plan_stages(explanation['queryPlanner']['winningPlan']))))
+
+    return results
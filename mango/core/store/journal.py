@@ -0,0 +1,200 @@
+from bson import ObjectId, json_util
+import threading
+import os
+
+
+class SurveyJournal:
+    """
+    Local write-behind journal of accepted surveys.
+
+    `append()` gives a survey its `_id`, writes it as one JSON line and fsyncs before returning, so an accepted survey
+    survives a crash. A background thread hands the pending surveys to `flush(documents)` in batches of `batch_size`
+    and records the journal offset up to which they are stored in a side file. On `open()` every entry after that
+    offset is pending again, flushing one twice is harmless because it keeps its `_id`. The journal is truncated
+    whenever everything in it has been flushed.
+
+    `flush(documents)` returns the documents that can never be stored (with the reason), those are moved to a
+    `.rejected` file for inspection, like the entries found corrupt on `open()`. Any exception it raises keeps the
+    batch pending and retries it after `retry_interval` seconds.
+
+    A journal file must only be used by one process at a time.
+    """
+
+    def __init__(self, app, path, name='surveys', batch_size=500, flush_interval=1.0, retry_interval=5.0):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        os.makedirs(path, exist_ok=True)
+        self.journal_path = os.path.join(path, '{}.jsonl'.format(name))
+        self.offset_path = os.path.join(path, '{}.offset'.format(name))
+        self.rejected_path = os.path.join(path, '{}.rejected'.format(name))
+        # (end offset, document) of every entry not flushed yet, in journal order
+        self._pending = []
+        self._by_reservation = {}
+        self._flushed_offset = 0
+        self._file = None
+        self._flush = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._flusher = None
+
+    @classmethod
+    def from_config(cls, app, worker_index=None):
+        write_behind_cfg = app.config['mango'].get('write_behind') or {}
+        return cls(app=app,
+                   path=write_behind_cfg.get('path', '/var/lib/mango/journal'),
+                   # pre-forked workers each own a journal, a restarted worker replays its own
+                   name='surveys' if worker_index is None else 'surveys-{}'.format(worker_index),
+                   batch_size=write_behind_cfg.get('batch_size', 500),
+                   flush_interval=write_behind_cfg.get('flush_interval', 1.0))
+
+    def open(self, flush):
+        """Loads the entries left unflushed by a previous run and starts flushing them with `flush`."""
+        self._flush = flush
+        self._flushed_offset = self._read_offset()
+        self._file = open(self.journal_path, 'ab+')
+        self._replay()
+        if self._pending:
+            self.app.log.info('{} unflushed surveys replayed from {}'.format(len(self._pending), self.journal_path))
+
+        self._flusher = threading.Thread(target=self._run, name='survey-journal', daemon=True)
+        self._flusher.start()
+        return self
+
+    def close(self):
+        """Stops the flusher after a last flush attempt, whatever is still pending is replayed by the next open()."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._flusher:
+            self._flusher.join()
+        if self._file:
+            self._file.close()
+
+    def append(self, document):
+        document.setdefault('_id', ObjectId())
+        line = (json_util.dumps(document) + '\n').encode()
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending.append((self._file.tell(), document))
+            if document.get('reservation_id'):
+                self._by_reservation[document['reservation_id']] = document
+            pending_count = len(self._pending)
+
+        if pending_count >= self.batch_size:
+            self._wakeup.set()
+
+        return document['_id']
+
+    def get_pending(self, reservation_id):
+        """The accepted survey of the reservation not flushed yet, or None."""
+        return self._by_reservation.get(reservation_id)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path) as offset_file:
+                return int(offset_file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset):
+        tmp_path = '{}.tmp'.format(self.offset_path)
+        with open(tmp_path, 'w') as offset_file:
+            offset_file.write(str(offset))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.replace(tmp_path, self.offset_path)
+        self._flushed_offset = offset
+
+    def _replay(self):
+        self._file.seek(0, os.SEEK_END)
+        if self._flushed_offset > self._file.tell():
+            self._write_offset(0)
+
+        self._file.seek(self._flushed_offset)
+        offset = self._flushed_offset
+        for line in self._file:
+            if not line.endswith(b'\n'):
+                # torn write of a survey that was never acknowledged
+                self.app.log.error('dropping incomplete journal entry at offset {}'.format(offset))
+                self._file.truncate(offset)
+                break
+
+            offset += len(line)
+            if not line.strip():
+                continue
+
+            try:
+                document = json_util.loads(line)
+            except ValueError as e:
+                self._reject([({'line': line.decode(errors='replace')},
+                               'corrupt journal entry at offset {}: {}'.format(offset - len(line), e))])
+                self._blank(offset - len(line), len(line))
+                continue
+
+            self._pending.append((offset, document))
+            if document.get('reservation_id'):
+                self._by_reservation[document['reservation_id']] = document
+
+        if not self._pending and offset > self._flushed_offset:
+            # only corrupt entries were left, they are set aside already
+            self._write_offset(0)
+            self._file.truncate(0)
+        self._file.seek(0, os.SEEK_END)
+
+    def _blank(self, offset, length):
+        # blanked out in place once set aside, so that the next open() skips it and offsets stay valid
+        with open(self.journal_path, 'r+b') as journal_file:
+            journal_file.seek(offset)
+            journal_file.write(b' ' * (length - 1))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def _reject(self, rejected):
+        with open(self.rejected_path, 'a') as rejected_file:
+            for document, reason in rejected:
+                rejected_file.write(json_util.dumps({'survey': document, 'reason': reason}) + '\n')
+        self.app.log.error('{} journaled surveys rejected, see {}'.format(len(rejected), self.rejected_path))
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                while self._pending:
+                    self._flush_batch()
+            except Exception as e:
+                self.app.log.error('could not flush {} journaled surveys, retrying in {}s: {}'
+                                   .format(len(self._pending), self.retry_interval, e))
+                self._stopped.wait(self.retry_interval)
+
+            if self._stopped.is_set():
+                return
+
+    def _flush_batch(self):
+        with self._lock:
+            batch = self._pending[:self.batch_size]
+
+        rejected = self._flush([document for _, document in batch])
+        if rejected:
+            self._reject(rejected)
+
+        self._write_offset(batch[-1][0])
+        with self._lock:
+            del self._pending[:len(batch)]
+            for _, document in batch:
+                if self._by_reservation.get(document.get('reservation_id')) is document:
+                    del self._by_reservation[document['reservation_id']]
+
+            if not self._pending:
+                # everything is stored, start over with an empty journal. The offset is reset first: a crash in
+                # between replays entries that are already stored, never skips new ones
+                self._write_offset(0)
+                self._file.truncate(0)
+                self._file.seek(0)
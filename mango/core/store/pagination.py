@@ -0,0 +1,71 @@
+from bson.errors import InvalidId
+from olive.exc import InvalidFilter
+from bson import ObjectId
+import binascii
+import datetime
+import base64
+import ujson
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'$date': value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and '$date' in value:
+        return datetime.datetime.fromisoformat(value['$date'])
+    if isinstance(value, dict) and '$oid' in value:
+        return ObjectId(value['$oid'])
+    return value
+
+
+def encode_cursor(sort_key, document):
+    """Returns the opaque continuation token pointing right after `document` in a listing ordered by `sort_key`."""
+    payload = {
+        'sort_key': sort_key,
+        'value': _encode_value(document.get(sort_key[1:])),
+        '_id': str(document['_id']),
+    }
+    return base64.urlsafe_b64encode(ujson.dumps(payload).encode()).decode()
+
+
+def decode_cursor(token, sort_key):
+    """Returns `(last_value, last_id)` of a token created by `encode_cursor` for the same `sort_key`."""
+    try:
+        payload = ujson.loads(base64.urlsafe_b64decode(token.encode()))
+        last_value, last_id = _decode_value(payload['value']), ObjectId(payload['_id'])
+    except (binascii.Error, ValueError, TypeError, KeyError, InvalidId):
+        raise InvalidFilter('invalid cursor given: {}'.format(token))
+
+    if payload.get('sort_key') != sort_key:
+        raise InvalidFilter('cursor was issued for sort_key {}, not {}'.format(payload.get('sort_key'), sort_key))
+
+    return last_value, last_id
+
+
+def keyset_filter(sort_key, last_value, last_id):
+    """
+    Range predicate selecting the documents after `(last_value, last_id)` for a listing sorted by `sort_key` then `_id`.
+
+    MongoDB orders missing/null values before any other value but range operators never match them, so nulls need
+    their own predicates.
+    """
+    field = sort_key[1:]
+    ascending = sort_key[:1] == '+'
+    operator = '$gt' if ascending else '$lt'
+
+    if last_value is None:
+        if ascending:
+            return {'$or': [{field: {'$ne': None}}, {field: None, '_id': {'$gt': last_id}}]}
+        return {field: None, '_id': {'$lt': last_id}}
+
+    predicates = [{field: {operator: last_value}}, {field: last_value, '_id': {operator: last_id}}]
+    if not ascending:
+        # nulls come last in a descending listing
+        predicates.append({field: None})
+
+    return {'$or': predicates}
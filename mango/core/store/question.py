@@ -1,18 +1,73 @@
 from olive.consts import DELETED_STATUS, ACTIVE_STATUS, INACTIVE_STATUS
 from olive.exc import SaveError, CacheNotFound, DocumentNotFound
+from bson import ObjectId
 from mango.core.models.question import QuestionSchema
-from olive.store.cache_wrapper import CacheWrapper
+from mango.core.models.reader import compile_reader
+from mango.core.store.cache import LocalCache, InvalidationBus, TieredCacheWrapper, CacheGeneration, \
+    PipelinedCacheWrapper, StampedeGuard
+from mango.core.store.catalog import QuestionCatalog
+from mango.core.store.indexes import ensure_indexes
 from olive.store.toolbox import to_object_id
+from pymongo import IndexModel
+import pymongo
 
 
 class QuestionStore:
+    indexes = [
+        # only non-deleted questions are ever listed, keep the index to those
+        IndexModel([('is_deleted', pymongo.ASCENDING), ('order', pymongo.ASCENDING)], name='active_questions',
+                   partialFilterExpression={'is_deleted': False}),
+        IndexModel([('include_in', pymongo.ASCENDING)], name='active_questions_include_in',
+                   partialFilterExpression={'is_deleted': False}),
+    ]
+
+    # representative (name, filter, sort) of every query the store runs, checked by `mango check-queries`
+    query_shapes = [
+        ('get_questions', {'is_deleted': False}, None),
+        ('get_question_by_id', {'_id': ObjectId()}, None),
+        ('get_questions_by_filters', {'_id': {'$in': [ObjectId(), ObjectId()]}, 'include_in': 'user_rate'}, None),
+        ('get_questions_by_include_in', {'is_deleted': False, 'include_in': 'user_rate'}, None),
+        ('get_rating_questions', {'_id': {'$in': [ObjectId(), ObjectId()]}, 'is_deleted': False,
+                                  'include_in': 'user_rate'}, None),
+    ]
+
     def __init__(self, db, app):
         self.app = app
         self.db = db
         self.question_schema = QuestionSchema(exclude_none_id=True)
+        # documents read back were validated on save, optionally skip marshmallow on the read paths
+        self.question_reader = None
+        if self.app.config['mango'].get('trusted_reads'):
+            self.question_reader = compile_reader(self.question_schema)
+
         self.cache_key = 'MANGO:QUESTION:{}'
         self.cache_questions_key = 'ALL'
-        self.cache_wrapper = CacheWrapper(self.app, self.cache_key)
+        self.cache_wrapper = PipelinedCacheWrapper(self.app, self.cache_key)
+        self.invalidation_bus = None
+        self.catalog = None
+
+        l1_cache_cfg = self.app.config['mango'].get('l1_cache') or {}
+        catalog_cfg = self.app.config['mango'].get('question_catalog') or {}
+        if l1_cache_cfg.get('enabled') or catalog_cfg.get('enabled'):
+            self.invalidation_bus = InvalidationBus(self.app, l1_cache_cfg.get('channel', 'MANGO:QUESTION:INVALIDATE'))
+
+        # optional in-process tier in front of redis, kept coherent across replicas through pub/sub
+        if l1_cache_cfg.get('enabled'):
+            self.cache_wrapper = TieredCacheWrapper(self.cache_wrapper,
+                                                    LocalCache(max_size=l1_cache_cfg.get('max_size', 1024),
+                                                               ttl=l1_cache_cfg.get('ttl', 60)),
+                                                    self.invalidation_bus)
+
+        # optional in-memory question index used to validate surveys without any I/O
+        if catalog_cfg.get('enabled'):
+            self.catalog = QuestionCatalog(self.db, self.app, max_age=catalog_cfg.get('max_age', 300))
+            self.invalidation_bus.subscribe(self.catalog.invalidate)
+
+        # the `ALL` key is namespaced by a generation number, bumping it invalidates the list with one INCR
+        questions_generation_key = self.cache_key.format('GENERATION:{}'.format(self.cache_questions_key))
+        self.questions_generation = CacheGeneration(self.app, questions_generation_key, self.invalidation_bus)
+        # optional single-flight recomputation of the `ALL` key, see `mango.stampede`
+        self.stampede_guard = StampedeGuard.from_config(self.app)
 
     def save(self, data):
         # raise validation error on invalid data
@@ -22,12 +77,11 @@ class QuestionStore:
             self.app.log.error('empty question payload cannot be saved.')
             raise SaveError
 
-        self.cache_wrapper.delete('ALL')
-
         self.app.log.debug('saving clean question:\n{}'.format(clean_data))
         question_id = self.db.save(clean_data)
         clean_data['_id'] = str(question_id)
-        self.cache_wrapper.delete(self.cache_questions_key)
+        self.questions_generation.bump()
+        self._invalidate_catalog()
         return str(question_id)
 
     def update(self, question_id, question):
@@ -50,8 +104,9 @@ class QuestionStore:
                                                                                         modified_count))
         if modified_count:
             question['_id'] = str(question_id)
-            self.cache_wrapper.write_cache(question_id, question)
-            self.cache_wrapper.delete(self.cache_questions_key)
+            # the question and the list generation in one round-trip
+            self.cache_wrapper.write_many({question_id: question}, generations=[self.questions_generation])
+            self._invalidate_catalog()
 
         return modified_count
 
@@ -70,7 +125,7 @@ class QuestionStore:
             if not question_doc['is_deleted']:
                 self.cache_wrapper.write_cache(question_id, question_doc)
 
-        clean_data = self.question_schema.load(question_doc)
+        clean_data = self._load(question_doc)
         return clean_data
 
     # TODO: zoodroom-backend compatibility
@@ -95,17 +150,34 @@ class QuestionStore:
             filter_args["include_in"] = include_in
 
         questions = list(self.db.find(filter=filter_args, projection=project))
-        return self.question_schema.load(questions, many=True, partial=partial)
+        return self._load(questions, many=True, partial=partial)
+
+    def get_rating_questions(self, question_ids, include_in=None):
+        """Returns `_id` and `weight` of the given questions, served from the in-memory catalog when enabled."""
+        if not self.catalog:
+            # deleted questions are not rated, like the catalog leaves them out
+            filter_args = {'_id': {'$in': [to_object_id(i) for i in question_ids]}, 'is_deleted': False}
+            if include_in:
+                filter_args['include_in'] = include_in
+
+            questions = list(self.db.find(filter=filter_args, projection=['weight']))
+            return self._load(questions, many=True, partial=('order', 'include_in', 'title'))
+
+        # keep raising InvalidObjectId on malformed ids like the database path does
+        for question_id in question_ids:
+            to_object_id(question_id)
+
+        return self.catalog.get_questions(question_ids, include_in=include_in)
 
     def delete(self, question_id):
         question_id = to_object_id(question_id)
-        self.cache_wrapper.delete(question_id)
-        self.cache_wrapper.delete('ALL')
         update_result = self.db.update({'_id': question_id}, {'$set': {'is_deleted': True}})
         modified_count = update_result['nModified']
 
+        # the question and, when it was deleted now, the list generation in one round-trip
+        self.cache_wrapper.delete_many([question_id], generations=[self.questions_generation] if modified_count else [])
         if modified_count:
-            self.cache_wrapper.delete(self.cache_questions_key)
+            self._invalidate_catalog()
 
         self.app.log.info('question {} deletion result: {}'.format(question_id, update_result))
 
@@ -113,14 +185,72 @@ class QuestionStore:
         return update_result.get('nModified', 0)
 
     def get_questions(self):
+        generations = []
+
+        def read():
+            generation, cached_questions = self._get_cached_questions()
+            generations.append(generation)
+            if cached_questions is None:
+                raise CacheNotFound('{} not found in cache'.format(self.cache_questions_key))
+            return cached_questions
+
+        def compute():
+            self.app.log.debug('reading questions directly from database')
+            questions_cursor = self.db.find({'is_deleted': False}, {'created_at': 0, 'is_deleted': 0})
+            questions_docs = self._load(questions_cursor, many=True)
+            if questions_docs:
+                self._write_cached_questions('{}:{}'.format(self.cache_questions_key, generations[-1]),
+                                             questions_docs)
+            return questions_docs
+
+        if self.stampede_guard:
+            return self.stampede_guard.fetch(self.cache_key.format(self.cache_questions_key), read, compute)
+
         try:
-            questions_docs = self.cache_wrapper.get_cache(self.cache_questions_key)
+            return read()[0]
         except CacheNotFound:
-            self.app.log.debug('reading questions directly from database')
-            questions_cursor = self.db.find({'is_deleted': {'$ne': True}}, {'created_at': 0, 'is_deleted': 0})
-            questions_docs = self.question_schema.load(questions_cursor, many=True)
-            if not questions_docs:
-                return questions_docs
-            self.cache_wrapper.write_cache(self.cache_questions_key, questions_docs)
+            return compute()
+
+    def _get_cached_questions(self):
+        """
+        Returns `(generation, (questions, fresh))` of the cached list, or `(generation, None)`. The questions
+        generation, the list and its stale copy are read in one round-trip.
+        """
+        questions_cache_key = self.cache_questions_key + ':{}'
+        stale_key = '{}:STALE'.format(self.cache_questions_key)
+        keys = [stale_key] if self.stampede_guard and self.stampede_guard.stale_ttl else []
+
+        generation, cached = self.cache_wrapper.get_many_in_generation(self.questions_generation,
+                                                                       [questions_cache_key], keys)
+        questions_cache_key = questions_cache_key.format(generation)
+        if questions_cache_key in cached:
+            return generation, (cached[questions_cache_key], True)
+        if stale_key in cached:
+            return generation, (self.stampede_guard.from_stale_copy(cached[stale_key]), False)
+
+        return generation, None
+
+    def _write_cached_questions(self, questions_cache_key, questions_docs):
+        if not self.stampede_guard or not self.stampede_guard.stale_ttl:
+            return self.cache_wrapper.write_cache(questions_cache_key, questions_docs)
+
+        self.cache_wrapper.write_many({questions_cache_key: questions_docs,
+                                       '{}:STALE'.format(self.cache_questions_key):
+                                           self.stampede_guard.stale_copy(questions_docs)})
+
+    def _load(self, question_docs, many=False, partial=None):
+        if not self.question_reader:
+            return self.question_schema.load(question_docs, many=many, partial=partial)
+
+        if many:
+            return [self.question_reader(question_doc) for question_doc in question_docs]
+
+        return self.question_reader(question_docs)
+
+    def ensure_indexes(self):
+        return ensure_indexes(self.db, self.indexes, self.app)
 
-        return questions_docs
+    def _invalidate_catalog(self):
+        if self.catalog:
+            self.catalog.invalidate()
+            self.invalidation_bus.publish(self.catalog.invalidation_key)
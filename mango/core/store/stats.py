@@ -0,0 +1,233 @@
+from olive.exc import DocumentNotFound, InvalidFilter
+from pymongo.errors import BulkWriteError
+from pymongo import UpdateOne
+import datetime
+import ujson
+import math
+import time
+
+
+class SurveyStatsStore:
+    """
+    Running rating aggregates of surveys: count, sum, sum of squares and a histogram of the ratings.
+
+    Aggregates are kept per question (question rating), platform and status (survey total_rating), both per day and in
+    an `ALL` bucket, under a deterministic `_id` so answering any of them is a single primary key lookup.
+
+    The aggregates are written after the surveys, not atomically with them. Updates that could not be written are
+    kept in a Redis list, the outbox, and written again by a later successful `record_many()` of any process: they
+    are applied at least once. An update failing with a connection error may have been applied already and is then
+    counted twice, run `mango rebuild-stats` if the aggregates drifted.
+    """
+    dimensions = ('question', 'platform', 'status')
+    all_days = 'ALL'
+    day_format = '%Y-%m-%d'
+    outbox_key = 'MANGO:SURVEY_STATS:OUTBOX'
+    # seconds between two looks at the outbox
+    outbox_interval = 10.0
+
+    def __init__(self, db, app):
+        self.app = app
+        self.db = db
+        self._next_outbox_check = 0
+
+    @staticmethod
+    def _stats_id(dimension, key, day):
+        return '{}:{}:{}'.format(dimension, key, day)
+
+    @staticmethod
+    def _ratings(survey):
+        for question in survey.get('questions') or []:
+            yield 'question', question['question_id'], question['rating']
+
+        if survey.get('total_rating') is not None:
+            yield 'platform', survey.get('platform', ''), survey['total_rating']
+            yield 'status', survey.get('status', ''), survey['total_rating']
+
+    def _day(self, survey):
+        created_at = survey.get('created_at')
+        if not isinstance(created_at, datetime.datetime):
+            created_at = survey['_id'].generation_time if survey.get('_id') else datetime.datetime.utcnow()
+        return created_at.strftime(self.day_format)
+
+    def updates(self, surveys):
+        """`(filter, update)` of the upserts adding the ratings of the given saved surveys to their aggregates."""
+        updates = []
+        for survey in surveys:
+            day = self._day(survey)
+            for dimension, key, rating in self._ratings(survey):
+                increments = {
+                    'count': 1,
+                    'sum': rating,
+                    'sum_sq': rating * rating,
+                    'histogram.{}'.format(rating): 1,
+                }
+                for bucket in (day, self.all_days):
+                    updates.append(({'_id': self._stats_id(dimension, key, bucket)},
+                                    {'$inc': increments,
+                                     '$setOnInsert': {'dimension': dimension, 'key': key, 'day': bucket}}))
+
+        return updates
+
+    @staticmethod
+    def upserts(updates):
+        return [UpdateOne(update_filter, update, upsert=True) for update_filter, update in updates]
+
+    def operations(self, surveys):
+        """Upserts adding the ratings of the given saved surveys to their aggregates."""
+        return self.upserts(self.updates(surveys))
+
+    def rating_change_operations(self, survey, total_rating):
+        """Upserts moving the platform and status aggregates of a saved survey from its rating to `total_rating`."""
+        day = self._day(survey)
+        old_rating = survey.get('total_rating')
+        increments = {}
+        for rating, sign in ((old_rating, -1), (total_rating, 1)):
+            if rating is None:
+                continue
+            increments['count'] = increments.get('count', 0) + sign
+            increments['sum'] = increments.get('sum', 0) + sign * rating
+            increments['sum_sq'] = increments.get('sum_sq', 0) + sign * rating * rating
+            histogram_key = 'histogram.{}'.format(rating)
+            increments[histogram_key] = increments.get(histogram_key, 0) + sign
+
+        operations = []
+        for dimension in ('platform', 'status'):
+            key = survey.get(dimension, '')
+            for bucket in (day, self.all_days):
+                operations.append(UpdateOne(
+                    {'_id': self._stats_id(dimension, key, bucket)},
+                    {'$inc': increments, '$setOnInsert': {'dimension': dimension, 'key': key, 'day': bucket}},
+                    upsert=True))
+
+        return operations
+
+    def record_many(self, surveys):
+        """
+        Adds the ratings of the given saved surveys to the aggregates with one unordered bulk write. On failure the
+        updates not written are moved to the outbox and the error is raised.
+        """
+        updates = self.updates(surveys)
+        if updates:
+            self._write(updates)
+
+        if time.monotonic() >= self._next_outbox_check:
+            self._next_outbox_check = time.monotonic() + self.outbox_interval
+            self.flush_outbox()
+
+    def flush_outbox(self, batch_size=1000):
+        """Writes the updates of the outbox, returns their number."""
+        count = 0
+        while True:
+            pipeline = self.app.cache.r.pipeline(transaction=True)
+            self.queue_outbox_pop(pipeline, batch_size)
+            updates = self.outbox_updates(pipeline.execute())
+            if not updates:
+                return count
+
+            self._write(updates)
+            count += len(updates)
+            self.app.log.info('{} survey stats updates written from the outbox'.format(len(updates)))
+
+    def queue_outbox_pop(self, pipeline, batch_size=1000):
+        """Queues the pop of up to `batch_size` updates of the outbox on a transaction `pipeline`."""
+        pipeline.lrange(self.outbox_key, 0, batch_size - 1)
+        pipeline.ltrim(self.outbox_key, batch_size, -1)
+
+    @staticmethod
+    def outbox_updates(results):
+        """The updates popped by the results of a `queue_outbox_pop()` pipeline."""
+        entries, _ = results
+        return [tuple(ujson.loads(entry)) for entry in entries]
+
+    @staticmethod
+    def outbox_entries(updates):
+        return [ujson.dumps(update) for update in updates]
+
+    def defer(self, updates, error):
+        """Moves the given updates to the outbox after a failed write of `error`."""
+        self.app.cache.r.rpush(self.outbox_key, *self.outbox_entries(updates))
+        self.app.log.error('{} survey stats updates moved to the outbox: {}'.format(len(updates), error))
+
+    @staticmethod
+    def failed_updates(updates, error):
+        """The updates of a failed bulk write of `updates` which were not written."""
+        if isinstance(error, BulkWriteError):
+            return [updates[write_error['index']] for write_error in error.details['writeErrors']]
+        return updates
+
+    def _write(self, updates):
+        try:
+            self.db.bulk_write(self.upserts(updates), ordered=False)
+        except Exception as e:
+            self.defer(self.failed_updates(updates, e), e)
+            raise
+
+    def record(self, survey):
+        self.record_many([survey])
+
+    def get(self, dimension, key, day=None):
+        if dimension not in self.dimensions:
+            raise InvalidFilter('invalid dimension given: {}, it should be one of {}'
+                                .format(dimension, ', '.join(self.dimensions)))
+
+        stats_doc = self.db.find_one({'_id': self._stats_id(dimension, key, day or self.all_days)})
+        if not stats_doc:
+            raise DocumentNotFound('no {} stats found for {} on {}'.format(dimension, key, day or self.all_days))
+
+        count = stats_doc['count']
+        # every rating of the aggregate may have been moved away by a recompute
+        mean = stats_doc['sum'] / count if count > 0 else 0.0
+        return {
+            'dimension': dimension,
+            'key': key,
+            'day': stats_doc['day'],
+            'count': count,
+            'mean': mean,
+            'stddev': math.sqrt(max(stats_doc['sum_sq'] / count - mean * mean, 0.0)) if count > 0 else 0.0,
+            'histogram': [{'rating': int(rating), 'count': rating_count}
+                          for rating, rating_count in sorted(stats_doc['histogram'].items(), key=lambda i: int(i[0]))],
+        }
+
+    def rebuild(self, survey_db, batch_size=1000):
+        """
+        Recomputes every aggregate from the survey collection into a temporary collection which then atomically
+        replaces the live one. Ratings recorded while it runs are lost, run it while survey writes are paused.
+        Returns the number of surveys read.
+        """
+        # the updates left in the outbox are part of the recomputed aggregates
+        self.app.cache.r.delete(self.outbox_key)
+        aggregates = {}
+        survey_count = 0
+        surveys = survey_db.find({}, projection={'questions': 1, 'total_rating': 1, 'platform': 1, 'status': 1,
+                                                 'created_at': 1}, batch_size=batch_size)
+        for survey in surveys:
+            survey_count += 1
+            day = self._day(survey)
+            for dimension, key, rating in self._ratings(survey):
+                for bucket in (day, self.all_days):
+                    stats_id = self._stats_id(dimension, key, bucket)
+                    stats_doc = aggregates.get(stats_id)
+                    if stats_doc is None:
+                        stats_doc = aggregates[stats_id] = {'_id': stats_id, 'dimension': dimension, 'key': key,
+                                                            'day': bucket, 'count': 0, 'sum': 0, 'sum_sq': 0,
+                                                            'histogram': {}}
+                    stats_doc['count'] += 1
+                    stats_doc['sum'] += rating
+                    stats_doc['sum_sq'] += rating * rating
+                    stats_doc['histogram'][str(rating)] = stats_doc['histogram'].get(str(rating), 0) + 1
+
+        self.app.log.info('{} surveys aggregated into {} stats documents'.format(survey_count, len(aggregates)))
+
+        staging = self.db.database['{}_rebuild'.format(self.db.name)]
+        staging.drop()
+        stats_docs = list(aggregates.values())
+        for i in range(0, len(stats_docs), batch_size):
+            staging.insert_many(stats_docs[i:i + batch_size], ordered=False)
+
+        if stats_docs:
+            staging.rename(self.db.name, dropTarget=True)
+        else:
+            self.db.drop()
+
+        return survey_count
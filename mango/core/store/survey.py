@@ -1,20 +1,89 @@
 from olive.exc import SaveError, CacheNotFound, DocumentNotFound
-from olive.store.cache_wrapper import CacheWrapper
+from mango.core.store.pagination import encode_cursor, decode_cursor, keyset_filter
+from mango.core.store.cache import CacheGeneration, PipelinedCacheWrapper, StampedeGuard
+from mango.core.store.indexes import ensure_indexes
+from mango.core.store.bloom import BloomFilter
 from mango.core.models.survey import SurveySchema
+from mango.core.models.reader import compile_reader
+from olive.store.toolbox import to_object_id
 from olive.toolbox import generate_sha256
+from marshmallow import ValidationError
 from olive.exc import InvalidFilter
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from bson import ObjectId
+from pymongo import IndexModel, UpdateOne
+from concurrent import futures
 from pprint import pformat
+import traceback
+import datetime
 import pymongo
 
 
 class SurveyStore:
-    def __init__(self, db, app):
+    indexes = [
+        # one survey per reservation, surveys saved without reservation are not constrained
+        IndexModel([('reservation_id', pymongo.ASCENDING)], name='reservation_id_unique', unique=True,
+                   partialFilterExpression={'reservation_id': {'$type': 'string', '$gt': ''}}),
+        # default listing order, `_id` breaks ties for keyset pagination
+        IndexModel([('total_rating', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], name='total_rating_id'),
+        IndexModel([('status', pymongo.ASCENDING), ('total_rating', pymongo.ASCENDING)], name='status_total_rating'),
+        # equality, sort (default `total_rating` listing), then range fields, for the local reservation filters
+        IndexModel([('city', pymongo.ASCENDING), ('total_rating', pymongo.ASCENDING),
+                    ('checkout_date', pymongo.ASCENDING)], name='city_total_rating_checkout_date'),
+        IndexModel([('complex', pymongo.ASCENDING), ('total_rating', pymongo.ASCENDING),
+                    ('checkout_date', pymongo.ASCENDING)], name='complex_total_rating_checkout_date'),
+        IndexModel([('checkout_date', pymongo.ASCENDING), ('total_rating', pymongo.ASCENDING)],
+                   name='checkout_date_total_rating'),
+    ]
+
+    # representative (name, filter, sort) of every query the store runs, checked by `mango check-queries`
+    query_shapes = [
+        ('get_by_reservation_id', {'reservation_id': '12'}, None),
+        ('get_by_reservation_ids', {'reservation_id': {'$in': ['12', '13']}}, None),
+        ('get_surveys', {}, [('total_rating', pymongo.ASCENDING)]),
+        ('get_surveys_page', {'$or': [{'total_rating': {'$gt': 3}}, {'total_rating': 3, '_id': {'$gt': ObjectId()}}]},
+         [('total_rating', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]),
+        ('get_surveys_by_status', {'status': 'published'}, [('total_rating', pymongo.ASCENDING)]),
+        ('get_surveys_by_city', {'city': 'tehran', 'checkout_date': {'$gte': '2019-08-01', '$lte': '2019-08-31'}},
+         [('total_rating', pymongo.ASCENDING)]),
+        ('get_surveys_by_complex', {'complex': '12', 'checkout_date': {'$gte': '2019-08-01'}},
+         [('total_rating', pymongo.ASCENDING)]),
+        ('get_surveys_by_checkout', {'checkout_date': {'$gte': '2019-08-01', '$lte': '2019-08-31'}},
+         [('total_rating', pymongo.ASCENDING)]),
+    ]
+
+    stream_batch_limit = 1000
+    # journaled surveys are published to the other processes under `PENDING:<reservation_id>` until stored
+    pending_ttl = 86400
+
+    def __init__(self, db, app, stats_store=None):
         self.app = app
         self.db = db
+        self.stats_store = stats_store
         self.survey_schema = SurveySchema(exclude_none_id=True)
+        # documents read back were validated on save, optionally skip marshmallow on the read paths
+        self.survey_reader = None
+        if self.app.config['mango'].get('trusted_reads'):
+            self.survey_reader = compile_reader(self.survey_schema)
+
         self.cache_key = 'MANGO:SURVEY:{}'
         self.get_surveys_cache_key = 'GET_SURVEYS:{}'
-        self.cache_wrapper = CacheWrapper(self.app, self.cache_key)
+        self.cache_wrapper = PipelinedCacheWrapper(self.app, self.cache_key)
+        # listing keys are namespaced by a generation number, bumping it invalidates all of them with one INCR
+        self.surveys_generation = CacheGeneration(self.app, self.cache_key.format('GENERATION:GET_SURVEYS'))
+        # optional single-flight recomputation of listing pages, see `mango.stampede`
+        self.stampede_guard = StampedeGuard.from_config(self.app)
+        self.journal = None
+
+        # optional bloom filter of the reservations having a survey, with short lived "no survey" cache entries
+        reservation_filter_cfg = self.app.config['mango'].get('reservation_filter') or {}
+        self.reservation_filter = None
+        self.negative_ttl = 0
+        if reservation_filter_cfg.get('enabled'):
+            self.reservation_filter = BloomFilter(self.app, self.cache_key.format('RESERVATION_FILTER'),
+                                                  capacity=reservation_filter_cfg.get('capacity', 5000000),
+                                                  error_rate=reservation_filter_cfg.get('error_rate', 0.001))
+            self.negative_ttl = reservation_filter_cfg.get('negative_ttl', 60)
 
     def save(self, data):
         # raise validation error on invalid data
@@ -24,34 +93,228 @@ class SurveyStore:
             self.app.log.error('empty survey payload cannot be saved.')
             raise SaveError
 
+        if self.journal is not None:
+            # write-behind: acknowledged once journaled, stored and announced by the journal flusher
+            reservation_id = clean_data.get('reservation_id')
+            clean_data.setdefault('_id', ObjectId())
+            if reservation_id and not self._claim_reservation(clean_data):
+                raise SaveError('survey of reservation {} already exists'.format(reservation_id))
+
+            try:
+                survey_id = self.journal.append(clean_data)
+            except Exception:
+                if reservation_id:
+                    self.cache_wrapper.delete('PENDING:{}'.format(reservation_id))
+                raise
+
+            self._index_reservations([clean_data])
+            return str(survey_id)
+
         self.app.log.debug('saving clean survey:\n{}'.format(clean_data))
-        survey_id = self.db.save(clean_data)
+        try:
+            survey_id = self.db.save(clean_data)
+        except DuplicateKeyError:
+            raise SaveError('survey of reservation {} already exists'.format(clean_data.get('reservation_id')))
 
-        # purge all survey caches with filters
-        self.cache_wrapper.delete_by_pattern('{}*'.format(self.cache_key.format(self.get_surveys_cache_key.format(''))))
+        # invalidate all survey caches with filters
+        self.surveys_generation.bump()
+        self._index_reservations([clean_data])
+        self._record_stats([clean_data])
 
         return str(survey_id)
 
-    def get_by_reservation_id(self, reservation_id):
+    def save_many(self, surveys):
+        """
+        Validates and inserts surveys with a single unordered insert_many, invalidating survey listing caches once.
+
+        Returns one entry per given survey, in order: the new survey id, or the ValidationError/SaveError that
+        prevented it from being saved. With write-behind on, the reservations are claimed like `save()` does, a survey
+        whose reservation has a journaled survey in any process is refused.
+        """
+        results = [None] * len(surveys)
+        documents = []
+        positions = []
+        for position, data in enumerate(surveys):
+            try:
+                # raise validation error on invalid data
+                self.survey_schema.load(data)
+            except ValidationError as ve:
+                results[position] = ve
+                continue
+
+            clean_data = self.survey_schema.dump(data)
+            if not clean_data:
+                results[position] = SaveError('empty survey payload cannot be saved.')
+                continue
+
+            if self.journal is not None and clean_data.get('reservation_id'):
+                # a survey journaled by `save()` is not in the collection yet, its claim keeps this one out
+                clean_data.setdefault('_id', ObjectId())
+                if not self._claim_reservation(clean_data):
+                    results[position] = SaveError('survey of reservation {} already exists'
+                                                  .format(clean_data['reservation_id']))
+                    continue
+
+            documents.append(clean_data)
+            positions.append(position)
+
+        if not documents:
+            return results
+
+        self.app.log.debug('bulk saving {} clean surveys'.format(len(documents)))
+        failed = {}
         try:
-            survey_doc = self.cache_wrapper.get_cache('BY_RESERVATION:{}'.format(reservation_id))
-        except CacheNotFound:
+            # insert_many sets `_id` on every document before sending the batch
+            self.db.insert_many(documents, ordered=False)
+        except BulkWriteError as bwe:
+            failed = {error['index']: error['errmsg'] for error in bwe.details['writeErrors']}
+            self.app.log.error('{} surveys of the batch could not be saved'.format(len(failed)))
+        finally:
+            if self.journal is not None:
+                # stored or not, they are not pending anymore
+                self.cache_wrapper.delete_many(['PENDING:{}'.format(document['reservation_id'])
+                                                for document in documents if document.get('reservation_id')])
+
+        for index, (position, document) in enumerate(zip(positions, documents)):
+            results[position] = SaveError(failed[index]) if index in failed else str(document['_id'])
+
+        if len(failed) < len(documents):
+            # invalidate all survey caches with filters
+            self.surveys_generation.bump()
+            saved = [document for index, document in enumerate(documents) if index not in failed]
+            self._index_reservations(saved)
+            self._record_stats(saved)
+
+        return results
+
+    def get_by_reservation_id(self, reservation_id):
+        pending_doc = self.journal.get_pending(reservation_id) if self.journal is not None else None
+        if pending_doc:
+            return self._load(self._pending_survey(pending_doc))
+
+        if self.reservation_filter and not self.reservation_filter.might_contain(reservation_id):
+            raise DocumentNotFound("Document with reservation_id {} not found!".format(reservation_id))
+
+        survey_key = 'BY_RESERVATION:{}'.format(reservation_id)
+        pending_key = 'PENDING:{}'.format(reservation_id)
+        no_survey_key = 'NO_SURVEY:{}'.format(reservation_id)
+        keys = [survey_key]
+        if self.journal is not None:
+            # journaled by another process
+            keys.append(pending_key)
+        if self.negative_ttl:
+            keys.append(no_survey_key)
+        cached = self.cache_wrapper.get_many(keys)
+        if survey_key in cached:
+            survey_doc = cached[survey_key]
+        elif pending_key in cached:
+            survey_doc = cached[pending_key]
+        elif no_survey_key in cached:
+            raise DocumentNotFound("Document with reservation_id {} not found!".format(reservation_id))
+        else:
             self.app.log.debug('reading directly from database')
             survey_doc = self.db.find_one({'reservation_id': reservation_id}, {'created_at': 0, 'updated_at': 0})
             if not survey_doc:
+                if self.negative_ttl:
+                    self.cache_wrapper.write_cache(no_survey_key, True, expire_time=self.negative_ttl)
                 raise DocumentNotFound("Document with reservation_id {} not found!".format(reservation_id))
 
             survey_doc['_id'] = str(survey_doc['_id'])
-            self.cache_wrapper.write_cache('BY_RESERVATION:{}'.format(reservation_id), survey_doc)
+            self.cache_wrapper.write_cache(survey_key, survey_doc)
 
-        clean_data = self.survey_schema.load(survey_doc)
+        clean_data = self._load(survey_doc)
         return clean_data
 
+    def get_by_reservation_ids(self, reservation_ids):
+        """
+        Batch `get_by_reservation_id`: one bloom filter check, one MGET of the cached surveys and one `$in` query for
+        the cache misses, which are then cached with one pipeline. Returns the surveys found, in the order of
+        `reservation_ids`, and the reservation ids without survey.
+        """
+        reservation_ids = list(dict.fromkeys(reservation_ids))
+        survey_docs = {}
+        if self.journal is not None:
+            for reservation_id in reservation_ids:
+                pending_doc = self.journal.get_pending(reservation_id)
+                if pending_doc:
+                    survey_docs[reservation_id] = self._pending_survey(pending_doc)
+
+        candidates = [reservation_id for reservation_id in reservation_ids if reservation_id not in survey_docs]
+        if self.reservation_filter and candidates:
+            candidates = [reservation_id for reservation_id, might_exist
+                          in zip(candidates, self.reservation_filter.might_contain_many(candidates)) if might_exist]
+
+        keys = ['BY_RESERVATION:{}'.format(reservation_id) for reservation_id in candidates]
+        if self.journal is not None:
+            keys += ['PENDING:{}'.format(reservation_id) for reservation_id in candidates]
+        if self.negative_ttl:
+            keys += ['NO_SURVEY:{}'.format(reservation_id) for reservation_id in candidates]
+        cached = self.cache_wrapper.get_many(keys) if keys else {}
+
+        misses = []
+        for reservation_id in candidates:
+            if 'BY_RESERVATION:{}'.format(reservation_id) in cached:
+                survey_docs[reservation_id] = cached['BY_RESERVATION:{}'.format(reservation_id)]
+            elif 'PENDING:{}'.format(reservation_id) in cached:
+                survey_docs[reservation_id] = cached['PENDING:{}'.format(reservation_id)]
+            elif 'NO_SURVEY:{}'.format(reservation_id) not in cached:
+                misses.append(reservation_id)
+
+        if misses:
+            self.app.log.debug('reading {} surveys directly from database'.format(len(misses)))
+            found = {}
+            for survey_doc in self.db.find({'reservation_id': {'$in': misses}}, {'created_at': 0, 'updated_at': 0}):
+                survey_doc['_id'] = str(survey_doc['_id'])
+                found[survey_doc['reservation_id']] = survey_doc
+
+            if found:
+                self.cache_wrapper.write_many({'BY_RESERVATION:{}'.format(reservation_id): survey_doc
+                                               for reservation_id, survey_doc in found.items()})
+            if self.negative_ttl and len(found) < len(misses):
+                self.cache_wrapper.write_many({'NO_SURVEY:{}'.format(reservation_id): True
+                                               for reservation_id in misses if reservation_id not in found},
+                                              expire_time=self.negative_ttl)
+            survey_docs.update(found)
+
+        surveys = self._load([survey_docs[reservation_id]
+                              for reservation_id in reservation_ids if reservation_id in survey_docs], many=True)
+        not_found = [reservation_id for reservation_id in reservation_ids if reservation_id not in survey_docs]
+        return surveys, not_found
+
     def stream_surveys(self):
-        surveys = self.db.find({})
+        surveys = self.db.find({}, projection={'created_at': 0, 'updated_at': 0}, batch_size=self.stream_batch_limit)
         for survey in surveys:
-            self.app.log.debug('yielding survey document: {}'.format(survey['_id']))
-            yield self.survey_schema.load(survey)
+            yield self._load(survey)
+
+    def stream_survey_batches(self, query=None, resume_after=None, batch_size=100):
+        """
+        Yields `(surveys, last_id)` tuples of up to `batch_size` surveys in `_id` order. A stream can be resumed by
+        passing the `last_id` of the last batch received as `resume_after`.
+
+        Only one batch is held at a time: the next one is read from the cursor when the consumer asks for it.
+        """
+        query = dict(query or {})
+        batch_size = max(1, min(batch_size or 100, self.stream_batch_limit))
+        if resume_after:
+            query['_id'] = {'$gt': to_object_id(resume_after)}
+
+        cursor = self.db.find(filter=query,
+                              projection={'created_at': 0, 'updated_at': 0},
+                              sort=[('_id', pymongo.ASCENDING)],
+                              batch_size=batch_size)
+        try:
+            batch = []
+            for survey in cursor:
+                batch.append(survey)
+                if len(batch) == batch_size:
+                    yield self._load(batch, many=True), str(batch[-1]['_id'])
+                    batch = []
+
+            if batch:
+                yield self._load(batch, many=True), str(batch[-1]['_id'])
+        finally:
+            # release the server side cursor when the consumer goes away mid-stream
+            cursor.close()
 
     def get_surveys(self, skip, limit, query=None, sort_key='+total_rating', ignore_cache=False):
         query = query or {}
@@ -63,44 +326,340 @@ class SurveyStore:
 
         cache_key = generate_sha256(plain_cache_key)
 
-        try:
-            if ignore_cache:
-                self.app.log.debug('ignoring cache requested')
-                raise CacheNotFound
-
-            survey_docs = self.cache_wrapper.get_cache(self.get_surveys_cache_key
-                                                       .format(cache_key))
-            total_count = self.cache_wrapper.get_cache(self.get_surveys_cache_key
-                                                       .format('{}:COUNT'.format(cache_key)))['total_count']
-        except CacheNotFound:
+        def load():
             self.app.log.debug('reading surveys directly from database by below filters...')
             self.app.log.info('skip={} limit={} sort_key={}'.format(skip, limit, sort_key))
 
-            sort_direction = {
-                '-': pymongo.DESCENDING,
-                '+': pymongo.ASCENDING
-            }
-            if sort_key[:1] not in sort_direction.keys():
-                raise InvalidFilter('invalid sort_key given: {}, it should start with - or +'.format(sort_key))
-
             survey_docs_cursor = self.db.find(filter=query,
                                               projection={'created_at': 0, 'updated_at': 0},
                                               skip=skip,
                                               limit=limit,
-                                              sort=[(sort_key[1:], sort_direction[sort_key[:1]])])
+                                              sort=self._sort_spec(sort_key))
 
             total_count = survey_docs_cursor.count()
+            return self._load(survey_docs_cursor, many=True), {'total_count': total_count}
+
+        if ignore_cache:
+            self.app.log.debug('ignoring cache requested')
+            survey_docs, page_info = load()
+        else:
+            survey_docs, page_info = self._cached_page(cache_key, load)
+
+        if survey_docs:
+            self.app.log.info('surveys result: \n{}'.format(pformat(survey_docs)))
+
+        return page_info['total_count'], survey_docs
+
+    def get_surveys_page(self, limit, query=None, sort_key='+total_rating', cursor=None, ignore_cache=False):
+        """
+        Keyset paginated listing: returns `(total_count, surveys, next_cursor)`.
+
+        `cursor` is the `next_cursor` of the previous page (None for the first one). Pages are selected with a range
+        predicate on `(sort_key, _id)` instead of skip, so every page costs the same however deep it is.
+        `next_cursor` is empty on the last page.
+        """
+        query = query or {}
+        limit = min(limit or 50, 200)
+        sort = self._sort_spec(sort_key)
+
+        plain_cache_key = 'cursor:{}limit:{}{}'.format(cursor or '', limit, sort_key)
+        if query:
+            plain_cache_key += str(query)
+
+        cache_key = generate_sha256(plain_cache_key)
+
+        def load():
+            self.app.log.debug('reading surveys directly from database by below filters...')
+            self.app.log.info('cursor={} limit={} sort_key={}'.format(cursor, limit, sort_key))
 
-            survey_docs = self.survey_schema.load(survey_docs_cursor, many=True)
-            if not survey_docs:
-                return total_count, survey_docs
+            page_query = query
+            if cursor:
+                page_query = {'$and': [query, keyset_filter(sort_key, *decode_cursor(cursor, sort_key))]}
 
-            if not ignore_cache:
-                self.cache_wrapper.write_cache(self.get_surveys_cache_key
-                                               .format(cache_key), survey_docs)
-                self.cache_wrapper.write_cache(key=self.get_surveys_cache_key.format('{}:COUNT'.format(cache_key)),
-                                               value={'total_count': total_count})
+            # the sort field is needed to build the next cursor even when it is not part of the response
+            projection = {field: 0 for field in ('created_at', 'updated_at') if field != sort_key[1:]}
+            raw_docs = list(self.db.find(filter=page_query,
+                                         projection=projection,
+                                         limit=limit,
+                                         sort=sort if sort_key[1:] == '_id' else sort + [('_id', sort[0][1])]))
+
+            total_count = self._total_count(query, ignore_cache)
+            next_cursor = encode_cursor(sort_key, raw_docs[-1]) if len(raw_docs) == limit else ''
+            return self._load(raw_docs, many=True), {'total_count': total_count, 'next_cursor': next_cursor}
+
+        if ignore_cache:
+            self.app.log.debug('ignoring cache requested')
+            survey_docs, page_info = load()
+        else:
+            survey_docs, page_info = self._cached_page(cache_key, load)
+
+        if survey_docs:
+            self.app.log.info('surveys result: \n{}'.format(pformat(survey_docs)))
+
+        return page_info['total_count'], survey_docs, page_info['next_cursor']
+
+    def _total_count(self, query, ignore_cache=False):
+        """
+        Number of surveys matching a listing query. The same for every page of the listing, it is cached once per
+        survey generation instead of being counted again for each page.
+        """
+        count_key = self.get_surveys_cache_key.format('TOTAL:{}:{}'.format(self.surveys_generation.current(),
+                                                                           generate_sha256(str(query))))
+        if not ignore_cache:
+            try:
+                return self.cache_wrapper.get_cache(count_key)
+            except CacheNotFound:
+                pass
+
+        total_count = self.db.count_documents(query)
+        self.cache_wrapper.write_cache(count_key, total_count)
+        return total_count
+
+    def _cached_page(self, cache_key, load):
+        """
+        Returns `(survey_docs, page_info)` of a listing page from cache, or from `load()` which reads them from the
+        database, caching non-empty pages in the generation the cache was looked up in.
+        """
+        generations = []
+
+        def read():
+            generation, cached_page = self._get_cached_page(cache_key)
+            generations.append(generation)
+            if cached_page is None:
+                raise CacheNotFound('{} not found in cache'.format(self.get_surveys_cache_key.format(cache_key)))
+            return cached_page
+
+        def compute():
+            survey_docs, page_info = load()
+            if survey_docs:
+                self._write_cached_page('{}:{}'.format(generations[-1], cache_key), cache_key, survey_docs, page_info)
+            return survey_docs, page_info
+
+        if self.stampede_guard:
+            return self.stampede_guard.fetch(self.get_surveys_cache_key.format(cache_key), read, compute)
+
+        try:
+            return read()[0]
+        except CacheNotFound:
+            return compute()
+
+    def _get_cached_page(self, cache_key):
+        """
+        Returns `(generation, ((survey_docs, page_info), fresh))` of a cached listing page, or `(generation, None)`.
+        The survey generation, the page, its `:COUNT` entry and its stale copy are read in one round-trip.
+        """
+        page_key = self.get_surveys_cache_key.format('{}:' + cache_key)
+        info_key = self.get_surveys_cache_key.format('{}:' + cache_key + ':COUNT')
+        stale_key = self.get_surveys_cache_key.format('STALE:{}'.format(cache_key))
+        keys = []
+        if self.stampede_guard and self.stampede_guard.stale_ttl:
+            keys.append(stale_key)
+
+        generation, cached = self.cache_wrapper.get_many_in_generation(self.surveys_generation,
+                                                                       [page_key, info_key], keys)
+        page_key, info_key = page_key.format(generation), info_key.format(generation)
+        if page_key in cached and info_key in cached:
+            return generation, ((cached[page_key], cached[info_key]), True)
+        if stale_key in cached:
+            survey_docs, page_info = self.stampede_guard.from_stale_copy(cached[stale_key])
+            return generation, ((survey_docs, page_info), False)
+
+        return generation, None
+
+    def _write_cached_page(self, generation_key, cache_key, survey_docs, page_info):
+        items = {self.get_surveys_cache_key.format(generation_key): survey_docs,
+                 self.get_surveys_cache_key.format('{}:COUNT'.format(generation_key)): page_info}
+        if self.stampede_guard and self.stampede_guard.stale_ttl:
+            # not namespaced by the generation: still readable after the next bump
+            items[self.get_surveys_cache_key.format('STALE:{}'.format(cache_key))] = \
+                self.stampede_guard.stale_copy([survey_docs, page_info])
+
+        self.cache_wrapper.write_many(items)
+
+    def _load(self, survey_docs, many=False):
+        if not self.survey_reader:
+            return self.survey_schema.load(survey_docs, many=many)
+
+        if many:
+            return [self.survey_reader(survey_doc) for survey_doc in survey_docs]
+
+        return self.survey_reader(survey_docs)
+
+    def ensure_indexes(self):
+        return ensure_indexes(self.db, self.indexes, self.app)
+
+    def rebuild_reservation_filter(self, batch_size=10000):
+        """Rebuilds the reservation bloom filter from the collection, returns the number of reservations added."""
+        if not self.reservation_filter:
+            raise ValueError('mango.reservation_filter is not enabled')
+
+        cursor = self.db.find({'reservation_id': {'$type': 'string', '$gt': ''}}, {'_id': 0, 'reservation_id': 1},
+                              batch_size=batch_size)
+        try:
+            return self.reservation_filter.rebuild((survey['reservation_id'] for survey in cursor),
+                                                   batch_size=batch_size)
+        finally:
+            cursor.close()
+
+    def _index_reservations(self, surveys):
+        """Adds the reservations of saved surveys to the bloom filter and drops their "no survey" entries."""
+        reservation_ids = [survey['reservation_id'] for survey in surveys if survey.get('reservation_id')]
+        if not reservation_ids or not self.reservation_filter:
+            return
+
+        pipeline = self.app.cache.r.pipeline(transaction=False)
+        self.reservation_filter.add_many(reservation_ids, pipeline)
+        pipeline.delete(*[self.cache_key.format('NO_SURVEY:{}'.format(reservation_id))
+                          for reservation_id in reservation_ids])
+        pipeline.execute()
+
+    def enable_write_behind(self, journal):
+        """Makes `save()` acknowledge surveys once appended to `journal`, which stores them in bulk in background."""
+        self.journal = journal.open(self._flush_journaled)
+        return self.journal
+
+    @staticmethod
+    def _pending_survey(pending_doc):
+        survey_doc = {k: v for k, v in pending_doc.items() if k not in ('created_at', 'updated_at')}
+        survey_doc['_id'] = str(survey_doc['_id'])
+        return survey_doc
+
+    def _claim_reservation(self, survey):
+        """
+        Publishes a survey about to be journaled as the pending survey of its reservation, for every process sharing
+        the Redis. False when the reservation already has a survey, stored or pending in any process.
+        """
+        reservation_id = survey['reservation_id']
+        if self.journal.get_pending(reservation_id) or self._is_stored(reservation_id):
+            return False
+
+        return self.cache_wrapper.add_cache('PENDING:{}'.format(reservation_id), self._pending_survey(survey),
+                                            expire_time=self.pending_ttl)
+
+    def _is_stored(self, reservation_id):
+        """Whether the reservation has a stored survey, from the bloom filter or the cache when they can tell."""
+        if self.reservation_filter and not self.reservation_filter.might_contain(reservation_id):
+            return False
+
+        survey_key = 'BY_RESERVATION:{}'.format(reservation_id)
+        no_survey_key = 'NO_SURVEY:{}'.format(reservation_id)
+        cached = self.cache_wrapper.get_many([survey_key, no_survey_key] if self.negative_ttl else [survey_key])
+        if cached:
+            return survey_key in cached
+
+        try:
+            return self.db.find_one({'reservation_id': reservation_id}, {'_id': 1}) is not None
+        except PyMongoError as e:
+            # keep accepting surveys while mongo is unavailable, a duplicate is then rejected by the flush
+            self.app.log.warning('could not check the survey of reservation {}: {}'.format(reservation_id, e))
+            return False
+
+    def _flush_journaled(self, documents):
+        """
+        Stores journaled surveys with one unordered insert_many. Returns `(document, reason)` of the surveys which can
+        never be stored, connection errors are raised so the journal retries the batch.
+        """
+        rejected = []
+        skipped = set()
+        try:
+            self.db.insert_many(documents, ordered=False)
+        except BulkWriteError as bwe:
+            for error in bwe.details['writeErrors']:
+                if error['code'] == 11000 and ('_id' in (error.get('keyPattern') or {})
+                                               or 'index: _id_ ' in error['errmsg']):
+                    # already stored by an earlier flush interrupted before the journal offset was saved
+                    skipped.add(error['index'])
+                else:
+                    rejected.append((documents[error['index']], error['errmsg']))
+                    skipped.add(error['index'])
+
+        stored = [document for index, document in enumerate(documents) if index not in skipped]
+        self.app.log.info('{} journaled surveys flushed'.format(len(stored)))
+        # stored or rejected, they are not pending anymore
+        self.cache_wrapper.delete_many(['PENDING:{}'.format(document['reservation_id'])
+                                        for document in documents if document.get('reservation_id')])
+        if stored:
+            # invalidate all survey caches with filters
+            self.surveys_generation.bump()
+            self._record_stats(stored)
+
+        return rejected
+
+    def backfill_reservation_attributes(self, get_reservation_attributes, batch_size=500, workers=8):
+        """
+        Copies reservation attributes (city, complex, checkout_date) onto surveys which have none yet, using
+        `get_reservation_attributes(reservation_id)` with `workers` concurrent lookups and one unordered bulk update
+        per batch. Returns the number of updated surveys, surveys whose lookup failed are left for the next run.
+
+        Every survey looked up is marked with `reservation_checked_at`, so a reservation the legacy API knows no
+        attributes of is not looked up again by the next runs.
+        """
+        updated_count = 0
+        surveys = self.db.find({'city': {'$exists': False}, 'complex': {'$exists': False},
+                                'checkout_date': {'$exists': False}, 'reservation_checked_at': {'$exists': False},
+                                'reservation_id': {'$nin': [None, '']}},
+                               projection={'reservation_id': 1},
+                               sort=[('_id', pymongo.ASCENDING)],
+                               batch_size=batch_size)
+
+        def lookup(survey):
+            try:
+                return survey, get_reservation_attributes(survey['reservation_id'])
+            except Exception:
+                self.app.log.error('could not get reservation {}: {}'.format(survey['reservation_id'],
+                                                                             traceback.format_exc()))
+                return survey, None
+
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            batch = []
+            for survey in surveys:
+                batch.append(survey)
+                if len(batch) >= batch_size:
+                    updated_count += self._write_reservation_attributes(executor.map(lookup, batch))
+                    batch = []
+
+            if batch:
+                updated_count += self._write_reservation_attributes(executor.map(lookup, batch))
+
+        if updated_count:
+            self.surveys_generation.bump()
+
+        return updated_count
+
+    def _write_reservation_attributes(self, lookups):
+        checked_at = datetime.datetime.utcnow()
+        lookups = [(survey, attributes) for survey, attributes in lookups if attributes is not None]
+        if not lookups:
+            return 0
+
+        self.db.bulk_write([UpdateOne({'_id': survey['_id']},
+                                      {'$set': dict(attributes, reservation_checked_at=checked_at)})
+                            for survey, attributes in lookups], ordered=False)
+        updated = [survey for survey, attributes in lookups if attributes]
+        if updated:
+            # cached surveys of these reservations lack the attributes
+            self.cache_wrapper.delete_many(['BY_RESERVATION:{}'.format(survey['reservation_id'])
+                                            for survey in updated])
+        self.app.log.info('reservation attributes written on {} surveys'.format(len(updated)))
+        return len(updated)
+
+    def _record_stats(self, surveys):
+        if not self.stats_store:
+            return
+
+        try:
+            self.stats_store.record_many(surveys)
+        except Exception:
+            # the updates not written are in the stats outbox, never fail a saved survey because of them
+            self.app.log.error('could not record survey stats: {}'.format(traceback.format_exc()))
 
-        self.app.log.info('surveys result: \n{}'.format(pformat(survey_docs)))
+    @staticmethod
+    def _sort_spec(sort_key):
+        sort_direction = {
+            '-': pymongo.DESCENDING,
+            '+': pymongo.ASCENDING
+        }
+        if sort_key[:1] not in sort_direction.keys():
+            raise InvalidFilter('invalid sort_key given: {}, it should start with - or +'.format(sort_key))
 
-        return total_count, survey_docs
+        return [(sort_key[1:], sort_direction[sort_key[:1]])]
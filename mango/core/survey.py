@@ -2,64 +2,159 @@ from olive.proto.zoodroom_pb2 import AddQuestionRequest, AddQuestionResponse, Ge
     GetQuestionByIdResponse, DeleteQuestionRequest, DeleteQuestionResponse, UpdateQuestionRequest, \
     AddSurveyResponse, AddSurveyRequest, UpdateQuestionResponse, GetQuestionsRequest, GetQuestionsResponse, \
     GetSurveyByReservationIdRequest, GetSurveyByReservationIdResponse, GetSurveysRequest, GetSurveysResponse, \
-    StreamGetSurveysResponse, StreamGetSurveysRequest
-from olive.exc import InvalidObjectId, DocumentNotFound, SaveError, FetchError
-from olive.store.toolbox import int_to_object_id
+    StreamGetSurveysResponse, StreamGetSurveysRequest, AddSurveysResponse, GetSurveyStatsRequest, \
+    GetSurveyStatsResponse, GetSurveysByReservationIdsRequest, GetSurveysByReservationIdsResponse, \
+    GetSurveyAnalyticsRequest, GetSurveyAnalyticsResponse
+from olive.exc import InvalidObjectId, DocumentNotFound, SaveError, FetchError, InvalidFilter
+from olive.store.toolbox import int_to_object_id, to_object_id
 from olive.proto import zoodroom_pb2_grpc
 from marshmallow import ValidationError
+from mango.core.legacy import ReservationResolver
 from olive.proto.rpc import Response
-from olive.http import Request
 import traceback
 
 
 class MangoService(zoodroom_pb2_grpc.MangoServiceServicer):
-    def __init__(self, question_store, survey_store, app, ranges, legacy_url, legacy_key):
+    def __init__(self, question_store, survey_store, app, ranges, legacy_url, legacy_key, bulk_batch_size=500,
+                 stats_store=None, reservation_resolver=None, local_reservation_filters=False, enrich_surveys=False,
+                 rating_recompute=None, max_reservation_ids=500, survey_snapshot=None):
         self.question_store = question_store
         self.survey_store = survey_store
+        self.stats_store = stats_store
         self.app = app
         self.ranges = ranges
         self.legacy_base_url = legacy_url if legacy_url[-1:] == '/' else '{}/'.format(legacy_url)
         self.legacy_key = legacy_key
+        self.reservation_resolver = reservation_resolver or ReservationResolver(app=app,
+                                                                                base_url=self.legacy_base_url,
+                                                                                key=legacy_key)
+        self.bulk_batch_size = bulk_batch_size
+        self.local_reservation_filters = local_reservation_filters
+        self.enrich_surveys = enrich_surveys
+        # recomputes stored total_ratings in background when a question weight changes
+        self.rating_recompute = rating_recompute
+        # most reservation ids a single GetSurveysByReservationIds call may ask for
+        self.max_reservation_ids = max_reservation_ids
+        # columnar copy of the surveys answering GetSurveyAnalytics
+        self.survey_snapshot = survey_snapshot
+
+    def _build_survey_payload(self, request, questions):
+        """Checks every rated question exists in `questions` (id -> question) and computes the weighted total_rating."""
+        given_questions = {question.question_id: question.rating for question in request.questions}
+
+        self.app.log.debug('Validating if all the sent questions exists')
+        for k in given_questions.keys():
+            if k not in questions:
+                raise DocumentNotFound("question {} not found with status=`active` and "
+                                       "include_in=`user_rate`".format(k))
+
+        self.app.log.debug('calculating total rating...')
+        sum_of_survey = 0.0
+        counter = 0.0
+        for question_id, rating in given_questions.items():
+            sum_of_survey += questions[question_id]['weight'] * rating
+            counter += questions[question_id]['weight']
+
+        overall_rate = int(round(sum_of_survey / counter, 1)) if counter else None
+        self.app.log.info('survey total_rating: {}/{} => {}'.format(sum_of_survey, counter, overall_rate))
+
+        survey_payload = {
+            'user_id': request.user_id,
+            'staff_id': request.staff_id,
+            'reservation_id': request.reservation_id,
+            'status': request.status,
+            'content': request.content,
+            'questions': [{"question_id": q, "rating": r or 0} for q, r in given_questions.items()],
+            'total_rating': overall_rate,
+            'platform': request.platform,
+        }
+        for attribute in ReservationResolver.reservation_attributes:
+            if getattr(request, attribute):
+                survey_payload[attribute] = getattr(request, attribute)
+
+        return survey_payload
+
+    def _enrich_survey_payload(self, survey_payload):
+        """Completes missing reservation attributes from the legacy API, failures are left to the backfill command."""
+        if not survey_payload['reservation_id'] or \
+                all(attribute in survey_payload for attribute in ReservationResolver.reservation_attributes):
+            return
+
+        try:
+            attributes = self.reservation_resolver.get_reservation_attributes(survey_payload['reservation_id'])
+        except FetchError:
+            self.app.log.error('could not enrich survey of reservation {}:\r\n{}'.format(
+                survey_payload['reservation_id'], traceback.format_exc()))
+            return
+
+        for attribute, value in attributes.items():
+            survey_payload.setdefault(attribute, value)
+
+    def _add_survey_batch(self, requests):
+        """Validates and saves a batch of AddSurveyRequest with one question lookup and one bulk insert."""
+        results = [None] * len(requests)
+
+        # malformed question ids only reject the surveys carrying them, not the whole batch
+        valid_positions = []
+        for position, request in enumerate(requests):
+            try:
+                for question in request.questions:
+                    to_object_id(question.question_id)
+                valid_positions.append(position)
+            except InvalidObjectId as ioi:
+                results[position] = {'error': {'code': 'invalid_id', 'message': str(ioi), 'details': []}}
+
+        question_ids = {question.question_id
+                        for position in valid_positions
+                        for question in requests[position].questions}
+        questions = self.question_store.get_rating_questions(question_ids=list(question_ids), include_in="user_rate")
+        questions = {str(q['_id']): q for q in questions}
+
+        payloads = []
+        payload_positions = []
+        for position in valid_positions:
+            try:
+                payloads.append(self._build_survey_payload(requests[position], questions))
+                payload_positions.append(position)
+            except DocumentNotFound as dnf:
+                results[position] = {'error': {'code': 'resource_not_found', 'message': str(dnf), 'details': []}}
+
+        for position, saved in zip(payload_positions, self.survey_store.save_many(payloads)):
+            if isinstance(saved, ValidationError):
+                results[position] = {'error': {'code': 'invalid_schema', 'message': 'Given data is not valid!',
+                                               'details': []}}
+            elif isinstance(saved, SaveError):
+                results[position] = {'error': {'code': 'save_error', 'message': str(saved), 'details': []}}
+            else:
+                results[position] = {'survey_id': saved}
+
+        return results
+
+    def _try_add_survey_batch(self, requests):
+        """
+        `_add_survey_batch`, whose failure only fails the surveys of this batch: the results of the batches already
+        saved are kept, so the client knows which surveys were stored.
+        """
+        try:
+            return self._add_survey_batch(requests)
+        except Exception:
+            self.app.log.error('a batch of {} surveys failed: {}'.format(len(requests), traceback.format_exc()))
+            return [{'error': {'code': 'server_error', 'message': 'Server is in maintenance mode', 'details': []}}
+                    for _ in requests]
 
     def AddSurvey(self, request: AddSurveyRequest, context) -> AddSurveyResponse:
         try:
             self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
-            given_questions = {question.question_id: question.rating for question in request.questions}
-            self.app.log.debug('Validating and retrieving below questions from database: \n{}'.format(given_questions))
-            questions = self.question_store.get_questions_by_filters(question_ids=given_questions.keys(),
-                                                                     include_in="user_rate",
-                                                                     status="active",
-                                                                     project=['weight'])
-            db_question_ids = [str(q['_id']) for q in questions]
-            self.app.log.info('Validation completed, validated questions: {}'.format(','.join(db_question_ids)))
-
-            self.app.log.debug('Validating if all the sent questions exists')
-            for k in given_questions.keys():
-                if k not in db_question_ids:
-                    raise DocumentNotFound("question {} not found with status=`active` and include_in=`user_rate`".format(k))
-
-            self.app.log.info('all questions are valid')
-
-            self.app.log.debug('calculating total rating...')
-            sum_of_survey = 0.0
-            counter = 0.0
-            for question in questions:
-                sum_of_survey += question['weight'] * given_questions[str(question['_id'])]
-                counter += question['weight']
-
-            overall_rate = int(round(sum_of_survey / counter, 1)) if counter else None
-            self.app.log.info('survey total_rating: {}/{} => {}'.format(sum_of_survey, counter, overall_rate))
-
-            survey_payload = {
-                'user_id': request.user_id,
-                'staff_id': request.staff_id,
-                'reservation_id': request.reservation_id,
-                'status': request.status,
-                'content': request.content,
-                'questions': [{"question_id": q, "rating": r or 0} for q, r in given_questions.items()],
-                'total_rating': overall_rate,
-                'platform': request.platform,
-            }
+            given_question_ids = list({question.question_id for question in request.questions})
+            self.app.log.debug('Validating and retrieving below questions: \n{}'.format(given_question_ids))
+            questions = self.question_store.get_rating_questions(question_ids=given_question_ids,
+                                                                 include_in="user_rate")
+            questions = {str(q['_id']): q for q in questions}
+            self.app.log.info('Validation completed, validated questions: {}'.format(','.join(questions.keys())))
+
+            survey_payload = self._build_survey_payload(request, questions)
+            if self.enrich_surveys:
+                self._enrich_survey_payload(survey_payload)
 
             survey_id = self.survey_store.save(survey_payload)
             self.app.log.info('survey has been saved successfully: {}'.format(survey_id))
@@ -68,6 +163,16 @@ class MangoService(zoodroom_pb2_grpc.MangoServiceServicer):
                 survey_id=survey_id
             )
 
+        except SaveError as se:
+            self.app.log.error('survey cannot be saved:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'save_error',
+                    'message': str(se),
+                    'details': []
+                }
+            )
+
         except InvalidObjectId as ioi:
             self.app.log.error('Invalid ObjectId (question_id) given:\r\n{}'.format(traceback.format_exc()))
             return Response.message(
@@ -116,6 +221,34 @@ class MangoService(zoodroom_pb2_grpc.MangoServiceServicer):
                 }
             )
 
+    def AddSurveys(self, request_iterator, context) -> AddSurveysResponse:
+        try:
+            results = []
+            batch = []
+            for request in request_iterator:
+                batch.append(request)
+                if len(batch) >= self.bulk_batch_size:
+                    results.extend(self._try_add_survey_batch(batch))
+                    batch = []
+
+            if batch:
+                results.extend(self._try_add_survey_batch(batch))
+
+            self.app.log.info('bulk survey ingestion finished: {} surveys, {} saved'.format(
+                len(results), sum(1 for r in results if 'survey_id' in r)))
+            return Response.message(
+                results=results
+            )
+        except Exception:
+            self.app.log.error('An error occurred: {}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'server_error',
+                    'message': 'Server is in maintenance mode',
+                    'details': []
+                }
+            )
+
     def AddQuestion(self, request: AddQuestionRequest, context) -> AddQuestionResponse:
         try:
             self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
@@ -237,7 +370,11 @@ class MangoService(zoodroom_pb2_grpc.MangoServiceServicer):
                 'weight': request.weight or question['weight'],
             }
 
+            weight_changed = new_question['weight'] != question['weight']
             question = self.question_store.update(request.question_id, new_question)
+            if question and weight_changed and self.rating_recompute:
+                self.rating_recompute.request([request.question_id])
+                self.rating_recompute.start()
 
             return Response.message(
                 is_updated=bool(question)
@@ -406,10 +543,83 @@ class MangoService(zoodroom_pb2_grpc.MangoServiceServicer):
                 }
             )
 
+    def GetSurveysByReservationIds(self, request: GetSurveysByReservationIdsRequest,
+                                   context) -> GetSurveysByReservationIdsResponse:
+        try:
+            self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
+            reservation_ids = self._batch_reservation_ids(request)
+            surveys, not_found = self.survey_store.get_by_reservation_ids(reservation_ids)
+            return Response.message(surveys=surveys, not_found_reservation_ids=not_found)
+        except ValueError as ve:
+            self.app.log.error('Schema value error:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'value_error',
+                    'message': str(ve),
+                    'details': []
+                }
+            )
+        except ValidationError as ve:
+            self.app.log.error('Schema validation error:\r\n{}'.format(ve.messages))
+            return Response.message(
+                error={
+                    'code': 'invalid_schema',
+                    'message': 'Given data is not valid!',
+                    'details': []
+                }
+            )
+        except Exception:
+            self.app.log.error('An error occurred: {}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'server_error',
+                    'message': 'Server is in maintenance mode',
+                    'details': []
+                }
+            )
+
+    def _batch_reservation_ids(self, request):
+        reservation_ids = list(request.reservation_ids)
+        if len(reservation_ids) > self.max_reservation_ids:
+            raise ValueError('at most {} reservation ids can be requested at once, {} given'
+                             .format(self.max_reservation_ids, len(reservation_ids)))
+        return reservation_ids
+
     def StreamGetSurveys(self, request: StreamGetSurveysRequest, context) -> StreamGetSurveysResponse:
         try:
-            for survey in self.survey_store.stream_surveys():
-                yield Response.message(survey=survey)
+            self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
+            if not request.batch_size:
+                # one survey per message, kept for backward compatibility
+                for survey in self.survey_store.stream_surveys():
+                    yield Response.message(survey=survey)
+                return
+
+            query = {}
+            for field in ('platform', 'city', 'complex'):
+                if getattr(request, field):
+                    query[field] = getattr(request, field)
+            if request.status:
+                query['status'] = request.status.lower()
+
+            # the generator is only resumed once the previous message was handed to the transport, so a slow
+            # consumer holds back reading from the database instead of piling batches up in memory
+            for surveys, last_id in self.survey_store.stream_survey_batches(query=query,
+                                                                            resume_after=request.resume_after,
+                                                                            batch_size=request.batch_size):
+                if not context.is_active():
+                    self.app.log.info('survey stream cancelled by the client after {}'.format(last_id))
+                    return
+
+                yield Response.message(surveys=surveys, last_id=last_id)
+        except InvalidObjectId as ioi:
+            self.app.log.error('Invalid ObjectId (resume_after) given:\r\n{}'.format(traceback.format_exc()))
+            yield Response.message(
+                error={
+                    'code': 'invalid_id',
+                    'message': str(ioi),
+                    'details': []
+                }
+            )
         except ValidationError as ve:
             self.app.log.error('Schema validation error:\r\n{}'.format(ve.messages))
             yield Response.message(
@@ -429,50 +639,66 @@ class MangoService(zoodroom_pb2_grpc.MangoServiceServicer):
                 }
             )
 
+    @staticmethod
+    def _reservation_query(request):
+        """Filters on the reservation attributes denormalized on the surveys."""
+        query = {}
+        if request.city:
+            query['city'] = str(request.city)
+        if request.complex:
+            query['complex'] = str(request.complex)
+        if request.checkout_start or request.checkout_end:
+            query['checkout_date'] = {}
+            if request.checkout_start:
+                query['checkout_date']['$gte'] = str(request.checkout_start)
+            if request.checkout_end:
+                query['checkout_date']['$lte'] = str(request.checkout_end)
+
+        return query
+
+    def _legacy_reservation_query(self, request):
+        """Filters on the reservation ids the legacy API resolves the reservation filters to."""
+        reservations = self.reservation_resolver.resolve(checkout_start=request.checkout_start,
+                                                         checkout_end=request.checkout_end,
+                                                         city=request.city,
+                                                         complex=request.complex)
+        if reservations:
+            reservations = list(map(int_to_object_id, reservations))
+
+        return {'reservation_id': {'$in': reservations}}
+
     def GetSurveys(self, request: GetSurveysRequest, context) -> GetSurveysResponse:
         try:
             self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
             query = {}
-            params = []
-            ignore_cache = False
             if not all(v in [None, 0, ''] for v in [request.checkout_start,
                                                     request.checkout_end,
                                                     request.city,
                                                     request.complex]):
-                ignore_cache = True
-                url = '{}v3/internal-reservations'.format(self.legacy_base_url)
-                if request.checkout_start:
-                    params.append('checkout_start={}'.format(request.checkout_start))
-                if request.checkout_end:
-                    params.append('checkout_end={}'.format(request.checkout_end))
-                if request.complex:
-                    params.append('complex={}'.format(request.complex))
-                if request.city:
-                    params.append('city={}'.format(request.city))
-
-                url = '{}?{}'.format(url, '&'.join(params))
-
-                rq = Request(url=url,
-                             app=self.app,
-                             headers={'X-INTERNAL-API-KEY': self.legacy_key})
-                reservations = rq.get()
-                if reservations:
-                    reservations = list(map(int_to_object_id, reservations))
-
-                query = {'reservation_id': {'$in': reservations}}
+                if self.local_reservation_filters:
+                    query = self._reservation_query(request)
+                else:
+                    query = self._legacy_reservation_query(request)
 
                 status = request.status
                 if status:
                     query['status'] = status.lower()
 
-            total_count, surveys = self.survey_store.get_surveys(skip=request.skip,
-                                                                 limit=request.page_size,
-                                                                 query=query,
-                                                                 ignore_cache=ignore_cache)
+            next_cursor = ''
+            if request.skip and not request.cursor:
+                # deprecated offset pagination, kept for backward compatibility
+                total_count, surveys = self.survey_store.get_surveys(skip=request.skip,
+                                                                     limit=request.page_size,
+                                                                     query=query)
+            else:
+                total_count, surveys, next_cursor = self.survey_store.get_surveys_page(limit=request.page_size,
+                                                                                       query=query,
+                                                                                       cursor=request.cursor)
             self.app.log.info('total surveys count: {}'.format(total_count))
             return Response.message(
                 surveys=surveys,
-                total_count=total_count
+                total_count=total_count,
+                next_cursor=next_cursor
             )
         except ValidationError as ve:
             self.app.log.error('Schema validation error:\r\n{}'.format(ve.messages))
@@ -483,6 +709,15 @@ class MangoService(zoodroom_pb2_grpc.MangoServiceServicer):
                     'details': []
                 }
             )
+        except InvalidFilter as inf:
+            self.app.log.error('Invalid filter given:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'invalid_filter',
+                    'message': str(inf),
+                    'details': []
+                }
+            )
         except FetchError as fe:
             self.app.log.error('Legacy API error:\r\n{}'.format(traceback.format_exc()))
             return Response.message(
@@ -501,3 +736,87 @@ class MangoService(zoodroom_pb2_grpc.MangoServiceServicer):
                     'details': []
                 }
             )
+
+    def GetSurveyStats(self, request: GetSurveyStatsRequest, context) -> GetSurveyStatsResponse:
+        """
+        Rating aggregates of a question, platform or status, overall or on one day.
+
+        The aggregates are not updated atomically with the surveys: they are written right after a survey is stored,
+        and the updates that failed are written again later from the stats outbox (at least once). They may lag behind
+        the surveys, and an update that failed with a connection error may be counted twice. `mango rebuild-stats`
+        recomputes them from the survey collection.
+        """
+        try:
+            self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
+            stats = self.stats_store.get(dimension=request.dimension, key=request.key, day=request.day or None)
+            return Response.message(**stats)
+        except InvalidFilter as inf:
+            self.app.log.error('Invalid filter given:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'invalid_filter',
+                    'message': str(inf),
+                    'details': []
+                }
+            )
+        except DocumentNotFound as dnf:
+            self.app.log.error('survey stats not found:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'resource_not_found',
+                    'message': str(dnf),
+                    'details': []
+                }
+            )
+        except Exception:
+            self.app.log.error('An error occurred: {}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'server_error',
+                    'message': 'Server is in maintenance mode',
+                    'details': []
+                }
+            )
+
+    def GetSurveyAnalytics(self, request: GetSurveyAnalyticsRequest, context) -> GetSurveyAnalyticsResponse:
+        try:
+            self.app.log.info('accepted fields by gRPC proto: {}'.format(request.DESCRIPTOR.fields_by_name.keys()))
+            if not self.survey_snapshot:
+                raise InvalidFilter('survey analytics are not enabled (mango.snapshot)')
+
+            analytics = self.survey_snapshot.analytics(interval=request.interval or 'day',
+                                                       start=request.start or None,
+                                                       end=request.end or None,
+                                                       platform=request.platform or None,
+                                                       status=request.status or None,
+                                                       question_id=request.question_id or None,
+                                                       window=request.window or 7,
+                                                       percentiles=list(request.percentiles) or (50, 90))
+            return Response.message(**analytics)
+        except InvalidFilter as inf:
+            self.app.log.error('Invalid filter given:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'invalid_filter',
+                    'message': str(inf),
+                    'details': []
+                }
+            )
+        except DocumentNotFound as dnf:
+            self.app.log.error('survey ratings not found:\r\n{}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'resource_not_found',
+                    'message': str(dnf),
+                    'details': []
+                }
+            )
+        except Exception:
+            self.app.log.error('An error occurred: {}'.format(traceback.format_exc()))
+            return Response.message(
+                error={
+                    'code': 'server_error',
+                    'message': 'Server is in maintenance mode',
+                    'details': []
+                }
+            )
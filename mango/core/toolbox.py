@@ -0,0 +1,65 @@
+from concurrent.futures import Future
+import threading
+import math
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls sharing a key: the first caller runs the function while the others block until it
+    finishes and get the same result, or the same exception.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def running(self, key):
+        """Whether a call of `key` is in flight."""
+        return key in self._calls
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank `q` (0-100) percentile of already sorted values, None when there are none."""
+    if not sorted_values:
+        return None
+
+    rank = max(1, math.ceil(q / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize_latencies(latencies):
+    """Count, mean, p50/p95/p99 and max of latencies given in seconds, reported in milliseconds."""
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'count': 0}
+
+    return {
+        'count': len(latencies),
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
@@ -1,15 +1,25 @@
 from olive.store.redis_cache_handler import CustomRedisCacheHandler
 from olive.proto import zoodroom_pb2_grpc, health_pb2_grpc
 from olive.store.mongo_connection import MongoConnection
+from mango.core.metrics import MetricsServer, MongoCommandListener, instrument_store, instrument_servicer
 from mango.core.store.question import QuestionStore
+from mango.core.prefork import Supervisor
+from mango.core.store.indexes import ensure_indexes
+from mango.core.store.journal import SurveyJournal
 from mango.core.store.survey import SurveyStore
+from mango.core.store.stats import SurveyStatsStore
 from olive.proto.health import HealthService
+from mango.core.legacy import ReservationResolver
 from mango.core.survey import MangoService
+from mango.core.recompute import RatingRecompute
+from mango.core.snapshot import SurveySnapshot
 from olive.proto.rpc import GRPCServerBase
 from cement.core.exc import CaughtSignal
 from mango.controllers.base import Base
 from olive.exc import MangoServiceError
 from cement import App, TestApp
+from pymongo import monitoring
+import os
 
 
 class MangoApp(App):
@@ -48,36 +58,121 @@ class MangoApp(App):
             CustomRedisCacheHandler
         ]
 
-    def run(self):
+    def get_database(self):
         mongodb_cfg = self.config['mango']['mongodb']
         self.log.debug('initiating MongoDB configuration...')
         mongo = MongoConnection(mongodb_cfg, self)
         self.log.info('current database: {}'.format(mongo))
-        target_database = mongo.service_db
+        return mongo.service_db
+
+    def run_server(self):
+        """Serves gRPC, the default command: in this process or in pre-forked workers (mango.server.prefork)."""
+        server_cfg = self.config['mango'].get('server') or {}
+        if not server_cfg.get('prefork'):
+            return self.serve()
+
+        # indexes are ensured once, the connections are closed so no client is inherited by the workers
+        target_database = self.get_database()
+        ensure_indexes(target_database.question, QuestionStore.indexes, self)
+        ensure_indexes(target_database.survey, SurveyStore.indexes, self)
+        target_database.client.close()
+        self.cache.r.connection_pool.disconnect()
+
+        supervisor = Supervisor(app=self,
+                                workers=server_cfg.get('workers') or os.cpu_count(),
+                                target=self.serve,
+                                grace=server_cfg.get('grace', 10),
+                                max_restarts=server_cfg.get('max_restarts', 5))
+        if not supervisor.run():
+            self.exit_code = 1
+
+    def serve(self, worker_index=None):
+        """Serves gRPC in this process, `worker_index` is given when it is a pre-forked worker."""
+        if worker_index is not None:
+            # forked worker: open its own redis connections, never the ones of the supervisor
+            self.cache.r.connection_pool.reset()
+
+        metrics_cfg = self.config['mango'].get('metrics') or {}
+        if metrics_cfg.get('enabled'):
+            # only clients created after the registration are monitored
+            monitoring.register(MongoCommandListener())
+
+        target_database = self.get_database()
         question_store = QuestionStore(target_database.question, self)
-        survey_store = SurveyStore(target_database.survey, self)
+        stats_store = SurveyStatsStore(target_database.survey_stats, self)
+        survey_store = SurveyStore(target_database.survey, self, stats_store=stats_store)
+        if worker_index is None:
+            question_store.ensure_indexes()
+            survey_store.ensure_indexes()
+
+        if (self.config['mango'].get('write_behind') or {}).get('enabled'):
+            survey_store.enable_write_behind(SurveyJournal.from_config(self, worker_index))
+
+        if survey_store.reservation_filter and not survey_store.reservation_filter.is_ready():
+            self.log.warning('reservation filter is not built yet, run `mango rebuild-reservation-filter`')
+
+        if metrics_cfg.get('enabled'):
+            instrument_store(question_store, 'question')
+            instrument_store(survey_store, 'survey')
+            instrument_store(stats_store, 'survey_stats')
+            # every worker exposes its own metrics, on consecutive ports
+            MetricsServer(app=self,
+                          host=metrics_cfg.get('host', '127.0.0.1'),
+                          port=metrics_cfg.get('port', 9464) + (worker_index or 0)).start()
         self.log.info('current service name: ' + self._meta.label)
 
+        server_cls = MangoServer
+        if (self.config['mango'].get('server') or {}).get('mode') == 'asyncio':
+            # motor is only needed by the asyncio mode
+            from mango.core.aio.server import AsyncMangoServer
+            server_cls = AsyncMangoServer
+
         # Passing self for app is suggested by Cement Core Developer:
         #   - https://github.com/datafolklabs/cement/issues/566
-        cs = MangoServer(service_name=self._meta.label,
-                         question_store=question_store,
-                         survey_store=survey_store,
-                         app=self)
-        cs.start()
+        cs = server_cls(service_name=self._meta.label,
+                        question_store=question_store,
+                        survey_store=survey_store,
+                        stats_store=stats_store,
+                        app=self)
+        try:
+            cs.start()
+        finally:
+            if survey_store.journal is not None:
+                survey_store.journal.close()
 
 
 class MangoServer(GRPCServerBase):
-    def __init__(self, service_name, question_store, survey_store, app, ):
+    def __init__(self, service_name, question_store, survey_store, app, stats_store=None):
         super(MangoServer, self).__init__(service=service_name, app=app)
 
+        reservation_resolver = ReservationResolver.from_config(app)
+        rating_recompute = RatingRecompute.from_config(app, question_store, survey_store, stats_store)
+        survey_snapshot = SurveySnapshot.from_config(app)
+
         # add class to gRPC server
         service = MangoService(question_store=question_store,
                                survey_store=survey_store,
                                app=app,
                                ranges=app.config['mango']['survey_setting']['ranges'],
                                legacy_url=app.config['mango']['legacy']['base_url'],
-                               legacy_key=app.config['mango']['legacy']['key'])
+                               legacy_key=app.config['mango']['legacy']['key'],
+                               bulk_batch_size=(app.config['mango'].get('bulk') or {}).get('batch_size', 500),
+                               stats_store=stats_store,
+                               reservation_resolver=reservation_resolver,
+                               local_reservation_filters=app.config['mango']['legacy'].get('local_filters', False),
+                               enrich_surveys=app.config['mango']['legacy'].get('enrich_surveys', False),
+                               rating_recompute=rating_recompute,
+                               max_reservation_ids=(app.config['mango'].get('bulk') or {}).get(
+                                   'max_reservation_ids', 500),
+                               survey_snapshot=survey_snapshot)
+        if (app.config['mango'].get('metrics') or {}).get('enabled'):
+            instrument_servicer(service)
+        if rating_recompute:
+            # resumes a recompute left unfinished by a previous run
+            rating_recompute.start()
+        if survey_snapshot:
+            survey_snapshot.start(survey_store.db)
+
         health_service = HealthService(app=app)
 
         # adds a MangoService to a gRPC.Server
@@ -1,9 +1,17 @@
 """
 PyTest Fixtures.
+
+Also the Redis, application and collection replacements shared by the test modules, which import them with
+`from conftest import ...`.
 """
 
-import pytest
+from mango.core.store.cache import PipelinedCacheWrapper, StampedeGuard
+from pymongo.results import BulkWriteResult, InsertOneResult
+from olive.exc import CacheNotFound
+from bson import ObjectId
 from cement import fs
+import logging
+import pytest
 
 
 @pytest.fixture(scope="function")
@@ -15,3 +23,335 @@ def tmp(request):
     t = fs.Tmp()
     yield t
     t.remove()
+
+
+class AppConfig(dict):
+    """Application config holding the `mango` section, `get(section, key)` serves the cache settings."""
+
+    def __init__(self, **mango):
+        super().__init__(mango=mango)
+
+    def get(self, section, key):
+        return {('cache.iredis', 'expire_time'): 60}[(section, key)]
+
+
+class DictRedis:
+    """
+    Redis replacement for strings, bitmaps and lists. Counts the GETs in `reads` and the round-trips in
+    `round_trips`, a pipeline costs one.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+        self.bitmaps = {}
+        self.lists = {}
+        self.reads = 0
+        self.round_trips = 0
+
+    def get(self, key):
+        self.round_trips += 1
+        self.reads += 1
+        return self.values.get(key)
+
+    def mget(self, keys):
+        self.round_trips += 1
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False, px=None):
+        self.round_trips += 1
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        self.expires[key] = ex
+        return True
+
+    def exists(self, key):
+        self.round_trips += 1
+        return int(key in self.values)
+
+    def delete(self, *keys):
+        self.round_trips += 1
+        for key in keys:
+            for store in (self.values, self.bitmaps, self.lists):
+                store.pop(key, None)
+
+    def rename(self, source, destination):
+        self.round_trips += 1
+        for store in (self.values, self.bitmaps, self.lists):
+            if source in store:
+                store[destination] = store.pop(source)
+
+    def incr(self, key):
+        self.round_trips += 1
+        self.values[key] = int(self.values.get(key) or 0) + 1
+        return self.values[key]
+
+    def eval(self, script, numkeys, *args):
+        self.round_trips += 1
+        keys, arguments = args[:numkeys], args[numkeys:]
+        if script == StampedeGuard.release_script:
+            if self.values.get(keys[0]) == arguments[0]:
+                del self.values[keys[0]]
+            return
+
+        assert script == PipelinedCacheWrapper.generation_read_script
+        generation = str(self.values.get(keys[0]) or 0)
+        read_keys = [prefix + generation + suffix for prefix, suffix in zip(arguments[::2], arguments[1::2])]
+        return [generation] + [self.values.get(key) for key in read_keys + list(keys[1:])]
+
+    def setbit(self, key, offset, value):
+        self.round_trips += 1
+        bits = self.bitmaps.setdefault(key, set())
+        (bits.add if value else bits.discard)(offset)
+
+    def getbit(self, key, offset):
+        self.round_trips += 1
+        return int(offset in self.bitmaps.get(key, ()))
+
+    def bitop(self, operation, destination, *keys):
+        self.round_trips += 1
+        assert operation == 'OR'
+        self.bitmaps[destination] = set().union(*(self.bitmaps.get(key, set()) for key in keys))
+
+    def rpush(self, key, *values):
+        self.round_trips += 1
+        self.lists.setdefault(key, []).extend(values)
+
+    def lrange(self, key, start, end):
+        self.round_trips += 1
+        return self.lists.get(key, [])[start:end + 1]
+
+    def ltrim(self, key, start, end):
+        self.round_trips += 1
+        self.lists[key] = self.lists.get(key, [])[start:]
+
+    def pipeline(self, transaction=True):
+        return DictPipeline(self)
+
+
+class DictPipeline:
+    """Queues the commands of a DictRedis, runs them on execute()."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        results = [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in commands]
+        self.redis.round_trips -= len(commands) - 1
+        return results
+
+
+class AsyncRedis:
+    """`redis.asyncio` view of a DictRedis, its attributes (`values`, `round_trips`...) are the DictRedis ones."""
+
+    def __init__(self, redis=None):
+        self.redis = redis or DictRedis()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.redis, name)
+        if not callable(attribute):
+            return attribute
+
+        async def command(*args, **kwargs):
+            return attribute(*args, **kwargs)
+        return command
+
+    def pipeline(self, transaction=True):
+        return AsyncPipeline(self.redis)
+
+
+class AsyncPipeline(DictPipeline):
+    async def execute(self):
+        return super().execute()
+
+
+class RedisCacheHandler:
+    def __init__(self, redis=None):
+        self.r = redis or DictRedis()
+
+
+class StubApp:
+    """Application replacement: the test logger, an AppConfig of the given `mango` section and a DictRedis cache."""
+    log = logging.getLogger('mango-test')
+
+    def __init__(self, redis=None, **mango):
+        self.config = AppConfig(**mango)
+        self.cache = RedisCacheHandler(redis)
+
+
+class DictCacheWrapper:
+    """Redis tier replacement keeping values in a dict and counting reads."""
+
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self.reads = 0
+
+    def get_cache(self, key):
+        self.reads += 1
+        try:
+            return self.values[str(key)]
+        except KeyError:
+            raise CacheNotFound
+
+    def write_cache(self, key, value):
+        self.values[str(key)] = value
+
+    def delete(self, key):
+        self.values.pop(str(key), None)
+
+    def delete_by_pattern(self, pattern):
+        self.values.clear()
+
+    def get_many(self, keys):
+        self.reads += 1
+        return {key: self.values[str(key)] for key in keys if str(key) in self.values}
+
+    def write_many(self, items, generations=()):
+        for key, value in items.items():
+            self.write_cache(key, value)
+
+
+MISSING = object()
+
+TYPES = {'string': str, 'int': int, 'bool': bool, 'object': dict, 'array': list}
+
+OPERATORS = {
+    '$gt': lambda value, bound: value is not MISSING and value > bound,
+    '$gte': lambda value, bound: value is not MISSING and value >= bound,
+    '$lt': lambda value, bound: value is not MISSING and value < bound,
+    '$lte': lambda value, bound: value is not MISSING and value <= bound,
+    '$ne': lambda value, bound: not equals(value, bound),
+    '$in': lambda value, bound: any(equals(value, candidate) for candidate in bound),
+    '$nin': lambda value, bound: not any(equals(value, candidate) for candidate in bound),
+    '$exists': lambda value, bound: (value is not MISSING) == bool(bound),
+    '$type': lambda value, bound: isinstance(value, TYPES[bound]),
+}
+
+
+def equals(value, condition):
+    """MongoDB equality: a missing field equals None, an array equals any of its elements."""
+    if value is MISSING:
+        return condition is None
+    return value == condition or (isinstance(value, list) and condition in value)
+
+
+def matches(document, query):
+    """Whether `document` matches a MongoDB `query` of equalities, comparison operators, `$and` and `$or`."""
+    for field, condition in query.items():
+        if field == '$and':
+            if not all(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif field == '$or':
+            if not any(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+            value = document.get(field, MISSING)
+            if not all(OPERATORS[operator](value, bound) for operator, bound in condition.items()):
+                return False
+        elif not equals(document.get(field, MISSING), condition):
+            return False
+    return True
+
+
+def project(document, projection):
+    if not projection:
+        return dict(document)
+
+    if not isinstance(projection, dict):
+        projection = {field: 1 for field in projection}
+    if any(included for field, included in projection.items() if field != '_id'):
+        fields = [field for field, included in projection.items() if included] + \
+            (['_id'] if projection.get('_id', 1) else [])
+        return {field: document[field] for field in fields if field in document}
+    return {field: value for field, value in document.items() if projection.get(field, 1)}
+
+
+class Cursor(list):
+    def close(self):
+        pass
+
+
+class AsyncCursor(Cursor):
+    def __aiter__(self):
+        async def documents():
+            for document in self:
+                yield document
+        return documents()
+
+    async def to_list(self, length=None):
+        return list(self[:length])
+
+
+class Collection:
+    """
+    pymongo collection replacement over the list `documents`, counting the finds in `finds` and the counts in
+    `counts`. Bulk writes are recorded in `written` and apply `$set` updates.
+    """
+
+    def __init__(self, documents=()):
+        self.documents = [dict(document) for document in documents]
+        self.finds = 0
+        self.counts = 0
+        self.written = []
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None, batch_size=None):
+        self.finds += 1
+        documents = [document for document in self.documents if matches(document, filter or {})]
+        for field, direction in reversed(sort or []):
+            documents.sort(key=lambda document: document.get(field), reverse=direction < 0)
+        documents = documents[skip:skip + limit if limit else None]
+        return Cursor(project(document, projection) for document in documents)
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        documents = self.find(filter, projection, limit=1, sort=sort)
+        return documents[0] if documents else None
+
+    def count_documents(self, filter):
+        self.counts += 1
+        return sum(matches(document, filter) for document in self.documents)
+
+    def _insert(self, document):
+        document.setdefault('_id', ObjectId())
+        self.documents.append(dict(document))
+        return document['_id']
+
+    def insert_one(self, document):
+        return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents, ordered=True):
+        for document in documents:
+            self._insert(document)
+
+    def bulk_write(self, operations, ordered=True):
+        self.written += operations
+        matched = 0
+        for operation in operations:
+            for document in self.documents:
+                if matches(document, operation._filter):
+                    document.update(operation._doc['$set'])
+                    matched += 1
+                    break
+        return BulkWriteResult({'nMatched': matched, 'nModified': matched}, True)
+
+
+class AsyncCollection(Collection):
+    """motor collection replacement, see Collection."""
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(super().find(*args, **kwargs))
+
+    async def find_one(self, filter=None, projection=None, sort=None):
+        documents = super().find(filter, projection, limit=1, sort=sort)
+        return documents[0] if documents else None
+
+    async def count_documents(self, filter):
+        return super().count_documents(filter)
+
+    async def insert_one(self, document):
+        return super().insert_one(document)
@@ -0,0 +1,101 @@
+from mango.core.aio.cache import AsyncCacheWrapper, AsyncCacheGeneration
+from mango.core.metrics import instrument_store, STORE_LATENCY, CACHE_REQUESTS
+from conftest import StubApp, AsyncRedis, AsyncCollection
+from olive.exc import CacheNotFound
+import asyncio
+import pytest
+
+
+def test_async_cache_wrapper_round_trip():
+    redis = AsyncRedis()
+    cache_wrapper = AsyncCacheWrapper(StubApp(), redis, 'MANGO:SURVEY:{}')
+
+    async def scenario():
+        with pytest.raises(CacheNotFound):
+            await cache_wrapper.get_cache('BY_RESERVATION:12')
+
+        await cache_wrapper.write_cache('BY_RESERVATION:12', {'_id': '1', 'total_rating': 3})
+        assert await cache_wrapper.get_cache('BY_RESERVATION:12') == {'_id': '1', 'total_rating': 3}
+        assert redis.expires['MANGO:SURVEY:BY_RESERVATION:12'] == 60
+
+        await cache_wrapper.delete('BY_RESERVATION:12')
+        with pytest.raises(CacheNotFound):
+            await cache_wrapper.get_cache('BY_RESERVATION:12')
+
+        await cache_wrapper.write_many({'GET_SURVEYS:1': [], 'GET_SURVEYS:1:COUNT': {'total_count': 0}})
+        assert await cache_wrapper.get_many(['GET_SURVEYS:1', 'GET_SURVEYS:1:COUNT', 'GET_SURVEYS:2']) == {
+            'GET_SURVEYS:1': [], 'GET_SURVEYS:1:COUNT': {'total_count': 0}}
+
+    asyncio.run(scenario())
+
+
+def test_async_cache_generation_shares_the_counter():
+    redis = AsyncRedis()
+    generation = AsyncCacheGeneration(StubApp(), redis, 'MANGO:SURVEY:GENERATION:GET_SURVEYS')
+
+    async def scenario():
+        assert await generation.current() == 0
+        assert await generation.bump() == 1
+        assert await generation.current() == 1
+
+    asyncio.run(scenario())
+    assert redis.values == {'MANGO:SURVEY:GENERATION:GET_SURVEYS': 1}
+
+
+def test_async_cache_wrapper_reads_the_generation_along():
+    redis = AsyncRedis()
+    cache_wrapper = AsyncCacheWrapper(StubApp(), redis, 'MANGO:SURVEY:{}')
+    generation = AsyncCacheGeneration(StubApp(), redis, 'MANGO:SURVEY:GENERATION:GET_SURVEYS')
+
+    async def scenario():
+        await generation.bump()
+        await cache_wrapper.write_many({'GET_SURVEYS:1:page': [{'_id': '1'}], 'STALE:page': []})
+        assert await cache_wrapper.get_many_in_generation(generation, ['GET_SURVEYS:{}:page', 'GET_SURVEYS:{}:x'],
+                                                          ['STALE:page']) == (1, {'GET_SURVEYS:1:page': [{'_id': '1'}],
+                                                                                  'STALE:page': []})
+
+    asyncio.run(scenario())
+
+
+class AsyncNumberStore:
+    def __init__(self):
+        self.cache_wrapper = AsyncCacheWrapper(StubApp(), AsyncRedis(), 'NUMBER:{}')
+
+    async def get(self, key):
+        try:
+            return await self.cache_wrapper.get_cache(key)
+        except CacheNotFound:
+            await self.cache_wrapper.write_cache(key, 1)
+            return 0
+
+    async def stream(self):
+        for i in range(3):
+            yield i
+
+
+def test_instrument_async_store():
+    store = instrument_store(AsyncNumberStore(), 'async_number')
+
+    async def scenario():
+        assert await store.get('a') == 0
+        assert await store.get('a') == 1
+        assert [i async for i in store.stream()] == [0, 1, 2]
+
+    asyncio.run(scenario())
+    assert CACHE_REQUESTS.collect()[('async_number', 'miss')] == 1
+    assert CACHE_REQUESTS.collect()[('async_number', 'hit')] == 1
+    assert sum(STORE_LATENCY.collect()[('async_number', 'get')][:-1]) == 2
+    assert sum(STORE_LATENCY.collect()[('async_number', 'stream')][:-1]) == 1
+
+
+def test_async_rating_questions_leave_out_deleted_questions():
+    from mango.core.aio.store import AsyncQuestionStore
+    from bson import ObjectId
+
+    active, deleted = ObjectId(), ObjectId()
+    question_store = AsyncQuestionStore(AsyncCollection([{'_id': active, 'weight': 2, 'is_deleted': False},
+                                                         {'_id': deleted, 'weight': 5, 'is_deleted': True}]),
+                                        StubApp(), AsyncRedis())
+
+    questions = asyncio.run(question_store.get_rating_questions([str(active), str(deleted)]))
+    assert questions == [{'_id': str(active), 'weight': 2}]
@@ -0,0 +1,176 @@
+from mango.core.store.bloom import BloomFilter
+from mango.core.store.survey import SurveyStore
+from mango.core.aio.store import AsyncSurveyStore
+from mango.core.store.journal import SurveyJournal
+from conftest import StubApp, AsyncRedis, Collection, AsyncCollection
+from olive.exc import DocumentNotFound, SaveError
+import asyncio
+import pytest
+
+
+class Schema:
+    def load(self, data):
+        return data
+
+    def dump(self, data):
+        return dict(data)
+
+
+def test_bloom_filter_is_only_trusted_once_built():
+    bloom = BloomFilter(StubApp(), 'MANGO:SURVEY:RESERVATION_FILTER', capacity=1000, error_rate=0.01)
+    bloom.add_many(['1'])
+    # not built from the collection yet: anything might be there
+    assert bloom.might_contain('2')
+    assert not bloom.is_ready()
+
+    assert bloom.rebuild(str(i) for i in range(0, 1000, 2)) == 500
+    assert bloom.is_ready()
+    assert all(bloom.might_contain(str(i)) for i in range(0, 1000, 2))
+    # added before the rebuild, merged into the rebuilt filter
+    assert bloom.might_contain('1')
+    false_positives = sum(bloom.might_contain(str(i)) for i in range(1001, 3000, 2))
+    assert false_positives < 50
+
+    resized = BloomFilter(bloom.app, 'MANGO:SURVEY:RESERVATION_FILTER', capacity=2000, error_rate=0.01)
+    assert not resized.is_ready()
+
+
+def test_reservations_without_survey_are_answered_from_redis():
+    app = StubApp(reservation_filter={'enabled': True, 'capacity': 1000, 'error_rate': 0.01, 'negative_ttl': 60})
+    collection = Collection([{'_id': 'a', 'reservation_id': '12'}])
+    survey_store = SurveyStore(collection, app)
+    survey_store._load = lambda survey_doc, many=False: survey_doc
+    assert survey_store.rebuild_reservation_filter() == 1
+    collection.finds = 0
+
+    assert survey_store.get_by_reservation_id('12')['_id'] == 'a'
+    assert collection.finds == 1
+    # the filter tells the reservation has no survey
+    with pytest.raises(DocumentNotFound):
+        survey_store.get_by_reservation_id('13')
+    assert collection.finds == 1
+
+    # a false positive is looked up once, then cached as missing
+    survey_store.reservation_filter.add_many(['14'])
+    for _ in range(2):
+        with pytest.raises(DocumentNotFound):
+            survey_store.get_by_reservation_id('14')
+    assert collection.finds == 2
+    assert 'MANGO:SURVEY:NO_SURVEY:14' in app.cache.r.values
+
+    # saving a survey of the reservation drops the entry
+    survey_store._index_reservations([{'reservation_id': '14'}])
+    assert 'MANGO:SURVEY:NO_SURVEY:14' not in app.cache.r.values
+
+
+def test_batch_reservation_lookup_costs_one_query():
+    app = StubApp(reservation_filter={'enabled': True, 'capacity': 1000, 'error_rate': 0.01, 'negative_ttl': 60})
+    collection = Collection([{'_id': 'a', 'reservation_id': '12'}, {'_id': 'b', 'reservation_id': '14'}])
+    survey_store = SurveyStore(collection, app)
+    survey_store._load = lambda survey_docs, many=False: survey_docs
+    survey_store.rebuild_reservation_filter()
+    collection.finds = 0
+    # a false positive of the filter, missing from the collection
+    survey_store.reservation_filter.add_many(['16'])
+
+    surveys, not_found = survey_store.get_by_reservation_ids(['14', '13', '12', '16', '14'])
+    assert [survey['_id'] for survey in surveys] == ['b', 'a']
+    assert not_found == ['13', '16']
+    assert collection.finds == 1
+    assert 'MANGO:SURVEY:NO_SURVEY:16' in app.cache.r.values
+
+    # everything is answered from redis now
+    surveys, not_found = survey_store.get_by_reservation_ids(['12', '16', '14'])
+    assert [survey['_id'] for survey in surveys] == ['a', 'b']
+    assert not_found == ['16']
+    assert collection.finds == 1
+
+
+def test_async_store_shares_the_reservation_filter():
+    app = StubApp(reservation_filter={'enabled': True, 'capacity': 1000, 'error_rate': 0.01, 'negative_ttl': 60})
+    collection = AsyncCollection([{'_id': 'a', 'reservation_id': '12'}])
+    SurveyStore(collection, app).reservation_filter.rebuild(['12'])
+    survey_store = AsyncSurveyStore(collection, app, AsyncRedis(app.cache.r))
+    survey_store._load = lambda survey_docs, many=False: survey_docs
+    survey_store.survey_schema = Schema()
+
+    async def scenario():
+        assert (await survey_store.get_by_reservation_id('12'))['_id'] == 'a'
+        with pytest.raises(DocumentNotFound):
+            await survey_store.get_by_reservation_id('13')
+        assert collection.finds == 1
+
+        # a false positive is looked up once, then cached as missing
+        survey_store.reservation_filter.add_many(['14'])
+        surveys, not_found = await survey_store.get_by_reservation_ids(['12', '13', '14'])
+        assert not_found == ['13', '14']
+        assert collection.finds == 2
+        assert 'MANGO:SURVEY:NO_SURVEY:14' in app.cache.r.values
+        with pytest.raises(DocumentNotFound):
+            await survey_store.get_by_reservation_id('14')
+        assert collection.finds == 2
+
+        # saving sets the bits of the reservation and drops its "no survey" entry
+        await survey_store.save({'_id': 'c', 'reservation_id': '15'})
+        assert survey_store.reservation_filter.might_contain('15')
+        await survey_store.save({'_id': 'b', 'reservation_id': '14'})
+        assert 'MANGO:SURVEY:NO_SURVEY:14' not in app.cache.r.values
+        assert (await survey_store.get_by_reservation_id('14'))['_id'] == 'b'
+
+    asyncio.run(scenario())
+
+
+def test_journaled_surveys_are_shared_between_processes(tmpdir):
+    app = StubApp(reservation_filter={'enabled': True, 'capacity': 1000, 'error_rate': 0.01, 'negative_ttl': 60})
+    collection = Collection([{'_id': 'a', 'reservation_id': '12'}])
+    survey_stores = []
+    for worker_index in range(2):
+        survey_store = SurveyStore(collection, app)
+        survey_store.survey_schema = Schema()
+        survey_store._load = lambda survey_doc, many=False: survey_doc
+        survey_store.enable_write_behind(SurveyJournal(app, str(tmpdir), name='surveys-{}'.format(worker_index),
+                                                       flush_interval=3600))
+        survey_stores.append(survey_store)
+    survey_stores[0].rebuild_reservation_filter()
+
+    # already stored
+    with pytest.raises(SaveError):
+        survey_stores[0].save({'reservation_id': '12'})
+
+    survey_id = survey_stores[0].save({'reservation_id': '13'})
+    # pending in the journal of the other worker
+    assert survey_stores[1].get_by_reservation_id('13')['_id'] == survey_id
+    surveys, not_found = survey_stores[1].get_by_reservation_ids(['13', '14'])
+    assert [survey['_id'] for survey in surveys] == [survey_id] and not_found == ['14']
+    with pytest.raises(SaveError):
+        survey_stores[1].save({'reservation_id': '13'})
+
+    for survey_store in survey_stores:
+        survey_store.journal.close()
+    assert [survey['reservation_id'] for survey in collection.documents] == ['12', '13']
+    assert 'MANGO:SURVEY:PENDING:13' not in app.cache.r.values
+
+
+def test_bulk_saves_refuse_journaled_reservations(tmpdir):
+    app = StubApp()
+    collection = Collection([])
+    survey_stores = []
+    for worker_index in range(2):
+        survey_store = SurveyStore(collection, app)
+        survey_store.survey_schema = Schema()
+        survey_store.enable_write_behind(SurveyJournal(app, str(tmpdir), name='surveys-{}'.format(worker_index),
+                                                       flush_interval=3600))
+        survey_stores.append(survey_store)
+
+    survey_id = survey_stores[0].save({'reservation_id': '13'})
+    results = survey_stores[1].save_many([{'reservation_id': '13'}, {'reservation_id': '14'},
+                                          {'reservation_id': '14'}])
+    assert isinstance(results[0], SaveError) and isinstance(results[2], SaveError)
+    assert results[1] == str(collection.documents[0]['_id'])
+    assert 'MANGO:SURVEY:PENDING:14' not in app.cache.r.values
+
+    for survey_store in survey_stores:
+        survey_store.journal.close()
+    # the acknowledged survey is stored, not rejected by the flush
+    assert [(str(survey['_id']), survey['reservation_id']) for survey in collection.documents][1] == (survey_id, '13')
+    assert not tmpdir.join('surveys-0.rejected').exists()
@@ -0,0 +1,273 @@
+from mango.core.store.cache import LocalCache, TieredCacheWrapper, CacheGeneration, PipelinedCacheWrapper, \
+    StampedeGuard
+from conftest import StubApp, DictCacheWrapper, Collection
+from olive.exc import CacheNotFound
+import threading
+import pytest
+import time
+
+
+class RecordingBus:
+    def __init__(self):
+        self.published = []
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def publish(self, key=None):
+        self.published.append(key)
+
+
+def test_local_cache_evicts_least_recently_used():
+    cache = LocalCache(max_size=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    with pytest.raises(CacheNotFound):
+        cache.get('b')
+
+
+def test_local_cache_expires_entries():
+    cache = LocalCache(max_size=2, ttl=0.01)
+    cache.set('a', 1)
+    time.sleep(0.02)
+
+    with pytest.raises(CacheNotFound):
+        cache.get('a')
+    assert len(cache) == 0
+
+
+def test_tiered_cache_reads_redis_once():
+    redis_tier = DictCacheWrapper()
+    redis_tier.write_cache('ALL', [{'weight': 1}])
+    cache = TieredCacheWrapper(redis_tier, LocalCache())
+
+    assert cache.get_cache('ALL') == [{'weight': 1}]
+    assert cache.get_cache('ALL') == [{'weight': 1}]
+    assert redis_tier.reads == 1
+
+
+def test_tiered_cache_broadcasts_and_applies_invalidations():
+    bus = RecordingBus()
+    redis_tier = DictCacheWrapper()
+    cache = TieredCacheWrapper(redis_tier, LocalCache(), bus)
+
+    cache.write_cache('q1', {'weight': 1})
+    cache.delete('ALL')
+    assert bus.published == ['q1', 'ALL']
+
+    # a peer replica changed q1, our local copy must be dropped
+    redis_tier.values['q1'] = {'weight': 2}
+    bus.subscribers[0]('q1')
+    assert cache.get_cache('q1') == {'weight': 2}
+
+    cache.get_cache('q1')
+    bus.subscribers[0](None)
+    assert len(cache.local_cache) == 0
+
+
+def test_cache_generation_bump():
+    app = StubApp()
+    generation = CacheGeneration(app, 'MANGO:SURVEY:GENERATION:GET_SURVEYS')
+
+    assert generation.current() == 0
+    assert generation.bump() == 1
+    assert generation.current() == 1
+    assert app.cache.r.reads == 2
+
+
+def test_cache_generation_is_memoized_with_a_bus():
+    app = StubApp()
+    bus = RecordingBus()
+    generation = CacheGeneration(app, 'MANGO:QUESTION:GENERATION:ALL', bus)
+
+    generation.current()
+    generation.current()
+    assert app.cache.r.reads == 1
+
+    # bumped by another replica
+    app.cache.r.incr(generation.key)
+    bus.subscribers[0](generation.key)
+    assert generation.current() == 1
+
+    generation.bump()
+    assert bus.published == [generation.key]
+    assert generation.current() == 2
+
+
+def test_pipelined_cache_multi_key_operations_cost_one_round_trip():
+    app = StubApp()
+    cache = PipelinedCacheWrapper(app, 'MANGO:SURVEY:{}')
+    generation = CacheGeneration(app, 'MANGO:SURVEY:GENERATION:GET_SURVEYS')
+
+    cache.write_many({'page': [{'_id': '1'}], 'page:COUNT': {'total_count': 1}}, generations=[generation])
+    assert app.cache.r.round_trips == 1
+    assert generation.current() == 1
+
+    app.cache.r.round_trips = 0
+    assert cache.get_many(['page', 'page:COUNT', 'other']) == {'page': [{'_id': '1'}],
+                                                               'page:COUNT': {'total_count': 1}}
+    assert cache.get_cache('page:COUNT') == {'total_count': 1}
+    assert app.cache.r.round_trips == 2
+
+    app.cache.r.round_trips = 0
+    cache.delete_many(['page', 'page:COUNT'], generations=[generation])
+    assert app.cache.r.round_trips == 1
+    assert cache.get_many(['page', 'page:COUNT']) == {}
+    with pytest.raises(CacheNotFound):
+        cache.get_cache('page')
+    assert generation.current() == 2
+
+
+def test_tiered_cache_get_many_only_reads_missing_keys():
+    redis_tier = DictCacheWrapper()
+    cache = TieredCacheWrapper(redis_tier, LocalCache())
+    cache.write_cache('a', 1)
+    redis_tier.values['b'] = 2
+
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+    assert cache.get_many(['a', 'b']) == {'a': 1, 'b': 2}
+    assert redis_tier.reads == 1
+
+
+def test_stampede_guard_waits_for_the_lock_holder():
+    app = StubApp()
+    guard = StampedeGuard(app, lock_ttl=2, poll_interval=0.01)
+    cache = {}
+
+    def read():
+        try:
+            return cache['ALL'], True
+        except KeyError:
+            raise CacheNotFound
+
+    def compute():
+        raise AssertionError('the lock holder computes the entry')
+
+    # another replica is recomputing the entry
+    app.cache.r.values[StampedeGuard.lock_key.format('ALL')] = 'peer'
+    threading.Timer(0.05, lambda: cache.update({'ALL': [{'weight': 1}]})).start()
+    assert guard.fetch('ALL', read, compute) == [{'weight': 1}]
+
+
+def test_stampede_guard_computes_once_and_releases_the_lock():
+    app = StubApp()
+    guard = StampedeGuard(app)
+    cache = {}
+
+    def read():
+        try:
+            return cache['ALL'], True
+        except KeyError:
+            raise CacheNotFound
+
+    def compute():
+        cache['ALL'] = [{'weight': 1}]
+        return cache['ALL']
+
+    assert guard.fetch('ALL', read, compute) == [{'weight': 1}]
+    assert StampedeGuard.lock_key.format('ALL') not in app.cache.r.values
+
+
+def test_stampede_guard_serves_stale_copies_while_refreshing():
+    app = StubApp()
+    guard = StampedeGuard(app, stale_ttl=60)
+    cache = {'STALE': guard.stale_copy([{'weight': 1}])}
+    computed = []
+
+    def read():
+        if 'ALL' in cache:
+            return cache['ALL'], True
+        return guard.from_stale_copy(cache['STALE']), False
+
+    def compute():
+        computed.append(1)
+        cache['ALL'] = [{'weight': 2}]
+        return cache['ALL']
+
+    assert guard.fetch('ALL', read, compute) == [{'weight': 1}]
+    guard._refresher.shutdown(wait=True)
+    assert computed == [1]
+    assert guard.fetch('ALL', read, compute) == [{'weight': 2}]
+
+    with pytest.raises(CacheNotFound):
+        guard.from_stale_copy({'written_at': time.time() - 61, 'value': []})
+
+
+def test_listing_total_is_counted_once_per_generation():
+    from mango.core.store.survey import SurveyStore
+    from bson import ObjectId
+
+    collection = Collection([{'_id': ObjectId(), 'total_rating': 3} for _ in range(5)])
+    survey_store = SurveyStore(collection, StubApp())
+    survey_store._load = lambda docs, many=False: [dict(survey, _id=str(survey['_id'])) for survey in docs]
+
+    cursor, pages = None, 0
+    while cursor != '':
+        total_count, surveys, cursor = survey_store.get_surveys_page(2, cursor=cursor)
+        assert total_count == 5
+        pages += 1
+    assert pages == 3
+    assert collection.counts == 1
+
+    survey_store.surveys_generation.bump()
+    survey_store.get_surveys_page(2)
+    assert collection.counts == 2
+
+
+def test_cached_reads_cost_one_round_trip():
+    from mango.core.store.survey import SurveyStore
+    from mango.core.store.question import QuestionStore
+    from bson import ObjectId
+
+    app = StubApp()
+    collection = Collection([{'_id': ObjectId(), 'total_rating': 3}])
+    survey_store = SurveyStore(collection, app)
+    survey_store._load = lambda docs, many=False: [dict(survey, _id=str(survey['_id'])) for survey in docs]
+    page = survey_store.get_surveys_page(2)
+
+    app.cache.r.round_trips = 0
+    assert survey_store.get_surveys_page(2) == page
+    assert app.cache.r.round_trips == 1
+
+    question_store = QuestionStore(Collection([]), app)
+    question_store.cache_wrapper.write_cache('ALL:0', [{'_id': '1', 'weight': 1}])
+    app.cache.r.round_trips = 0
+    assert question_store.get_questions() == [{'_id': '1', 'weight': 1}]
+    assert app.cache.r.round_trips == 1
+
+    # a bump is seen by the next read
+    question_store.questions_generation.bump()
+    question_store.cache_wrapper.write_cache('ALL:1', [{'_id': '1', 'weight': 2}])
+    assert question_store.get_questions() == [{'_id': '1', 'weight': 2}]
+
+
+def test_backfill_marks_checked_surveys_and_drops_their_cache():
+    from mango.core.store.survey import SurveyStore
+
+    app = StubApp()
+    collection = Collection([{'_id': 1, 'reservation_id': '12'}, {'_id': 2, 'reservation_id': 'unknown'},
+                             {'_id': 3, 'reservation_id': 'broken'}])
+    survey_store = SurveyStore(collection, app)
+    survey_store.cache_wrapper.write_cache('BY_RESERVATION:12', {'_id': '1'})
+    lookups = []
+
+    def get_reservation_attributes(reservation_id):
+        lookups.append(reservation_id)
+        if reservation_id == 'broken':
+            raise ValueError('legacy API is down')
+        return {'city': 'tehran'} if reservation_id == '12' else {}
+
+    assert survey_store.backfill_reservation_attributes(get_reservation_attributes, workers=1) == 1
+    assert collection.documents[0]['city'] == 'tehran'
+    assert 'MANGO:SURVEY:BY_RESERVATION:12' not in app.cache.r.values
+
+    # only the failed lookup is retried
+    lookups.clear()
+    assert survey_store.backfill_reservation_attributes(get_reservation_attributes, workers=1) == 0
+    assert lookups == ['broken']
@@ -0,0 +1,51 @@
+from mango.core.store.catalog import QuestionCatalog
+from conftest import StubApp, Collection
+from bson import ObjectId
+
+
+def test_catalog_indexes_questions_by_context():
+    rate_id, display_id, deleted_id = ObjectId(), ObjectId(), ObjectId()
+    collection = Collection([
+        {'_id': rate_id, 'weight': 2, 'include_in': ['user_rate', 'rate_display'], 'is_deleted': False},
+        {'_id': display_id, 'weight': 1, 'include_in': ['rate_display'], 'is_deleted': False},
+        {'_id': deleted_id, 'weight': 5, 'include_in': ['user_rate'], 'is_deleted': True},
+    ])
+    catalog = QuestionCatalog(collection, StubApp())
+
+    questions = catalog.get_questions([str(rate_id), str(display_id), str(deleted_id)], include_in='user_rate')
+    assert [q['_id'] for q in questions] == [str(rate_id)]
+    assert questions[0]['weight'] == 2
+    assert len(catalog.get_questions([str(rate_id), str(display_id)])) == 2
+    assert collection.finds == 1
+
+
+def test_catalog_rebuilds_after_invalidation():
+    question_id = ObjectId()
+    collection = Collection([{'_id': question_id, 'weight': 2, 'include_in': ['user_rate'], 'is_deleted': False}])
+    catalog = QuestionCatalog(collection, StubApp())
+    catalog.get_questions([str(question_id)])
+    version = catalog.version
+
+    # unrelated keys published on the shared invalidation channel are ignored
+    catalog.invalidate('5d4bbd9cf9c3ca6feb2563b3')
+    catalog.get_questions([str(question_id)])
+    assert catalog.version == version
+
+    collection.documents[0]['weight'] = 7
+    catalog.invalidate()
+    assert catalog.get_questions([str(question_id)])[0]['weight'] == 7
+    assert catalog.version == version + 1
+
+
+def test_rating_questions_leave_out_deleted_questions_without_catalog():
+    from mango.core.store.question import QuestionStore
+
+    rate_id, deleted_id = ObjectId(), ObjectId()
+    question_store = QuestionStore(Collection([
+        {'_id': rate_id, 'weight': 2, 'include_in': ['user_rate'], 'is_deleted': False},
+        {'_id': deleted_id, 'weight': 5, 'include_in': ['user_rate'], 'is_deleted': True},
+    ]), StubApp())
+    assert question_store.catalog is None
+
+    questions = question_store.get_rating_questions([str(rate_id), str(deleted_id)], include_in='user_rate')
+    assert questions == [{'_id': str(rate_id), 'weight': 2}]
@@ -0,0 +1,41 @@
+from mango.core.store.codec import CacheCodec, MSGPACK, MSGPACK_ZLIB
+import pytest
+import ujson
+
+PAGE = [{'_id': '5d5e6f7a8b9c0d1e2f3a4b5c', 'total_rating': 3, 'content': 'great stay ' * 20,
+         'questions': [{'question_id': '5d5e6f7a8b9c0d1e2f3a4b5d', 'rating': 4}]}]
+
+
+@pytest.mark.parametrize('codec', [CacheCodec(), CacheCodec('msgpack'), CacheCodec('msgpack', 'zlib', threshold=64)])
+def test_codecs_round_trip(codec):
+    assert codec.decode(codec.encode(PAGE)) == PAGE
+    assert codec.decode(codec.encode({'total_count': 0, 'next_cursor': ''})) == {'total_count': 0, 'next_cursor': ''}
+
+
+def test_json_codec_keeps_the_untagged_layout():
+    assert CacheCodec().encode(PAGE) == ujson.dumps(PAGE).encode()
+
+
+def test_compression_only_above_the_threshold():
+    codec = CacheCodec('msgpack', 'zlib', threshold=64)
+    assert codec.encode(PAGE)[0] == MSGPACK_ZLIB
+    assert codec.encode({'total_count': 1})[0] == MSGPACK
+    assert len(codec.encode(PAGE)) < len(CacheCodec('msgpack').encode(PAGE))
+
+
+def test_every_format_is_readable_whatever_the_configured_one():
+    json_codec, msgpack_codec = CacheCodec(), CacheCodec('msgpack', 'zlib', threshold=64)
+
+    assert json_codec.decode(msgpack_codec.encode(PAGE)) == PAGE
+    assert msgpack_codec.decode(json_codec.encode(PAGE)) == PAGE
+    # legacy values, as returned by a client decoding responses
+    assert msgpack_codec.decode(ujson.dumps(PAGE)) == PAGE
+
+
+def test_invalid_codec_settings():
+    with pytest.raises(ValueError):
+        CacheCodec('pickle')
+    with pytest.raises(ValueError):
+        CacheCodec('msgpack', 'brotli')
+    with pytest.raises(ValueError):
+        CacheCodec('json', 'zlib')
@@ -0,0 +1,84 @@
+from mango.core.export import SurveyExport
+from conftest import StubApp, Collection, matches
+from bson import ObjectId
+import datetime
+import random
+import pytest
+import ujson
+import csv
+import os
+
+
+class SampledCollection(Collection):
+    """Collection serving the `$match` and `$sample` stages of the export sampling."""
+
+    def aggregate(self, pipeline):
+        surveys = sorted((survey for survey in self.documents if matches(survey, pipeline[0]['$match'])),
+                         key=lambda survey: survey['_id'])
+        return [{'_id': survey['_id']}
+                for survey in random.Random(1).sample(surveys, min(len(surveys), pipeline[1]['$sample']['size']))]
+
+
+def surveys(count, start=datetime.datetime(2019, 8, 1)):
+    return [{'_id': ObjectId.from_datetime(start + datetime.timedelta(minutes=i)),
+             'reservation_id': str(i), 'user_id': 'user-{}'.format(i % 7), 'status': 'published',
+             'platform': 'android', 'total_rating': i % 5 + 1, 'content': 'nice, "clean"\nroom',
+             'created_at': start + datetime.timedelta(minutes=i),
+             'questions': [{'question_id': 'q1', 'rating': i % 5 + 1}]} for i in range(count)]
+
+
+def exported_rows(output_dir, manifest):
+    rows = []
+    for partition in manifest['files']:
+        with open(os.path.join(output_dir, partition['file'])) as export_file:
+            if manifest['format'] == 'jsonl':
+                rows += [ujson.loads(line) for line in export_file]
+            else:
+                rows += list(csv.DictReader(export_file))
+    return rows
+
+
+@pytest.mark.parametrize('export_format', ['jsonl', 'csv'])
+def test_export_splits_the_collection_into_id_ranges(tmpdir, export_format):
+    collection = SampledCollection(surveys(1000))
+    survey_export = SurveyExport(StubApp(), collection, str(tmpdir), export_format=export_format, partitions=4,
+                                 workers=2, batch_size=64)
+    manifest = survey_export.run()
+
+    assert manifest['count'] == 1000
+    assert len(manifest['files']) == 4
+    assert all(100 < partition['count'] < 400 for partition in manifest['files'])
+    rows = exported_rows(str(tmpdir), manifest)
+    assert [row['reservation_id'] for row in rows] == [str(i) for i in range(1000)]
+    assert rows[0]['content'] == 'nice, "clean"\nroom'
+    questions = ujson.loads(rows[3]['questions']) if export_format == 'csv' else rows[3]['questions']
+    assert questions == [{'question_id': 'q1', 'rating': 4}]
+    assert not [name for name in os.listdir(str(tmpdir)) if name.endswith('.tmp')]
+
+
+def test_incremental_export_starts_after_the_watermark(tmpdir):
+    collection = SampledCollection(surveys(100))
+    survey_export = SurveyExport(StubApp(), collection, str(tmpdir), export_format='jsonl', partitions=2)
+    first = survey_export.run()
+    assert SurveyExport.latest_watermark(str(tmpdir)) == first['last_id']
+
+    collection.documents += surveys(10, start=datetime.datetime(2019, 9, 1))
+    second = survey_export.run(after_id=SurveyExport.latest_watermark(str(tmpdir)))
+    assert second['count'] == 10
+    assert SurveyExport.latest_watermark(str(tmpdir)) == second['last_id']
+    assert survey_export.run(after_id=second['last_id'])['count'] == 0
+
+    since = survey_export.run(since=datetime.datetime(2019, 8, 1, 1, 30))
+    assert since['count'] == 10 + 10
+
+
+def test_parquet_export(tmpdir):
+    pq = pytest.importorskip('pyarrow.parquet')
+    collection = SampledCollection(surveys(300))
+    manifest = SurveyExport(StubApp(), collection, str(tmpdir), partitions=3, batch_size=50).run()
+
+    table = pq.ParquetDataset([os.path.join(str(tmpdir), partition['file'])
+                               for partition in manifest['files']]).read()
+    assert table.num_rows == 300
+    assert sorted(table.column('total_rating').to_pylist()) == sorted(i % 5 + 1 for i in range(300))
+    assert table.column('questions').to_pylist()[0] == [{'question_id': 'q1', 'rating': 1}]
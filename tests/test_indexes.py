@@ -0,0 +1,17 @@
+from mango.core.store.indexes import plan_stages
+
+
+def test_plan_stages_walks_nested_plans():
+    winning_plan = {
+        'stage': 'SUBPLAN',
+        'inputStage': {
+            'stage': 'OR',
+            'inputStages': [
+                {'stage': 'IXSCAN', 'indexName': 'total_rating_id'},
+                {'stage': 'FETCH', 'inputStage': {'stage': 'COLLSCAN'}},
+            ]
+        }
+    }
+
+    assert list(plan_stages(winning_plan)) == ['SUBPLAN', 'OR', 'IXSCAN', 'FETCH', 'COLLSCAN']
+    assert list(plan_stages({'queryPlan': {'stage': 'IXSCAN'}})) == ['IXSCAN']
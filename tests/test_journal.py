@@ -0,0 +1,112 @@
+from mango.core.store.journal import SurveyJournal
+from conftest import StubApp
+from bson import json_util
+import os
+
+
+def journal(tmp, flush, **kwargs):
+    # flushes only happen on close() unless a test wakes the flusher up
+    return SurveyJournal(StubApp(), tmp.dir, flush_interval=3600, **kwargs).open(flush)
+
+
+def test_appended_surveys_are_pending_until_flushed(tmp):
+    flushed = []
+    survey_journal = journal(tmp, lambda documents: flushed.extend(documents) or [])
+    survey_id = survey_journal.append({'reservation_id': 12, 'rate': 5})
+
+    assert survey_journal.get_pending(12)['_id'] == survey_id
+    assert survey_journal.get_pending(13) is None
+    assert len(survey_journal) == 1
+
+    survey_journal.close()
+    assert [document['_id'] for document in flushed] == [survey_id]
+    assert survey_journal.get_pending(12) is None
+    assert len(survey_journal) == 0
+    # everything is stored: the journal starts over
+    assert os.path.getsize(survey_journal.journal_path) == 0
+
+
+def test_unflushed_surveys_are_replayed_on_open(tmp):
+    def failing_flush(documents):
+        raise ConnectionError('mongo is down')
+
+    survey_journal = SurveyJournal(StubApp(), tmp.dir, flush_interval=3600, retry_interval=0)
+    survey_journal.open(failing_flush)
+    first_id = survey_journal.append({'reservation_id': 1})
+    second_id = survey_journal.append({'reservation_id': 2})
+    survey_journal.close()
+
+    # a crash in the middle of a write leaves a torn last line
+    with open(survey_journal.journal_path, 'ab') as journal_file:
+        journal_file.write(b'{"reservation_id": 3')
+
+    flushed = []
+    survey_journal = journal(tmp, lambda documents: flushed.extend(documents) or [])
+    assert len(survey_journal) == 2
+    assert survey_journal.get_pending(2)['_id'] == second_id
+    survey_journal.close()
+    assert [document['_id'] for document in flushed] == [first_id, second_id]
+
+
+def test_only_entries_after_the_offset_are_replayed(tmp):
+    batches = []
+
+    def flush(documents):
+        if any(document['reservation_id'] == 2 for document in documents):
+            raise ConnectionError('mongo is down')
+        batches.append(documents)
+        return []
+
+    survey_journal = SurveyJournal(StubApp(), tmp.dir, batch_size=2, flush_interval=3600, retry_interval=0)
+    survey_journal.open(flush)
+    for reservation_id in range(3):
+        survey_journal.append({'reservation_id': reservation_id})
+    survey_journal.close()
+    assert [[document['reservation_id'] for document in batch] for batch in batches] == [[0, 1]]
+
+    reopened = journal(tmp, lambda documents: batches.append(documents) or [])
+    assert [document['reservation_id'] for _, document in reopened._pending] == [2]
+    reopened.close()
+    assert reopened._read_offset() == 0
+
+
+def test_rejected_surveys_are_set_aside(tmp):
+    def flush(documents):
+        return [(document, 'duplicate reservation') for document in documents if document['reservation_id'] == 2]
+
+    survey_journal = journal(tmp, flush)
+    survey_journal.append({'reservation_id': 1})
+    survey_journal.append({'reservation_id': 2})
+    survey_journal.close()
+
+    with open(survey_journal.rejected_path) as rejected_file:
+        rejected = [json_util.loads(line) for line in rejected_file]
+    assert [entry['survey']['reservation_id'] for entry in rejected] == [2]
+    assert rejected[0]['reason'] == 'duplicate reservation'
+    assert len(survey_journal) == 0
+
+
+def test_corrupt_entries_are_set_aside_on_open(tmp):
+    def failing_flush(documents):
+        raise ConnectionError('mongo is down')
+
+    survey_journal = journal(tmp, failing_flush, retry_interval=0)
+    survey_journal.append({'reservation_id': 1})
+    survey_journal.close()
+    with open(survey_journal.journal_path, 'ab') as journal_file:
+        journal_file.write(b'{"reservation_id": \x00\n')
+    for reservation_id in (2, 3):
+        # set aside once, whatever the number of replays
+        survey_journal = journal(tmp, failing_flush, retry_interval=0)
+        survey_journal.append({'reservation_id': reservation_id})
+        survey_journal.close()
+
+    flushed = []
+    survey_journal = journal(tmp, lambda documents: flushed.extend(documents) or [])
+    assert len(survey_journal) == 3
+    survey_journal.close()
+    assert [document['reservation_id'] for document in flushed] == [1, 2, 3]
+    with open(survey_journal.rejected_path) as rejected_file:
+        rejected = [json_util.loads(line) for line in rejected_file]
+    assert len(rejected) == 1 and rejected[0]['reason'].startswith('corrupt journal entry at offset')
+    assert os.path.getsize(survey_journal.journal_path) == 0
@@ -0,0 +1,83 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mango.core.legacy import ReservationResolver
+from mango.core.metrics import LEGACY_LATENCY, LEGACY_FAILURES
+from olive.exc import FetchError
+from concurrent import futures
+from conftest import StubApp
+import threading
+import pytest
+import time
+import json
+
+
+@pytest.fixture()
+def legacy_api():
+    """Local stand-in of the legacy `v3/internal-reservations` endpoint, counting the requests it serves."""
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            hits.append(self.path)
+            # slow enough for concurrent lookups to overlap
+            time.sleep(0.1)
+            status, body = (500, b'{}') if 'broken' in self.path else (200, json.dumps([3, 1, 2, 1]).encode())
+            if '/internal-reservations/' in self.path and status == 200:
+                body = json.dumps({'city': 'tehran', 'complex': '7', 'checkout': '2019-08-01'}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1]), hits
+    server.shutdown()
+
+
+def test_resolved_reservations_are_cached(legacy_api):
+    base_url, hits = legacy_api
+    resolver = ReservationResolver(StubApp(), base_url, 'secret')
+
+    assert resolver.resolve(city='tehran', complex='12') == [1, 2, 3]
+    assert resolver.resolve(complex='12', city='tehran ') == [1, 2, 3]
+    assert len(hits) == 1
+    assert 'city=tehran' in hits[0] and 'complex=12' in hits[0]
+
+
+def test_concurrent_lookups_are_coalesced(legacy_api):
+    base_url, hits = legacy_api
+    resolver = ReservationResolver(StubApp(), base_url, 'secret')
+
+    with futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: resolver.resolve(checkout_start='2019-08-01'), range(8)))
+
+    assert results == [[1, 2, 3]] * 8
+    assert len(hits) == 1
+
+
+def test_legacy_errors_raise_fetch_error(legacy_api):
+    base_url, hits = legacy_api
+    resolver = ReservationResolver(StubApp(), base_url, 'secret')
+
+    with pytest.raises(FetchError):
+        resolver.resolve(city='broken')
+
+
+def test_reservation_lookups_are_timed(legacy_api):
+    base_url, hits = legacy_api
+    resolver = ReservationResolver(StubApp(), base_url, 'secret')
+    requests = sum(LEGACY_LATENCY.collect().get(('get_reservation',), [0])[:-1])
+
+    attributes = resolver.get_reservation_attributes('12')
+    assert attributes == {'city': 'tehran', 'complex': '7', 'checkout_date': '2019-08-01'}
+    with pytest.raises(FetchError):
+        resolver.get_reservation_attributes('broken')
+    assert sum(LEGACY_LATENCY.collect()[('get_reservation',)][:-1]) == requests + 2
+    assert LEGACY_FAILURES.collect()[('get_reservation',)] >= 1
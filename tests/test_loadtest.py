@@ -0,0 +1,79 @@
+from olive.proto import zoodroom_pb2_grpc, zoodroom_pb2
+from mango.core.loadtest import LoadTest, parse_mix
+from mango.main import MangoAppTest
+from concurrent import futures
+from conftest import StubApp
+import pytest
+import grpc
+
+
+class StubService(zoodroom_pb2_grpc.MangoServiceServicer):
+    def GetQuestions(self, request, context):
+        return zoodroom_pb2.GetQuestionsResponse()
+
+    def GetSurveys(self, request, context):
+        return zoodroom_pb2.GetSurveysResponse(total_count=0)
+
+    def GetSurveyByReservationId(self, request, context):
+        return zoodroom_pb2.GetSurveyByReservationIdResponse(error=zoodroom_pb2.Error(code='resource_not_found'))
+
+
+def test_parse_mix():
+    mix = parse_mix('GetSurveys=60, AddSurvey=10,GetQuestions')
+    assert mix == {'GetSurveys': 60, 'AddSurvey': 10, 'GetQuestions': 1}
+
+    with pytest.raises(ValueError):
+        parse_mix('GetSurveys=60,DropSurveys=10')
+    with pytest.raises(ValueError):
+        parse_mix('GetSurveys=many')
+    with pytest.raises(ValueError):
+        parse_mix('GetSurveys=0')
+
+
+def test_loadtest_reports_latencies_and_codes_per_rpc():
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    zoodroom_pb2_grpc.add_MangoServiceServicer_to_server(StubService(), server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    try:
+        report = LoadTest(app=StubApp(),
+                          target='127.0.0.1:{}'.format(port),
+                          mix={'GetSurveys': 1, 'GetSurveyByReservationId': 1},
+                          rate=200,
+                          concurrency=4,
+                          duration=0.5,
+                          seed=1).run()
+    finally:
+        server.stop(None)
+
+    results = report['results']
+    assert results['GetSurveys']['count'] + results['GetSurveyByReservationId']['count'] == 100
+    assert results['GetSurveys']['codes'] == {'ok': results['GetSurveys']['count']}
+    assert results['GetSurveyByReservationId']['codes'] == {
+        'resource_not_found': results['GetSurveyByReservationId']['count']}
+    assert results['GetSurveys']['p99_ms'] >= results['GetSurveys']['p50_ms']
+
+
+def test_loadtest_requests_are_replayed_by_the_seed():
+    def requests(seed):
+        load_test = LoadTest(app=StubApp(), target='127.0.0.1:1', mix={'AddSurvey': 1, 'GetSurveys': 1},
+                             rate=100, concurrency=1, duration=1, seed=seed)
+        load_test.question_ids = ['q{}'.format(i) for i in range(10)]
+        built = []
+        for _ in range(20):
+            add_survey = load_test.build_request('AddSurvey')
+            # unique on every run
+            assert add_survey.reservation_id.startswith('loadtest-')
+            add_survey.ClearField('reservation_id')
+            built += [add_survey, load_test.build_request('GetSurveys')]
+        return built
+
+    assert requests(1) == requests(1)
+    assert requests(1) != requests(2)
+
+
+def test_loadtest_command_rejects_invalid_mix():
+    argv = ['loadtest', '--target', '127.0.0.1:1', '--mix', 'DropSurveys=1']
+    with MangoAppTest(argv=argv) as app:
+        app.run()
+        assert app.exit_code == 1
@@ -6,9 +6,3 @@ def test_mango(tmp):
         res = app.run()
         print(res)
         raise Exception
-
-
-def test_command1(tmp):
-    argv = ['command1']
-    with MangoAppTest(argv=argv) as app:
-        app.run()
@@ -2,6 +2,7 @@ from olive.store.mongo_connection import MongoConnection
 from olive.proto import zoodroom_pb2_grpc, zoodroom_pb2
 from mango.core.store.question import QuestionStore
 from mango.core.store.survey import SurveyStore
+from mango.core.store.stats import SurveyStatsStore
 from mango.core.survey import MangoService
 from decorator import contextmanager
 from mango.main import MangoAppTest
@@ -25,29 +26,12 @@ def test_mango_debug():
         assert app.debug is True
 
 
-def test_command1():
-    # test command1 without arguments
-    argv = ['command1']
-    with MangoAppTest(argv=argv) as app:
-        app.run()
-        data, output = app.last_rendered
-        assert data['foo'] == 'bar'
-        assert output.find('Foo => bar')
-
-    # test command1 with arguments
-    argv = ['command1', '--foo', 'not-bar']
-    with MangoAppTest(argv=argv) as app:
-        app.run()
-        data, output = app.last_rendered
-        assert data['foo'] == 'not-bar'
-        assert output.find('Foo => not-bar')
-
-
 @contextmanager
-def grpc_server(cls, question_store, survey_store, app, ranges, url, key):
+def grpc_server(cls, question_store, survey_store, app, ranges, url, key, **kwargs):
     """Instantiate a Mango server and return a stub for use in tests"""
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    zoodroom_pb2_grpc.add_MangoServiceServicer_to_server(cls(question_store, survey_store, app, ranges, url, key), server)
+    zoodroom_pb2_grpc.add_MangoServiceServicer_to_server(cls(question_store, survey_store, app, ranges, url, key,
+                                                             **kwargs), server)
     port = server.add_insecure_port('[::]:0')
     server.start()
 
@@ -70,7 +54,8 @@ class SurveyTest(unittest.TestCase):
         self.legacy_url = self.app.config['mango']['legacy']['base_url']
         self.legacy_key = self.app.config['mango']['legacy']['key']
         self.question_store = QuestionStore(target_database.question, self.app)
-        self.survey_store = SurveyStore(target_database.survey, self.app)
+        self.stats_store = SurveyStatsStore(target_database.survey_stats, self.app)
+        self.survey_store = SurveyStore(target_database.survey, self.app, stats_store=self.stats_store)
         self.grpc_server = grpc_server(MangoService, self.question_store, self.survey_store,
                                        self.app, self.ranges, self.legacy_url, self.legacy_key)
 
@@ -150,6 +135,20 @@ class SurveyTest(unittest.TestCase):
             ))
             self.assertEqual(response.error.code, 'resource_not_found')
 
+    def test_get_surveys_by_reservation_ids(self):
+        with grpc_server(MangoService, self.question_store, self.survey_store, self.app,
+                         self.ranges, self.legacy_url, self.legacy_key) as stub:
+            response = stub.GetSurveysByReservationIds(zoodroom_pb2.GetSurveysByReservationIdsRequest(
+                reservation_ids=['12', 'non_existent_id']
+            ))
+            self.assertEqual([survey.reservation_id for survey in response.surveys], ['12'])
+            self.assertEqual(list(response.not_found_reservation_ids), ['non_existent_id'])
+
+            response = stub.GetSurveysByReservationIds(zoodroom_pb2.GetSurveysByReservationIdsRequest(
+                reservation_ids=[str(i) for i in range(501)]
+            ))
+            self.assertEqual(response.error.code, 'value_error')
+
     def test_get_surveys(self):
         with grpc_server(MangoService, self.question_store, self.survey_store, self.app,
                          self.ranges, self.legacy_url, self.legacy_key) as stub:
@@ -223,3 +222,203 @@ class SurveyTest(unittest.TestCase):
             get_questions_response = stub.GetQuestions(request=request)
             if deletion_response.is_deleted:
                 self.assertNotIn(question, get_questions_response.questions)
+
+    def test_add_surveys(self):
+        with grpc_server(MangoService, self.question_store, self.survey_store, self.app,
+                         self.ranges, self.legacy_url, self.legacy_key) as stub:
+            requests = [zoodroom_pb2.AddSurveyRequest(
+                questions=[zoodroom_pb2.SurveyQuestion(
+                    question_id='5d4bbd9cf9c3ca6feb2563b3',
+                    rating=2
+                )]
+            ), zoodroom_pb2.AddSurveyRequest(
+                questions=[zoodroom_pb2.SurveyQuestion(
+                    question_id='5d4bbd9cf9c3ca6feb2563b0',
+                    rating=2
+                )]
+            ), zoodroom_pb2.AddSurveyRequest(
+                questions=[zoodroom_pb2.SurveyQuestion(
+                    question_id='12222222',
+                    rating=2
+                )]
+            )]
+            response = stub.AddSurveys(iter(requests))
+            self.assertEqual(len(response.results), 3)
+            self.assertEqual(len(response.results[0].survey_id), 24)
+            self.assertEqual(response.results[1].error.code, 'resource_not_found')
+            self.assertEqual(response.results[2].error.code, 'invalid_id')
+
+    def test_add_surveys_keeps_the_results_of_saved_batches(self):
+        save_many = self.survey_store.save_many
+        calls = []
+
+        def failing_save_many(surveys):
+            calls.append(surveys)
+            if len(calls) > 1:
+                raise ConnectionError('mongo went away')
+            return save_many(surveys)
+
+        self.survey_store.save_many = failing_save_many
+        with grpc_server(MangoService, self.question_store, self.survey_store, self.app,
+                         self.ranges, self.legacy_url, self.legacy_key, bulk_batch_size=1) as stub:
+            requests = [zoodroom_pb2.AddSurveyRequest(
+                questions=[zoodroom_pb2.SurveyQuestion(question_id='5d4bbd9cf9c3ca6feb2563b3', rating=2)]
+            ) for _ in range(2)]
+            response = stub.AddSurveys(iter(requests))
+            self.assertEqual(response.error.code, '')
+            self.assertEqual(len(response.results), 2)
+            self.assertEqual(len(response.results[0].survey_id), 24)
+            self.assertEqual(response.results[1].error.code, 'server_error')
+
+    def test_get_surveys_with_cursor(self):
+        with grpc_server(MangoService, self.question_store, self.survey_store, self.app,
+                         self.ranges, self.legacy_url, self.legacy_key) as stub:
+            first_page = stub.GetSurveys(zoodroom_pb2.GetSurveysRequest(page_size=1))
+            if not first_page.next_cursor:
+                return
+
+            second_page = stub.GetSurveys(zoodroom_pb2.GetSurveysRequest(page_size=1,
+                                                                         cursor=first_page.next_cursor))
+            self.assertEqual(second_page.total_count, first_page.total_count)
+            self.assertNotEqual(second_page.surveys[0]._id, first_page.surveys[0]._id)
+
+            invalid_page = stub.GetSurveys(zoodroom_pb2.GetSurveysRequest(cursor='invalid'))
+            self.assertEqual(invalid_page.error.code, 'invalid_filter')
+
+    def test_get_survey_stats(self):
+        with grpc_server(MangoService, self.question_store, self.survey_store, self.app,
+                         self.ranges, self.legacy_url, self.legacy_key, stats_store=self.stats_store) as stub:
+            stub.AddSurvey(zoodroom_pb2.AddSurveyRequest(
+                questions=[zoodroom_pb2.SurveyQuestion(
+                    question_id='5d4bbd9cf9c3ca6feb2563b3',
+                    rating=2
+                )],
+                platform='stats-test'
+            ))
+            response = stub.GetSurveyStats(zoodroom_pb2.GetSurveyStatsRequest(
+                dimension='platform',
+                key='stats-test'
+            ))
+            self.assertGreater(response.count, 0)
+
+            response = stub.GetSurveyStats(zoodroom_pb2.GetSurveyStatsRequest(
+                dimension='unknown',
+                key='stats-test'
+            ))
+            self.assertEqual(response.error.code, 'invalid_filter')
+
+    def test_get_survey_analytics(self):
+        from mango.core.snapshot import SurveySnapshot
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as path:
+            survey_snapshot = SurveySnapshot(self.app, path)
+            survey_snapshot.refresh(self.survey_store.db)
+            with grpc_server(MangoService, self.question_store, self.survey_store, self.app,
+                             self.ranges, self.legacy_url, self.legacy_key, survey_snapshot=survey_snapshot) as stub:
+                response = stub.GetSurveyAnalytics(zoodroom_pb2.GetSurveyAnalyticsRequest(
+                    interval='week',
+                    percentiles=[50, 95]
+                ))
+                self.assertGreater(response.count, 0)
+                self.assertEqual(sum(bucket.count for bucket in response.buckets), response.count)
+
+                response = stub.GetSurveyAnalytics(zoodroom_pb2.GetSurveyAnalyticsRequest(interval='month'))
+                self.assertEqual(response.error.code, 'invalid_filter')
+
+    def test_get_surveys_by_local_reservation_filters(self):
+        with grpc_server(MangoService, self.question_store, self.survey_store, self.app,
+                         self.ranges, self.legacy_url, self.legacy_key, local_reservation_filters=True) as stub:
+            stub.AddSurvey(zoodroom_pb2.AddSurveyRequest(
+                questions=[zoodroom_pb2.SurveyQuestion(
+                    question_id='5d4bbd9cf9c3ca6feb2563b3',
+                    rating=2
+                )],
+                reservation_id='local-filter-reservation',
+                city='local-filter-city',
+                checkout_date='2019-08-10'
+            ))
+            response = stub.GetSurveys(zoodroom_pb2.GetSurveysRequest(
+                city='local-filter-city',
+                checkout_start='2019-08-01',
+                checkout_end='2019-08-31'
+            ))
+            self.assertIn('local-filter-reservation', [survey.reservation_id for survey in response.surveys])
+
+    def test_stream_get_surveys_in_batches(self):
+        with grpc_server(MangoService, self.question_store, self.survey_store, self.app,
+                         self.ranges, self.legacy_url, self.legacy_key) as stub:
+            batches = list(stub.StreamGetSurveys(zoodroom_pb2.StreamGetSurveysRequest(batch_size=2)))
+            for batch in batches:
+                self.assertLessEqual(len(batch.surveys), 2)
+
+            if len(batches) < 2:
+                return
+
+            # resuming after the first batch streams everything but the first batch
+            resumed = list(stub.StreamGetSurveys(zoodroom_pb2.StreamGetSurveysRequest(
+                batch_size=2,
+                resume_after=batches[0].last_id
+            )))
+            self.assertEqual(resumed[0].surveys[0]._id, batches[1].surveys[0]._id)
+
+    def test_async_service_serves_surveys(self):
+        from mango.core.aio.store import AsyncQuestionStore, AsyncSurveyStore
+        from mango.core.aio.service import AsyncMangoService
+        from motor.motor_asyncio import AsyncIOMotorClient
+        import redis.asyncio
+        import asyncio
+
+        async def scenario():
+            mongo_client = AsyncIOMotorClient(**dict(self.app.config['mango']['mongodb']))
+            database = mongo_client[self.survey_store.db.database.name]
+            redis_cfg = self.app.config.get_section_dict('cache.iredis')
+            redis_client = redis.asyncio.Redis(host=redis_cfg['host'], port=redis_cfg['port'], db=redis_cfg['db'])
+            service = AsyncMangoService(self.question_store, self.survey_store, self.app, self.ranges, self.legacy_url,
+                                        self.legacy_key,
+                                        aio_question_store=AsyncQuestionStore(database.question, self.app,
+                                                                              redis_client),
+                                        aio_survey_store=AsyncSurveyStore(database.survey, self.app, redis_client))
+            server = grpc.aio.server()
+            zoodroom_pb2_grpc.add_MangoServiceServicer_to_server(service, server)
+            port = server.add_insecure_port('127.0.0.1:0')
+            await server.start()
+            try:
+                async with grpc.aio.insecure_channel('127.0.0.1:{}'.format(port)) as channel:
+                    stub = zoodroom_pb2_grpc.MangoServiceStub(channel)
+                    pages = await asyncio.gather(*[stub.GetSurveys(zoodroom_pb2.GetSurveysRequest(page_size=2))
+                                                   for _ in range(20)])
+                    self.assertEqual({page.total_count for page in pages}, {pages[0].total_count})
+                    self.assertEqual(pages[0].error.code, '')
+
+                    response = await stub.GetSurveyByReservationId(zoodroom_pb2.GetSurveyByReservationIdRequest(
+                        reservation_id='async-service-missing-reservation'))
+                    self.assertEqual(response.error.code, 'resource_not_found')
+            finally:
+                await server.stop(None)
+                await redis_client.close()
+
+        asyncio.run(scenario())
+
+    def test_rating_recompute_applies_new_weights(self):
+        from mango.core.recompute import RatingRecompute
+        from bson import ObjectId
+
+        heavy, light = str(ObjectId()), str(ObjectId())
+        self.question_store.db.insert_many([{'_id': ObjectId(heavy), 'weight': 3, 'is_deleted': False},
+                                            {'_id': ObjectId(light), 'weight': 1, 'is_deleted': False}])
+        survey_ids = self.survey_store.db.insert_many([
+            {'questions': [{'question_id': heavy, 'rating': 5}, {'question_id': light, 'rating': 1}],
+             'total_rating': 3, 'platform': 'android', 'status': 'published'}
+            for _ in range(5)]).inserted_ids
+
+        rating_recompute = RatingRecompute(self.app, self.question_store, self.survey_store, batch_size=2)
+        rating_recompute.db.delete_many({})
+        rating_recompute.request([heavy])
+        self.assertTrue(rating_recompute.run())
+
+        # (3 * 5 + 1 * 1) / 4 = 4.0
+        ratings = {survey['total_rating'] for survey in self.survey_store.db.find({'_id': {'$in': survey_ids}})}
+        self.assertEqual(ratings, {4})
+        job = rating_recompute.status()
+        self.assertEqual((job['status'], job['processed'], job['updated']), ('done', 5, 5))
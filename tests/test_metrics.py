@@ -0,0 +1,91 @@
+from mango.core.metrics import Registry, MetricsServer, MeteredCacheWrapper, instrument_store, STORE_LATENCY, \
+    CACHE_REQUESTS
+from conftest import StubApp, DictCacheWrapper
+from olive.exc import CacheNotFound
+from urllib.request import urlopen
+import threading
+
+
+def test_counter_sums_thread_shards():
+    counter = Registry().counter('test_total', 'test counter', ('method',))
+
+    def work():
+        for _ in range(1000):
+            counter.inc('GetSurveys')
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    counter.inc('AddSurvey', amount=2)
+    assert counter.collect() == {('GetSurveys',): 8000, ('AddSurvey',): 2}
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    histogram = registry.histogram('test_seconds', 'test histogram', ('method',), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, 'GetSurveys')
+
+    lines = registry.render().splitlines()
+    assert 'test_seconds_bucket{method="GetSurveys",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{method="GetSurveys",le="1"} 3' in lines
+    assert 'test_seconds_bucket{method="GetSurveys",le="+Inf"} 4' in lines
+    assert 'test_seconds_sum{method="GetSurveys"} 6.05' in lines
+    assert 'test_seconds_count{method="GetSurveys"} 4' in lines
+
+
+class NumberStore:
+    def __init__(self):
+        self.cache_wrapper = DictCacheWrapper({'known': 1})
+
+    def get(self, key):
+        try:
+            return self.cache_wrapper.get_cache(key)
+        except CacheNotFound:
+            return None
+
+    def stream(self):
+        yield from range(3)
+
+
+def test_instrument_store_times_operations_and_counts_cache_reads():
+    store = instrument_store(NumberStore(), 'number')
+    hits = CACHE_REQUESTS.collect().get(('number', 'hit'), 0)
+
+    assert store.get('known') == 1
+    assert store.get('unknown') is None
+    assert list(store.stream()) == [0, 1, 2]
+    assert isinstance(store.cache_wrapper, MeteredCacheWrapper)
+
+    assert CACHE_REQUESTS.collect()[('number', 'hit')] == hits + 1
+    assert CACHE_REQUESTS.collect()[('number', 'miss')] >= 1
+    latencies = STORE_LATENCY.collect()
+    assert sum(latencies[('number', 'get')][:-1]) == 2
+    assert sum(latencies[('number', 'stream')][:-1]) == 1
+
+
+def test_metrics_server_serves_prometheus_text():
+    registry = Registry()
+    registry.counter('test_total', 'test counter').inc()
+    server = MetricsServer(app=StubApp(), registry=registry, port=0).start()
+    try:
+        response = urlopen('http://127.0.0.1:{}/metrics'.format(server.httpd.server_port))
+        assert response.headers['Content-Type'].startswith('text/plain')
+        assert 'test_total 1' in response.read().decode().splitlines()
+    finally:
+        server.stop()
+
+
+def test_probe_keys_are_counted_apart():
+    cache_wrapper = MeteredCacheWrapper(DictCacheWrapper({'known': 1}), 'probed')
+    cache_wrapper.cache_wrapper.values['NO_SURVEY:12'] = True
+
+    values = cache_wrapper.get_many(['BY_RESERVATION:12', 'NO_SURVEY:12', 'known'])
+    assert values == {'NO_SURVEY:12': True, 'known': 1}
+    counts = CACHE_REQUESTS.collect()
+    assert (counts[('probed', 'hit')], counts[('probed', 'miss')]) == (1, 1)
+    assert counts[('probed:no_survey', 'hit')] == 1
+    assert ('probed:no_survey', 'miss') not in counts
@@ -0,0 +1,44 @@
+from mango.core.store.pagination import encode_cursor, decode_cursor, keyset_filter
+from olive.exc import InvalidFilter
+from bson import ObjectId
+import datetime
+import pytest
+
+
+def test_cursor_round_trip():
+    survey_id = ObjectId()
+    token = encode_cursor('+total_rating', {'_id': survey_id, 'total_rating': 3})
+
+    assert decode_cursor(token, '+total_rating') == (3, survey_id)
+
+
+def test_cursor_keeps_datetime_values():
+    survey_id = ObjectId()
+    created_at = datetime.datetime(2019, 8, 10, 12, 30)
+    token = encode_cursor('-created_at', {'_id': survey_id, 'created_at': created_at})
+
+    assert decode_cursor(token, '-created_at') == (created_at, survey_id)
+
+
+def test_invalid_cursor():
+    token = encode_cursor('+total_rating', {'_id': ObjectId(), 'total_rating': 3})
+
+    with pytest.raises(InvalidFilter):
+        decode_cursor(token, '-total_rating')
+    with pytest.raises(InvalidFilter):
+        decode_cursor('not-a-cursor', '+total_rating')
+
+
+def test_keyset_filter():
+    last_id = ObjectId()
+
+    assert keyset_filter('+total_rating', 3, last_id) == {'$or': [
+        {'total_rating': {'$gt': 3}},
+        {'total_rating': 3, '_id': {'$gt': last_id}},
+    ]}
+    assert keyset_filter('-total_rating', 3, last_id) == {'$or': [
+        {'total_rating': {'$lt': 3}},
+        {'total_rating': 3, '_id': {'$lt': last_id}},
+        {'total_rating': None},
+    ]}
+    assert keyset_filter('-total_rating', None, last_id) == {'total_rating': None, '_id': {'$lt': last_id}}
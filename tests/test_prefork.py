@@ -0,0 +1,56 @@
+from mango.core.prefork import Supervisor
+from conftest import StubApp
+import threading
+import signal
+import time
+import os
+
+
+def test_supervisor_restarts_crashed_workers_and_stops_on_sigterm(tmp):
+    def worker(worker_index):
+        # every start leaves a marker, the first start of worker 0 crashes
+        starts = [name for name in os.listdir(tmp.dir) if name.startswith('{}-'.format(worker_index))]
+        open(os.path.join(tmp.dir, '{}-{}'.format(worker_index, len(starts))), 'w').close()
+        if worker_index == 0 and not starts:
+            raise RuntimeError('worker crashed')
+
+        while True:
+            time.sleep(0.05)
+
+    supervisor = Supervisor(app=StubApp(), workers=2, target=worker, restart_delay=0.1, grace=2)
+
+    def stop_when_restarted():
+        deadline = time.monotonic() + 10
+        while '0-1' not in os.listdir(tmp.dir) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    threading.Thread(target=stop_when_restarted, daemon=True).start()
+    started_at = time.monotonic()
+    assert supervisor.run()
+
+    assert time.monotonic() - started_at < 10
+    assert sorted(os.listdir(tmp.dir)) == ['0-0', '0-1', '1-0']
+    assert supervisor.processes == {}
+    assert signal.getsignal(signal.SIGTERM) == previous_handler
+
+
+def test_supervisor_stops_on_crash_loop(tmp):
+    def worker(worker_index):
+        starts = [name for name in os.listdir(tmp.dir) if name.startswith('{}-'.format(worker_index))]
+        open(os.path.join(tmp.dir, '{}-{}'.format(worker_index, len(starts))), 'w').close()
+        if worker_index == 0:
+            raise RuntimeError('worker crashed')
+
+        while True:
+            time.sleep(0.05)
+
+    supervisor = Supervisor(app=StubApp(), workers=2, target=worker, restart_delay=0.2, grace=2, max_restarts=2)
+    started_at = time.monotonic()
+    assert not supervisor.run()
+
+    # restarted after 0.2s then 0.4s, the third exit in a row stops every worker
+    assert time.monotonic() - started_at >= 0.6
+    assert sorted(os.listdir(tmp.dir)) == ['0-0', '0-1', '0-2', '1-0']
+    assert supervisor.processes == {}
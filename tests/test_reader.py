@@ -0,0 +1,53 @@
+from mango.core.models.question import QuestionSchema
+from mango.core.models.survey import SurveySchema
+from mango.core.models.reader import compile_reader
+from bson import ObjectId
+
+
+def survey_doc(**kwargs):
+    doc = {
+        '_id': ObjectId(),
+        'user_id': '1',
+        'staff_id': '',
+        'reservation_id': '12',
+        'total_rating': 3,
+        'status': 'published',
+        'content': 'it was fine',
+        'platform': 'android',
+        'questions': [{'question_id': str(ObjectId()), 'rating': 3}, {'question_id': str(ObjectId()), 'rating': 2}],
+    }
+    doc.update(kwargs)
+    return doc
+
+
+def test_survey_reader_matches_schema_load():
+    schema = SurveySchema(exclude_none_id=True)
+    read = compile_reader(schema)
+    doc = survey_doc(city='tehran', complex='12', checkout_date='2019-08-10')
+
+    assert read(doc) == schema.load(doc)
+
+
+def test_survey_reader_skips_missing_fields():
+    schema = SurveySchema(exclude_none_id=True)
+    read = compile_reader(schema)
+    doc = survey_doc()
+
+    assert read(doc) == schema.load(doc)
+    assert 'city' not in read(doc)
+
+
+def test_question_reader_matches_schema_load():
+    schema = QuestionSchema(exclude_none_id=True)
+    read = compile_reader(schema)
+    doc = {
+        '_id': ObjectId(),
+        'title': {'on_rate': 'rate it', 'on_display': 'rated'},
+        'include_in': ['user_rate'],
+        'weight': 2,
+        'order': 1,
+        'is_deleted': False,
+    }
+
+    assert read(doc) == schema.load(doc)
+    assert read(doc)['_id'] == str(doc['_id'])
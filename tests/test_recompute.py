@@ -0,0 +1,81 @@
+from mango.core.recompute import total_ratings, RatingRecompute
+from mango.core.store.stats import SurveyStatsStore
+from conftest import Collection
+from bson import ObjectId
+import random
+
+
+def python_total_rating(survey, weights):
+    # the computation of MangoService._build_survey_payload
+    sum_of_survey = 0.0
+    counter = 0.0
+    for question in survey['questions']:
+        sum_of_survey += weights.get(question['question_id'], 0) * question['rating']
+        counter += weights.get(question['question_id'], 0)
+
+    return int(round(sum_of_survey / counter, 1)) if counter else None
+
+
+def test_total_ratings_match_the_add_survey_computation():
+    rng = random.Random(7)
+    weights = {str(question): rng.randint(0, 10) for question in range(20)}
+    surveys = [{'questions': [{'question_id': str(rng.randrange(22)), 'rating': rng.randint(0, 5)}
+                              for _ in range(rng.randint(0, 6))]}
+               for _ in range(5000)]
+
+    assert total_ratings(surveys, weights) == [python_total_rating(survey, weights) for survey in surveys]
+
+
+def test_total_ratings_round_like_python_on_ties():
+    weights = {'a': 1, 'b': 1, 'zero': 0}
+    surveys = [
+        {'questions': [{'question_id': 'a', 'rating': 4}, {'question_id': 'b', 'rating': 3}]},
+        {'questions': [{'question_id': 'zero', 'rating': 5}]},
+        {'questions': []},
+    ]
+
+    assert total_ratings(surveys, weights) == [3, None, None]
+    assert total_ratings([], weights) == []
+
+
+def test_rating_change_operations_move_the_survey_between_ratings():
+    stats_store = SurveyStatsStore(db=None, app=None)
+    survey = {'_id': ObjectId(), 'total_rating': 3, 'platform': 'android', 'status': 'published'}
+    operations = stats_store.rating_change_operations(survey, 4)
+
+    assert len(operations) == 4
+    assert operations[0]._doc['$inc'] == {'count': 0, 'sum': 1, 'sum_sq': 7, 'histogram.3': -1, 'histogram.4': 1}
+    assert {operation._filter['_id'].split(':')[0] for operation in operations} == {'platform', 'status'}
+
+
+class Store:
+    def __init__(self, db):
+        self.db = db
+        self.cache_wrapper = self
+
+    def delete_many(self, keys):
+        pass
+
+
+def test_recompute_only_moves_the_stats_of_matched_updates():
+    questions = Collection([{'_id': 'a', 'weight': 1, 'is_deleted': False},
+                            {'_id': 'b', 'weight': 1, 'is_deleted': False},
+                            {'_id': 'gone', 'weight': 5, 'is_deleted': True}])
+    surveys = [{'_id': ObjectId(), 'total_rating': 1, 'platform': 'android', 'status': 'published',
+                'questions': [{'question_id': 'a', 'rating': 5}, {'question_id': 'gone', 'rating': 1}]}
+               for _ in range(2)]
+    survey_collection = Collection(surveys)
+    survey_collection.database = {'rating_recompute': None}
+    stats_collection = Collection()
+    recompute = RatingRecompute(app=None, question_store=Store(questions), survey_store=Store(survey_collection),
+                                stats_store=SurveyStatsStore(db=stats_collection, app=None))
+
+    weights = recompute._weights()
+    assert weights == {'a': 1, 'b': 1}
+
+    # rated again by someone else after it was read
+    survey_collection.documents[1]['total_rating'] = 2
+    assert recompute._recompute_batch(surveys, weights) == 1
+    assert survey_collection.documents[0]['total_rating'] == 5
+    assert survey_collection.documents[1]['total_rating'] == 2
+    assert len(stats_collection.written) == 4
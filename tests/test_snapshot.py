@@ -0,0 +1,133 @@
+from mango.core.snapshot import SurveySnapshot
+from olive.exc import DocumentNotFound, InvalidFilter
+from conftest import StubApp, Cursor, Collection
+from bson import ObjectId
+import numpy as np
+import datetime
+import random
+import pytest
+import os
+
+
+class ReadingCursor(Cursor):
+    """Runs `on_read(survey)` as every survey is read."""
+
+    def __init__(self, surveys, on_read):
+        super().__init__(surveys)
+        self.on_read = on_read
+
+    def __iter__(self):
+        for survey in super().__iter__():
+            self.on_read(survey)
+            yield survey
+
+
+def surveys(count, start=datetime.datetime(2019, 8, 1), seed=1):
+    rng = random.Random(seed)
+    result = []
+    for i in range(count):
+        created_at = start + datetime.timedelta(hours=i)
+        ratings = [rng.randint(1, 5) for _ in range(2)]
+        result.append({'_id': ObjectId.from_datetime(created_at), 'created_at': created_at,
+                       'platform': rng.choice(['android', 'ios']), 'status': rng.choice(['published', 'pending']),
+                       'total_rating': round(sum(ratings) / 2),
+                       'questions': [{'question_id': 'q1', 'rating': ratings[0]},
+                                     {'question_id': 'q2', 'rating': ratings[1]}]})
+    return result
+
+
+def test_analytics_per_day(tmpdir):
+    collection = Collection(surveys(24 * 10))
+    snapshot = SurveySnapshot(StubApp(), str(tmpdir))
+    assert snapshot.refresh(collection, batch_size=50) == 240
+
+    result = snapshot.analytics(interval='day', platform='android', window=3, percentiles=(50, 90))
+    android = [survey for survey in collection.documents if survey['platform'] == 'android']
+    assert result['count'] == len(android)
+    assert len(result['buckets']) == 10
+
+    for position, bucket in enumerate(result['buckets']):
+        day = datetime.datetime(2019, 8, 1) + datetime.timedelta(days=position)
+        ratings = [survey['total_rating'] for survey in android
+                   if day <= survey['created_at'] < day + datetime.timedelta(days=1)]
+        window_start = day - datetime.timedelta(days=2)
+        window_ratings = [survey['total_rating'] for survey in android
+                          if window_start <= survey['created_at'] < day + datetime.timedelta(days=1)]
+        assert bucket['start'] == day.strftime('%Y-%m-%d')
+        assert bucket['count'] == len(ratings)
+        assert bucket['mean'] == pytest.approx(np.mean(ratings))
+        assert bucket['rolling_mean'] == pytest.approx(np.mean(window_ratings))
+        assert [p['value'] for p in bucket['percentiles']] == \
+            [int(np.percentile(ratings, percentile, method='inverted_cdf')) for percentile in (50, 90)]
+        assert sum(h['count'] for h in bucket['histogram']) == len(ratings)
+
+
+def test_question_ratings_per_week(tmpdir):
+    collection = Collection(surveys(24 * 21))
+    snapshot = SurveySnapshot(StubApp(), str(tmpdir))
+    snapshot.refresh(collection)
+
+    result = snapshot.analytics(interval='week', question_id='q2', start='2019-08-05', end='2019-08-19')
+    # 2019-08-05 is a monday
+    assert [bucket['start'] for bucket in result['buckets']] == ['2019-08-05', '2019-08-12']
+    ratings = [question['rating'] for survey in collection.documents
+               for question in survey['questions'] if question['question_id'] == 'q2'
+               and datetime.datetime(2019, 8, 5) <= survey['created_at'] < datetime.datetime(2019, 8, 19)]
+    assert result['count'] == len(ratings)
+    assert result['mean'] == pytest.approx(np.mean(ratings))
+
+    with pytest.raises(DocumentNotFound):
+        snapshot.analytics(question_id='q3')
+    with pytest.raises(InvalidFilter):
+        snapshot.analytics(interval='month')
+
+
+def test_refresh_appends_new_surveys(tmpdir):
+    collection = Collection(surveys(100))
+    snapshot = SurveySnapshot(StubApp(), str(tmpdir))
+    snapshot.refresh(collection)
+    assert snapshot.analytics()['count'] == 100
+
+    collection.documents += surveys(30, start=datetime.datetime(2019, 9, 1), seed=2)
+    # rows left behind by an interrupted refresh are dropped
+    with open(snapshot._column_path('created_day', 0), 'ab') as column_file:
+        column_file.write(b'\0' * 4)
+    assert snapshot.refresh(collection) == 30
+    assert snapshot.refresh(collection) == 0
+    assert snapshot.analytics()['count'] == 130
+    assert snapshot.analytics(start='2019-09-01')['count'] == 30
+
+    # created before the last survey copied: date ranges can no longer be sliced
+    late = surveys(1, start=datetime.datetime(2019, 8, 2))[0]
+    late['_id'] = ObjectId.from_datetime(datetime.datetime(2019, 10, 1))
+    collection.documents.append(late)
+    assert snapshot.refresh(collection) == 1
+    assert not snapshot.view()[0]['sorted']
+    assert snapshot.analytics(start='2019-09-01')['count'] == 30
+    assert snapshot.analytics(end='2019-09-01')['count'] == 101
+
+    collection.documents = collection.documents[:10]
+    assert snapshot.refresh(collection, rebuild=True) == 10
+    assert snapshot.analytics()['count'] == 10
+
+
+def test_readers_only_see_complete_rebuilds(tmpdir):
+    collection = Collection(surveys(100))
+    snapshot = SurveySnapshot(StubApp(), str(tmpdir))
+    snapshot.refresh(collection)
+    reader = SurveySnapshot(StubApp(), str(tmpdir))
+    meta, columns = reader.view()
+
+    counts = []
+    collection.documents = collection.documents[:60]
+    find = collection.find
+    collection.find = lambda *args, **kwargs: ReadingCursor(find(*args, **kwargs),
+                                                            lambda survey: counts.append(reader.analytics()['count']))
+    assert snapshot.refresh(collection, batch_size=7, rebuild=True) == 60
+    assert counts == [100] * 60
+    assert reader.analytics()['count'] == 60
+    assert reader.view()[0]['generation'] == meta['generation'] + 1
+    # the previous generation is gone but stays readable through the maps taken before the swap
+    assert sorted(os.listdir(str(tmpdir))) == sorted(['.lock', 'snapshot.json'] + [
+        '{}.1.bin'.format(name) for name, _ in SurveySnapshot.survey_columns + SurveySnapshot.rating_columns])
+    assert int(columns['total_rating'][99]) == surveys(100)[99]['total_rating']
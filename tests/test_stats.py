@@ -0,0 +1,66 @@
+from mango.core.store.stats import SurveyStatsStore
+from pymongo.errors import AutoReconnect, BulkWriteError
+from conftest import StubApp
+from bson import ObjectId
+import pytest
+
+
+class StatsCollection:
+    """Applies `$inc` upserts, failing the bulk writes listed in `failures`."""
+
+    def __init__(self, failures=()):
+        self.docs = {}
+        self.failures = list(failures)
+
+    def find_one(self, query):
+        return self.docs.get(query['_id'])
+
+    def bulk_write(self, operations, ordered=True):
+        failure = self.failures.pop(0) if self.failures else None
+        if isinstance(failure, Exception):
+            raise failure
+
+        for index, operation in enumerate(operations):
+            if failure and index in failure:
+                continue
+            update = operation._doc
+            stats_doc = self.docs.setdefault(operation._filter['_id'], dict(update['$setOnInsert'], histogram={}))
+            for field, amount in update['$inc'].items():
+                if field.startswith('histogram.'):
+                    rating = field.split('.')[1]
+                    stats_doc['histogram'][rating] = stats_doc['histogram'].get(rating, 0) + amount
+                else:
+                    stats_doc[field] = stats_doc.get(field, 0) + amount
+
+        if failure:
+            raise BulkWriteError({'writeErrors': [{'index': index, 'errmsg': 'failed'} for index in failure]})
+
+
+def survey(rating):
+    return {'_id': ObjectId(), 'platform': 'android', 'status': 'published', 'total_rating': rating}
+
+
+def test_failed_updates_are_written_from_the_outbox():
+    # the first write partially fails, the second one does not reach mongo
+    collection = StatsCollection(failures=[{1, 3}, AutoReconnect('mongo is down')])
+    stats_store = SurveyStatsStore(collection, StubApp())
+    with pytest.raises(BulkWriteError):
+        stats_store.record_many([survey(4)])
+    assert len(stats_store.app.cache.r.lists[stats_store.outbox_key]) == 2
+    with pytest.raises(AutoReconnect):
+        stats_store.record_many([survey(2)])
+    assert len(stats_store.app.cache.r.lists[stats_store.outbox_key]) == 6
+
+    stats_store.record_many([survey(3)])
+    assert stats_store.app.cache.r.lists[stats_store.outbox_key] == []
+    for dimension, key in (('platform', 'android'), ('status', 'published')):
+        stats = stats_store.get(dimension, key)
+        assert stats['count'] == 3
+        assert stats['mean'] == 3
+
+
+def test_empty_aggregates():
+    collection = StatsCollection()
+    collection.docs['platform:ios:ALL'] = {'day': 'ALL', 'count': 0, 'sum': 0, 'sum_sq': 0, 'histogram': {'4': 0}}
+    stats = SurveyStatsStore(collection, StubApp()).get('platform', 'ios')
+    assert (stats['count'], stats['mean'], stats['stddev']) == (0, 0.0, 0.0)
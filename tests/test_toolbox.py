@@ -0,0 +1,53 @@
+from mango.core.toolbox import SingleFlight, percentile, summarize_latencies
+import threading
+import time
+
+
+def test_percentile_uses_nearest_rank():
+    values = list(range(1, 101))
+
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([7], 99) == 7
+    assert percentile([], 50) is None
+
+
+def test_summarize_latencies_in_milliseconds():
+    summary = summarize_latencies([0.003, 0.001, 0.002, 0.004])
+
+    assert summary['count'] == 4
+    assert summary['p50_ms'] == 2
+    assert summary['p99_ms'] == summary['max_ms'] == 4
+    assert round(summary['mean_ms'], 6) == 2.5
+    assert summarize_latencies([]) == {'count': 0}
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    single_flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 42
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(single_flight.do('ALL', compute)))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=lambda: results.append(single_flight.do('ALL', compute))) for _ in range(4)]
+    for follower in followers:
+        follower.start()
+    time.sleep(0.05)
+    release.set()
+    assert single_flight.running('ALL')
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert results == [42] * 5
+    assert len(calls) == 1
+    assert not single_flight.running('ALL')